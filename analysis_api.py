@@ -1,16 +1,123 @@
-import glob
+from __future__ import annotations
+
 import os
 import shutil
 import stat
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Iterable, Union
-
-import git
-import lizard
-import pandas as pd
-from git.repo.base import Repo
+from typing import Callable, Iterable, Iterator, Optional, Union
 
+import discovery
+import export
+import fast_python
 import features
+import history
+import hotspots
+import mirrors
+import sampling
+import sketch
+from lazy import lazy_import
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+git = lazy_import('git')
+lizard = lazy_import('lizard')
+pd = lazy_import('pandas')
+
+
+# The columns of the per-function analysis of each file
+FUNCTION_COLUMNS = ['name', 'start_line', 'nloc', 'CCN', 'enclosing_class', 'max_depth', 'branches', 'calls',
+                    'returns', 'raises', 'assertions']
+# The columns that come from `features` rather than from lizard
+EXTRA_COLUMNS = FUNCTION_COLUMNS[4:]
+# The ways Python files can be analyzed: with lizard, or with `fast_python`, which gives the same
+# results without running lizard
+ENGINES = ('lizard', 'fast')
+# The columns of the per-file summary of a repository
+SUMMARY_COLUMNS = ['file_dir', 'file_name', 'nloc', 'CCN', 'func_token']
+# The number of files whose results are written to disk together by `SpilledResults`
+SPILL_FILES = 1000
+
+
+@dataclass()
+class FileResult:
+    """The analysis of a single file, as yielded by `ClonedRepo.iter_files`"""
+    # The path of the file relative to the root of the repository, with a leading separator. This is
+    # the key of `ClonedRepo.file_analysis`
+    path: str
+    file_dir: str
+    file_name: str
+    nloc: int
+    CCN: int
+    func_token: int
+    # One row per function, with the columns in `FUNCTION_COLUMNS`
+    functions: pd.DataFrame
+
+    def summary(self) -> dict:
+        """
+        :return: The file's row of the per-file summary, see `SUMMARY_COLUMNS`
+        """
+        return {column: getattr(self, column) for column in SUMMARY_COLUMNS}
+
+
+class SpilledResults:
+    """The per-file results of a repository, written to `directory` in batches of `batch_files` files,
+    so that they can be read back later without ever being held in memory all at once.
+
+    Every batch is a pickled DataFrame with the functions of its files, plus one with their summaries.
+    """
+    def __init__(self, directory: Union[str, Path], batch_files: int = SPILL_FILES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.batch_files = batch_files
+        self.batches = 0
+        self.buffer: list[FileResult] = []
+
+    def _batch_paths(self, i: int) -> tuple[Path, Path]:
+        return self.directory / f"summary-{i:05d}.pkl", self.directory / f"functions-{i:05d}.pkl"
+
+    def add(self, result: FileResult):
+        self.buffer.append(result)
+        if len(self.buffer) >= self.batch_files:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        [summary_path, functions_path] = self._batch_paths(self.batches)
+        summary = pd.DataFrame(data=[result.summary() for result in self.buffer], columns=SUMMARY_COLUMNS)
+        summary.assign(path=[result.path for result in self.buffer]).to_pickle(summary_path)
+        frames = [result.functions.assign(path=result.path) for result in self.buffer]
+        pd.concat(frames, ignore_index=True).to_pickle(functions_path)
+        self.batches += 1
+        self.buffer = []
+
+    def summary(self) -> pd.DataFrame:
+        """
+        :return: The per-file summary of every file, with the columns in `SUMMARY_COLUMNS`
+        """
+        self.flush()
+        frames = [pd.read_pickle(self._batch_paths(i)[0]) for i in range(self.batches)]
+        if not frames:
+            return pd.DataFrame(columns=SUMMARY_COLUMNS)
+        return pd.concat(frames, ignore_index=True)[SUMMARY_COLUMNS]
+
+    def __iter__(self) -> Iterator[FileResult]:
+        """Reads the results back, one batch at a time"""
+        self.flush()
+        for i in range(self.batches):
+            [summary_path, functions_path] = self._batch_paths(i)
+            functions = dict(iter(pd.read_pickle(functions_path).groupby('path', sort=False)))
+            for row in pd.read_pickle(summary_path).itertuples(index=False):
+                df = functions.get(row.path)
+                df = pd.DataFrame(columns=FUNCTION_COLUMNS) if df is None else df[FUNCTION_COLUMNS]
+                yield FileResult(row.path, row.file_dir, row.file_name, row.nloc, row.CCN, row.func_token,
+                                 df.reset_index(drop=True))
+
+    def remove(self):
+        """Deletes the results from disk"""
+        remove_dir(self.directory)
 
 
 class ClonedRepo:
@@ -18,22 +125,50 @@ class ClonedRepo:
     analyzed and deleted once analysis is complete. The results of analysis are
     cached for repeated use.
     """
-    def __init__(self, root_path: Path, user_name: str, repo_name: str):
+    def __init__(self, root_path: Path, user_name: str, repo_name: str, languages: Iterable[str] = ('python',),
+                 engine: str = 'lizard'):
         self.root_path = root_path
         self.user_name = user_name
         self.repo_name = repo_name
+        # The languages (as lizard names them) to analyze. `None` analyzes every supported language
+        self.languages = languages
+        # How Python files are analyzed, one of `ENGINES`
+        self.engine = engine
+        # The URL the repository was cloned from and the commit that was checked out, if known
+        self.url: Optional[str] = None
+        self.commit: Optional[str] = None
         self.repo_analysis: pd.DataFrame = None
         self.file_analysis: dict[str, pd.DataFrame] = None
+        self.history: Optional[history.History] = None
+        self.hotspot_analysis: Optional[hotspots.Hotspots] = None
+        # The working copy in the scratch area of `cache`, if the repository was checked out of a mirror
+        self.checkout: Optional[mirrors.Checkout] = None
+        self.cache: Optional[mirrors.MirrorCache] = None
+        # Aggregate statistics, which `iter_files` updates as every file is analyzed
+        self.sketch: Optional[sketch.RepoSketch] = None
+        # The results `iter_files` wrote to disk, if it was asked to
+        self.spilled: Optional[SpilledResults] = None
+        # The files `estimate` analyzed, by their path in the repository, so that a full analysis doesn't
+        # analyze them again
+        self.sampled_files: dict[str, tuple[FileResult, int]] = {}
 
     @staticmethod
-    def from_url(url: str) -> "ClonedRepo":
+    def from_url(url: str, languages: Iterable[str] = ('python',), engine: str = 'lizard',
+                 cache: mirrors.MirrorCache = None) -> "ClonedRepo":
         """
         :param url: The URL of the repository
+        :param languages: The languages to analyze, as lizard names them. `None` analyzes every
+            supported language
+        :param engine: How Python files are analyzed, one of `ENGINES`
+        :param cache: The mirrors the repository is checked out of. Defaults to `mirrors.default_cache()`
         :return: A `ClonedRepo` instance for the repository at `url`.
         :raise git.GitCommandError: if the URL is not the root of a valid
             git repository.
         """
-        return clone_repo(url)
+        ret = clone_repo(url, cache)
+        ret.languages = languages
+        ret.engine = engine
+        return ret
 
     def analyze_files(self, file_filter: Callable[[pd.DataFrame], pd.DataFrame] = None,
                       func_filter: Callable[[pd.DataFrame], pd.DataFrame] = None, sort: list[str] = None,
@@ -98,89 +233,256 @@ class ClonedRepo:
             files_to_include = files_to_include.sort_values(by=list(sort), ascending=ascending)
         return files_to_include
 
+    def export(self, path: Union[str, Path], fmt: str = 'sqlite', compress: bool = None):
+        """Writes the summary and the per-function details of every file into `path`.
+
+        :param path: Where to write the results. For the `csv` format this is a directory, otherwise it is a file
+        :param fmt: The format to write, one of the keys of `export.FORMATS`
+        :param compress: If the output should be compressed. `None` uses the format's default
+        """
+        repo = f"{self.user_name}/{self.repo_name}"
+        with export.open_exporter(path, fmt, compress) as exporter:
+            if self.file_analysis is not None:
+                export.export_analysis(exporter, repo, self.repo_analysis, self.file_analysis)
+                return
+            # Streamed, so that the results of every file are written as soon as it was analyzed
+            summary = []
+            for result in self.iter_files():
+                exporter.write_functions(result.functions, repo, result.path)
+                summary.append(result.summary())
+            exporter.write_summary(pd.DataFrame(data=summary, columns=SUMMARY_COLUMNS), repo)
+
+    def estimate(self, precision: float = sampling.PRECISION, time_budget: float = None,
+                 confidence: float = sampling.CONFIDENCE, seed=None) -> sampling.Estimate:
+        """Estimates the summary statistics of the repository from a stratified random sample of its files,
+        which is much faster than analyzing all of them. The working copy is kept, so that the repository
+        can still be analyzed in full afterwards, e.g. with `analyze_repo`, if the estimates look interesting.
+
+        :param precision: Stop once the confidence intervals are at most this wide on either side, relative
+            to the estimates
+        :param time_budget: Stop after this many seconds, however precise the estimates are by then
+        :param confidence: The confidence level of the intervals
+        :param seed: The seed of the random sample, to draw the same files every time
+        :return: The estimated means and totals, see `sampling.Estimate`
+        """
+        if not os.path.exists(self.root_path) and self.cache is not None:
+            self.checkout = self.cache.checkout(self.url, self.commit or 'HEAD')
+            self.root_path = self.checkout.path
+
+        def analyze(entry: discovery.SourceEntry) -> dict[str, float]:
+            # By the path in the repository, since the working copy may be checked out elsewhere next time
+            if entry.rel_path not in self.sampled_files:
+                self.sampled_files[entry.rel_path] = self._analyze_file(entry)
+            [result, loc] = self.sampled_files[entry.rel_path]
+            return {'nloc': result.nloc, 'loc': loc, 'CCN': result.CCN, 'func_token': result.func_token}
+        return sampling.estimate(self._discover_files(), analyze, precision, time_budget, confidence, seed)
+
+    def analyze_history(self, rev_range: str = None, every: int = 1, max_commits: int = None) -> history.History:
+        """Analyzes the complexity of the repository at a series of commits, without checking any of them out.
+        The result is cached, so only the first call determines which commits are analyzed.
+
+        :param rev_range: The commits to include, e.g. `v1.0..v2.0`. Defaults to the entire history of HEAD
+        :param every: Only include every `every`th commit. The newest commit is always included
+        :param max_commits: Only include (at most) this many of the newest commits
+        :return: The metrics of the repository at every selected commit, see `history.History`
+        """
+        if self.history is None:
+            with self._git_dir() as git_dir:
+                self.history = history.analyze_history(git_dir, rev_range, every, max_commits, self.languages,
+                                                       engine=self.engine)
+        return self.history
+
+    def hotspots(self, since: str = None) -> hotspots.Hotspots:
+        """Ranks the files and functions of the repository by how often they changed multiplied by their CCN.
+        The result is cached, so only the first call determines which changes are counted.
+
+        :param since: Only count changes after this date, in any format `git log --since` accepts
+        :return: The ranked files and functions, see `hotspots.Hotspots`
+        """
+        if self.hotspot_analysis is None:
+            with self._git_dir() as git_dir:
+                self.hotspot_analysis = hotspots.analyze_hotspots(git_dir, since=since, languages=self.languages,
+                                                                  engine=self.engine)
+        return self.hotspot_analysis
+
+    @contextmanager
+    def _git_dir(self) -> Iterator[Path]:
+        """Provides the git directory of the repository. If the working copy was already removed by
+        `_perform_analysis`, just the history is fetched again, and removed afterwards."""
+        git_dir = Path(self.root_path) / '.git'
+        if git_dir.exists():
+            yield git_dir
+            return
+        if self.cache is not None:
+            # The mirror the repository was checked out of, which is only cloned again if it was evicted
+            with self.cache.mirror(self.url, fetch=False) as git_dir:
+                yield git_dir
+            return
+        git_dir = Path(f"{self.root_path}.git")
+        if git_dir.exists():
+            remove_dir(git_dir)
+        git.Repo.clone_from(self.url, git_dir, bare=True).close()
+        try:
+            yield git_dir
+        finally:
+            remove_dir(git_dir)
+
+    def iter_files(self, spill_dir: Union[str, Path] = None, batch_files: int = SPILL_FILES) -> Iterator[FileResult]:
+        """Analyzes every code file in the repository, and yields the results of each file as soon as it
+        is done. Nothing is kept in memory but the aggregates in `sketch`, so a repository of any size
+        can be analyzed in bounded memory, and consumers can start on the first file right away.
+
+        The working copy is removed once every file was analyzed, or as soon as the generator is closed
+        or fails before that. If the results were kept (in `file_analysis` or `spilled`), they are yielded
+        again by later calls; otherwise the repository is checked out of its mirror and analyzed again.
+
+        :param spill_dir: If given, the results are also written to this directory in batches, and are
+            kept in `spilled`, see `SpilledResults`
+        :param batch_files: The number of files per batch written to `spill_dir`
+        """
+        if self.spilled is not None:
+            yield from self.spilled
+            return
+        if self.file_analysis is not None:
+            for row, (path, df) in zip(self.repo_analysis.itertuples(index=False), self.file_analysis.items()):
+                yield FileResult(path, row.file_dir, row.file_name, row.nloc, row.CCN, row.func_token, df)
+            return
+
+        if not os.path.exists(self.root_path) and self.cache is not None:
+            self.checkout = self.cache.checkout(self.url, self.commit or 'HEAD')
+            self.root_path = self.checkout.path
+        # The working copy is released even if the consumer stops early or an analysis fails; the results
+        # are only kept once every file was analyzed
+        try:
+            spilled = None if spill_dir is None else SpilledResults(spill_dir, batch_files)
+            self.sketch = sketch.RepoSketch()
+            for entry in self._discover_files():
+                if entry.rel_path in self.sampled_files:
+                    [result, loc] = self.sampled_files.pop(entry.rel_path)
+                else:
+                    [result, loc] = self._analyze_file(entry)
+                self.sketch.add_file(result.nloc, loc, result.CCN, result.func_token, result.functions['CCN'])
+                if spilled is not None:
+                    spilled.add(result)
+                yield result
+            if spilled is not None:
+                spilled.flush()
+                self.spilled = spilled
+        finally:
+            self._remove_working_copy()
+
+    def _discover_files(self) -> Iterator[discovery.SourceEntry]:
+        for entry in discovery.discover_files(self.root_path, self.languages):
+            # Remove __init__ files as they tend to throw off statistics
+            if entry.rel_path.rsplit('/', 1)[-1] != '__init__.py':
+                yield entry
+
+    def _analyze_file(self, entry: discovery.SourceEntry) -> tuple[FileResult, int]:
+        """
+        :return: The analysis of a single file, and its number of lines
+        """
+        file = entry.path
+        with open(file, mode='rb') as fp:
+            data = fp.read()
+        loc = data.count(b'\n') + 1
+        # The extra statistics are only available for Python
+        is_python = entry.language == 'python'
+        extra_analysis = features.FunctionStore()
+        if is_python:
+            source = data.decode('utf-8', errors='replace')
+            try:
+                features.analyze_source(source, extra_analysis, file)
+            except (SyntaxError, ValueError, RecursionError):
+                # e.g. Python 2 code or very deeply nested code, which lizard still analyzes. Rather than failing
+                # the whole repository, the extra statistics are left NULL, like those of other languages
+                extra_analysis = features.FunctionStore()
+                is_python = False
+        if entry.language == 'python' and self.engine == 'fast':
+            lizard_analysis = fast_python.analyze_source(source, file)
+        else:
+            lizard_analysis = lizard.analyze_file(file)
+        pretty_file_name = file[len(str(self.root_path)):]
+        if '\\' in pretty_file_name:
+            [file_dir, file_name] = pretty_file_name.rsplit('\\', 1)
+        else:
+            [file_dir, file_name] = pretty_file_name.rsplit('/', 1)
+        result = FileResult(
+            path=pretty_file_name,
+            file_dir=file_dir,
+            file_name=file_name,
+            nloc=lizard_analysis.nloc,
+            CCN=lizard_analysis.CCN,
+            func_token=lizard_analysis.token_count,
+            functions=function_frame(lizard_analysis, extra_analysis, is_python),
+        )
+        return result, loc
+
+    def _remove_working_copy(self):
+        if self.checkout is not None:
+            self.checkout.release()
+        elif os.path.exists(self.root_path):
+            remove_dir(self.root_path)
+
     def _perform_analysis(self):
         """The internal mechanism by which code analysis is performed"""
-        file_name_prefix_len = len(str(self.root_path))
-        # For now, it is hard-coded that only Python files are analyzed.
-        files = glob.glob(str(self.root_path / "**" / "*.py"))
-        self.file_analysis = dict()
+        file_analysis = dict()
         files_data = []
-        for file in files:
-            # Gets the name of the file without the '.py' extension
-            name = file.split('/')[-1][:-3]
-            # Remove __init__ files as they tend to throw off statistics
-            if name == '__init__':
-                continue
-            lizard_analysis = lizard.analyze_file(file)
-            extra_analysis: features.SourceFile = features.analyze_file(file)
-            extra_functions = extra_analysis.functions
-            flatten_nested_functions(extra_functions)
-            # Since several functions in different classes can have the same name,
-            # we use the start line as a secondary key.
-            extra_analysis: dict[tuple[str, int], features.Function] = {
-                (func.name, func.start_line): func
-                for func in extra_functions
-            }
-            functions = []
-            for func in lizard_analysis.function_list:
-                key = (func.name, func.start_line)
-                # A missing function has never been observed but best to keep this in just in case.
-                extra = extra_analysis.get(key, features.Function('<missing>', -1, -1, None))
-                functions.append({
-                    'name': func.name,
-                    'start_line': func.start_line,
-                    'nloc': func.nloc,
-                    'CCN': func.cyclomatic_complexity,
-                    'enclosing_class': extra.enclosing_class,
-                    'max_depth': extra.max_depth,
-                    'branches': extra.branches,
-                    'calls': extra.calls,
-                    'returns': extra.returns,
-                    'raises': extra.raises,
-                    'assertions': extra.assertions,
-                })
-
-            df = pd.DataFrame(data=functions,
-                              columns=['name', 'start_line', 'nloc', 'CCN', 'enclosing_class', 'max_depth', 'branches',
-                                       'calls', 'returns', 'raises', 'assertions'])
-            pretty_file_name = file[file_name_prefix_len:]
-            self.file_analysis[pretty_file_name] = df
-            if '\\' in pretty_file_name:
-                [file_dir, file_name] = pretty_file_name.rsplit('\\', 1)
-            else:
-                [file_dir, file_name] = pretty_file_name.rsplit('/', 1)
-            files_data.append({
-                'file_dir': file_dir,
-                'file_name': file_name,
-                'nloc': lizard_analysis.nloc,
-                'CCN': lizard_analysis.CCN,
-                'func_token': lizard_analysis.token_count,
-            })
-        self.repo_analysis = pd.DataFrame(data=files_data,
-                                          columns=['file_dir', 'file_name', 'nloc', 'CCN', 'func_token'])
-        remove_dir(self.root_path)
-
-
-def clone_repo(url: str) -> ClonedRepo:
+        for result in self.iter_files():
+            file_analysis[result.path] = result.functions
+            files_data.append(result.summary())
+        self.file_analysis = file_analysis
+        self.repo_analysis = pd.DataFrame(data=files_data, columns=SUMMARY_COLUMNS)
+
+
+def function_frame(lizard_analysis, extra_analysis: features.FunctionStore, is_python: bool) -> pd.DataFrame:
+    """Joins the functions found by lizard with the extra statistics collected by `features`
+
+    :param lizard_analysis: lizard's analysis of a single file
+    :param extra_analysis: The extra statistics of the functions in the same file
+    :param is_python: If the file is a Python file; the extra statistics are only available for Python
+    :return: A DataFrame with one row per function and the columns in `FUNCTION_COLUMNS`
     """
+    # Since several functions in different classes can have the same name,
+    # we use the start line as a secondary key.
+    extra_index = extra_analysis.index()
+    lizard_functions = lizard_analysis.function_list
+    # A missing function has never been observed but best to keep this in just in case.
+    rows = [extra_index.get((func.name, func.start_line), -1) for func in lizard_functions]
+    columns = {
+        'name': [func.name for func in lizard_functions],
+        'start_line': [func.start_line for func in lizard_functions],
+        'nloc': [func.nloc for func in lizard_functions],
+        'CCN': [func.cyclomatic_complexity for func in lizard_functions],
+    }
+    for column in EXTRA_COLUMNS:
+        values = getattr(extra_analysis, column)
+        missing = 0 if is_python and column != 'enclosing_class' else None
+        columns[column] = [values[row] if row >= 0 else missing for row in rows]
+    return pd.DataFrame(data=columns, columns=FUNCTION_COLUMNS)
+
+
+def clone_repo(url: str, cache: mirrors.MirrorCache = None) -> ClonedRepo:
+    """Checks out a repository from its mirror, which costs a fetch rather than a clone if it was
+    checked out before
+
     :param url: The URL of the repository that should be cloned
-    :return: The path to the root of the local copy of the repository
+    :param cache: The mirrors to check out of. Defaults to `mirrors.default_cache()`
+    :return: The local copy of the repository, in a directory of its own
+    :raise git.GitCommandError: if the URL is not the root of a valid git repository
     """
+    cache = cache or mirrors.default_cache()
     [user_name, repo_name] = url.rsplit('/', 2)[1:]
-    working_dir = Path(os.getcwd())
-    temp_dir = working_dir / "tmp" / f"{user_name}_{repo_name}"
     try:
-        Repo.clone_from(url, temp_dir)
-    except git.GitCommandError as err:
-        # GitCommandError can be raised for several reasons, one is that the repository already
-        # exists in the temp directory. In that case, we ignore the error, delete that part of
-        # the temp directory, and try again.
-        if 'exists' in str(err):
-            remove_dir(temp_dir)
-            Repo.clone_from(url, temp_dir)
-        else:
-            raise err
-    return ClonedRepo(temp_dir, user_name, repo_name)
+        checkout = cache.checkout(url)
+    except subprocess.CalledProcessError as err:
+        raise git.GitCommandError(err.cmd, err.returncode, err.stderr) from err
+    ret = ClonedRepo(checkout.path, user_name, repo_name)
+    ret.url = url
+    # An empty repository has no commits at all
+    ret.commit = checkout.commit
+    ret.checkout = checkout
+    ret.cache = cache
+    return ret
 
 
 def flatten_nested_functions(funcs: list[features.Function]):
@@ -1,36 +1,93 @@
-import glob
-import pandas as pd
-import lizard
+import atexit
+import itertools
 import os
-import sqlalchemy.engine
-import pymysql
-import shutil
-import yaml
-import platform
-import psutil
 import json
-from git.repo.base import Repo
 from datetime import datetime
-import joblib
 
-# from sklearn.externals import joblib
+import discovery
+import features
+import isolation
+import sketch
+import settings
+import timing
+from lazy import lazy_import
 
-with open('config.yml') as f:
-    keys = yaml.load(f, Loader=yaml.FullLoader)
+# These are only loaded once they are actually used, see `bench_imports.py`
+pd = lazy_import('pandas')
+lizard = lazy_import('lizard')
 
-pymysql.install_as_MySQLdb()
 j = 1
 my = []
 paths = None
 
+# The repositories that are queued, so that they are queued again after a restart. `QUEUE_LOG` overrides it
+QUEUE_LOG = '/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test/log.json'
+
+# The statistics that `features` adds to each function found by lizard, named as in `export.FUNCTION_COLUMNS`
+EXTRA_COLUMNS = ('enclosing_class', 'max_depth', 'branches', 'calls', 'returns', 'raises', 'assertions')
+
 # --------------------------------------------------------------------
-URL = f"mysql+mysqlconnector://{keys['Keys']['DB_USER']}:{keys['Keys']['DB_PASSWORD']}@{keys['Keys']['DB_HOST']}:3306/{keys['Keys']['DB_NAME']}"
-engine = sqlalchemy.create_engine(URL, echo=False)
+# The database engine is created on first use by `get_engine`
+engine = None
+
+
+def get_engine():
+    """
+    :return: The engine of the database that results are written to. It is created on first use
+    """
+    global engine
+    if engine is None:
+        import pymysql
+        import sqlalchemy
+        pymysql.install_as_MySQLdb()
+        keys = settings.keys()
+        # An embedded database, e.g. `sqlite:///cca.db`, can be used instead of MySQL by setting `DB_URL`
+        url = keys.get('DB_URL')
+        if not url:
+            url = (f"mysql+mysqlconnector://{keys.get('DB_USER')}:{keys.get('DB_PASSWORD')}"
+                   f"@{keys.get('DB_HOST')}:3306/{keys.get('DB_NAME')}")
+        connect_args = {}
+        if url.startswith('sqlite'):
+            # Worker processes share an embedded database, so they wait for each other's locks
+            connect_args['timeout'] = 60
+        engine = sqlalchemy.create_engine(url, echo=False, connect_args=connect_args)
+    return engine
+
+
+def pruned_dirs() -> dict:
+    """
+    :return: The arguments of `discovery.discover_files` that `PRUNED_DIRS` and `ROOT_PRUNED_DIRS` in
+        `config.yml` override, if they are set
+    """
+    keys = settings.keys()
+    ret = {}
+    if keys.get('PRUNED_DIRS') is not None:
+        ret['pruned_dirs'] = keys['PRUNED_DIRS']
+    if keys.get('ROOT_PRUNED_DIRS') is not None:
+        ret['root_pruned_dirs'] = keys['ROOT_PRUNED_DIRS']
+    return ret
+
+
+def queue_log():
+    return settings.keys().get('QUEUE_LOG') or QUEUE_LOG
+
+
+def save_queue_log():
+    # Written to a file of its own first, so that `load` never reads a half-written log
+    import tempfile
+    path = queue_log()
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path), dir=os.path.dirname(path) or '.')
+    with open(fd, 'w', encoding='utf-8') as file:
+        json.dump(my, file, indent='\t')
+    os.replace(temp_path, path)
 
 
 def load(q, langs):
     if langs == "python":
-        with open('/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test/log.json', 'r') as f:
+        if not os.path.exists(queue_log()):
+            # Nothing was ever queued
+            return
+        with open(queue_log(), 'r') as f:
             json_data = json.load(f)
             if json_data is not None:
                 for s in json_data:
@@ -46,39 +103,198 @@ def queuing(lists, q, lang):
         if s not in my:
             q.put(s)
             my.append(s)
+            timing.event('enqueued', url=s)
     print("Queue Size: " + str(q.qsize()))
     if lang == "python":
-        with open('/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test/log.json', 'w', encoding='utf-8') as file:
-            json.dump(my, file, indent="\t")
+        save_queue_log()
+
+
+def open_crawl_exporter():
+    """Opens the exporter configured by the optional `EXPORT_PATH` and `EXPORT_FORMAT` keys, so that
+    crawl results are also written to a single file for offline analysis. Returns `None` if no
+    `EXPORT_PATH` is configured."""
+    import export
+    path = settings.keys().get('EXPORT_PATH')
+    if not path:
+        return None
+    exporter = export.open_exporter(path, settings.keys().get('EXPORT_FORMAT') or 'sqlite')
+    atexit.register(exporter.close)
+    return exporter
+
+
+def open_budget_pool():
+    """Starts the worker processes that analyze files, with the per-file budgets set by the optional
+    `FILE_CPU_SECONDS`, `FILE_MEMORY_MB` and `ANALYSIS_WORKERS` keys"""
+    config = settings.keys()
+    return isolation.BudgetPool(
+        analyze_python_file,
+        workers=config.get('ANALYSIS_WORKERS'),
+        cpu_seconds=config.get('FILE_CPU_SECONDS') or isolation.CPU_SECONDS,
+        memory_mb=config.get('FILE_MEMORY_MB') or isolation.MEMORY_MB,
+    )
+
+
+def analyze_repo(url, lang, exporter, pool, function_writer, token=None):
+    """Checks out a repository from its mirror (see `mirrors.default_cache`) to a scratch directory of
+    its own, analyzes every file of it and removes the working copy again
+
+    :param function_writer: The `function_store.FunctionStoreWriter` of `exporter`, which is told
+        which repository the functions that follow belong to
+    :param token: The token of the lease of the repository's job, if a worker of the job queue is
+        analyzing it. The functions are then staged, see `function_store.FunctionStoreWriter.commit`
+    :return: The per-file DataFrame, the `sketch.RepoSketch` of the repository, the files that
+        were skipped (see `calc_complexity`), the `dedup.TreeIdentity` of what was analyzed and the
+        estimate the analysis started with, if any (see `estimate_repo`). If the repository was
+        skipped because of its estimate (see `skips`), the DataFrame and the sketch are `None`
+    """
+    import dedup
+    import function_store
+    import mirrors
+    with mirrors.default_cache().checkout(url) as checkout:
+        identity = dedup.local_identity(checkout.git_dir, checkout.commit, [lang])
+        [estimate, analyzed] = estimate_repo(str(checkout.path), lang, pool)
+        if estimate is not None and skips(estimate):
+            return None, None, [], identity, estimate
+        function_writer.begin_repo(url, function_store.first_commit_date(checkout.git_dir), lang, token)
+        repo_sketch = sketch.RepoSketch()
+        skipped = []
+        df = calc_complexity(str(checkout.path), lang, exporter, repo_sketch, pool, skipped, analyzed)
+    return df, repo_sketch, skipped, identity, estimate
+
+
+def estimate_repo(path, lang, pool=None):
+    """Estimates the statistics of the repository cloned to `path` from a random sample of its files
+    (see `sampling.estimate`), if the optional `ESTIMATE_PRECISION` key is set. Sampling stops once the
+    estimates are that precise, or after `ESTIMATE_SECONDS`.
+
+    :param pool: The `isolation.BudgetPool` that analyzes the files, see `calc_complexity`
+    :return: The estimate, or `None` if repositories aren't estimated, and the results of the files
+        that were sampled by their path, which `calc_complexity` doesn't need to analyze again
+    """
+    import sampling
+    keys = settings.keys()
+    if not keys.get('ESTIMATE_PRECISION') or lang != "python":
+        return None, {}
+    analyzed = {}
+
+    def analyze_batch(entries):
+        paths = [entry.path for entry in entries]
+        # The files of a batch are analyzed in parallel, like those of `calc_complexity`
+        if pool is not None:
+            outcomes = {outcome.item: outcome for outcome in pool.map(paths)}
+        else:
+            outcomes = {i: isolation.Outcome(i, result=analyze_python_file(i)) for i in paths}
+        ret = []
+        for i in paths:
+            if outcomes[i].skipped is not None:
+                ret.append(None)
+                continue
+            analyzed[i] = outcomes[i].result
+            [nloc, loc, CCN, func_token, _] = outcomes[i].result
+            ret.append({'nloc': nloc, 'loc': loc, 'CCN': CCN, 'func_token': func_token})
+        return ret
+    batch_files = max(len(pool.workers), sampling.CHECK_EVERY) if pool is not None else sampling.CHECK_EVERY
+    estimate = sampling.estimate(source_files(path, lang), None, keys['ESTIMATE_PRECISION'],
+                                 keys.get('ESTIMATE_SECONDS'), analyze_batch=analyze_batch, batch_files=batch_files)
+    return estimate, analyzed
+
+
+def skips(estimate):
+    """
+    :return: If a repository isn't analyzed in full after it was estimated, because the optional
+        `ESTIMATE_MIN_AVG_CCN` key is set and its average CCN is below that even at the upper end of
+        the confidence interval
+    """
+    min_avg_ccn = settings.keys().get('ESTIMATE_MIN_AVG_CCN')
+    return min_avg_ccn is not None and estimate.sampled > 0 and estimate.means['CCN'].high < min_avg_ccn
+
+
+def send_estimate(estimate, path, analyzed, con):
+    """Records the estimate of a repository (see `estimate_repo`) in the `Repo_estimates` table, in
+    place of any earlier one
+
+    :param analyzed: If the repository was analyzed in full after it was estimated
+    :param con: The connection of the transaction to write in
+    """
+    import results
+    table = results.repo_estimates
+    con.execute(table.delete().where(table.c.URL == path))
+    con.execute(table.insert().values(Time=datetime.now().replace(microsecond=0), URL=path,
+                                      Confidence=estimate.confidence, Reason=estimate.reason, Analyzed=analyzed,
+                                      **estimate.summary()))
+
 
+def reuse_duplicate(duplicate, url, lang, con):
+    """Writes the stored results of a repository with the same code as the repository at `url`, in
+    place of analyzing it, see `dedup.find_duplicate`
 
-def goes_through(q):
+    :param con: The connection of the transaction to write in
+    """
+    import dedup
+    if duplicate.source_url != url:
+        remove_results(url, con)
+    dedup.reuse(con, duplicate, url, lang)
+
+
+def goes_through(q, exporter=None):
+    import dedup
+    import export
+    import function_store
+    import results
+    pool = open_budget_pool()
+    function_writer = function_store.FunctionStoreWriter(get_engine())
+    dedup.create_schema(get_engine())
+    results.create_schema(get_engine())
+    exporter = export.combine(exporter, function_writer)
     while True:
         url = q.get()
         if url is not None:
-            os.chdir("/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test")
+            timing.event('dequeued', url=url)
             user_name = url.rsplit('/', 2)[1]
             repo_name = url.rsplit('/', 1)[-1]
-            temp_location = f"/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test/{user_name}/{repo_name}"
-            mother_direcotry = f"/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test/{user_name}"
-            Repo.clone_from(url, temp_location)
-            df = calc_complexity(temp_location, language)
-            if not df.empty:
-                if language == "python":
-                    make_df(df)
-                    get_average(df, url, q)
-                    #send(df)
-                    my.remove(url)
-                    with open('/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test/log.json', 'w', encoding='utf-8') as file:
-                        json.dump(my, file, indent='\t')
-                    shutil.rmtree(mother_direcotry)
-            else:
-                print("no python files found in the repository")
+            with timing.stage('dedup', url=url):
+                duplicate = dedup.find_duplicate(get_engine(), url, language)
+            if duplicate is not None:
+                with get_engine().begin() as con:
+                    reuse_duplicate(duplicate, url, language, con)
+                print(f"{user_name}/{repo_name} has the same code as {duplicate.source_url}, its results were reused")
+                my.remove(url)
+                save_queue_log()
+                timing.event('done', url=url)
+                continue
+            with timing.stage('analyze', url=url):
+                df, repo_sketch, skipped, identity, estimate = analyze_repo(url, language, exporter, pool,
+                                                                            function_writer)
+            if df is None:
+                with get_engine().begin() as con:
+                    send_estimate(estimate, url, False, con)
+                print(f"{user_name}/{repo_name} was skipped, its estimated Avg_CCN is "
+                      f"{estimate.means['CCN'].estimate:.2f}")
                 my.remove(url)
-                with open('/Users/yoonjaelee/PycharmProjects/Cyclomatic-Complexity-Analyzer/test/log.json', 'w',
-                          encoding='utf-8') as file:
-                    json.dump(my, file, indent='\t')
-                shutil.rmtree(mother_direcotry)
+                save_queue_log()
+                timing.event('done', url=url)
+                continue
+            with timing.stage('store', url=url):
+                with get_engine().begin() as con:
+                    if estimate is not None:
+                        send_estimate(estimate, url, True, con)
+                    dedup.record(con, url, language, identity)
+                if skipped:
+                    send_skipped(skipped, url)
+                if not df.empty:
+                    exporter.write_summary(df.drop(columns="Repo_name"), f"{user_name}/{repo_name}")
+                    exporter.flush()
+                    if language == "python":
+                        make_df(df)
+                        get_average(df, url, q, repo_sketch)
+                        #send(df)
+                        my.remove(url)
+                        save_queue_log()
+                else:
+                    print("no python files found in the repository")
+                    my.remove(url)
+                    save_queue_log()
+            timing.event('done', url=url)
 
 
 
@@ -93,43 +309,117 @@ def make_df(df):
     df3.loc[len(df)] = [nloc, loc, CCN, func_token]
 
 
-def calc_complexity(url, lang):
+def analyze_python_file(path):
+    """Analyzes a single Python file. This runs inside the worker processes of the budget pool, so
+    everything it returns is plain data.
+
+    :return: The file's nloc, loc, CCN and token count, and (name, start line, nloc, CCN, *`EXTRA_COLUMNS`)
+        for each of its functions
+    """
+    with open(path, "r", encoding='ISO-8859-1', errors='ignore') as f:
+        p = f.read()
+    mlb = lizard.analyze_file(path)
+    extra = features.FunctionStore()
+    try:
+        features.analyze_source(p, extra, path)
+        # Like `analysis_api.function_frame`, a function that lizard found but `features` didn't has zero counts
+        missing = (None,) + (0,) * (len(EXTRA_COLUMNS) - 1)
+    except (SyntaxError, ValueError, RecursionError):
+        # e.g. Python 2 code, which lizard still analyzes, but whose extra statistics are unknown
+        missing = (None,) * len(EXTRA_COLUMNS)
+    extra_index = extra.index()
+    extra_columns = [getattr(extra, column) for column in EXTRA_COLUMNS]
+    functions = []
+    for func in mlb.function_list:
+        row = extra_index.get((func.name, func.start_line), -1)
+        functions.append((func.name, func.start_line, func.nloc, func.cyclomatic_complexity,
+                          *(tuple(values[row] for values in extra_columns) if row >= 0 else missing)))
+    return mlb.nloc, len(p.split('\n')), mlb.CCN, mlb.token_count, functions
+
+
+def source_files(path, lang):
+    """
+    :return: The files of the repository cloned to `path` that are analyzed, see `discovery.discover_files`
+    """
+    # Remove __init__ files as they tend to throw off statistics
+    return [entry for entry in discovery.discover_files(path, [lang], **pruned_dirs())
+            if entry.rel_path.rsplit('/', 1)[-1] != "__init__.py"]
+
+
+def calc_complexity(url, lang, exporter=None, repo_sketch=None, pool=None, skipped=None, analyzed=None):
+    """Analyzes every file of the repository cloned to `url`.
+
+    :param pool: The `isolation.BudgetPool` that analyzes the files. Without one, files are analyzed
+        in this process, without any budget
+    :param skipped: A list that (file path, reason) is appended to for every file that went over its budget
+    :param analyzed: The results of files that were already analyzed, by path (see `estimate_repo`)
+    """
     user_name = url.rsplit('/', 3)[1]
     repo_name = url.rsplit('/', 2)[1]
     full_name = f"{user_name}/{repo_name}"
-    if lang == "python":
-        path = url + "**/*.py"
-    files = glob.glob(path, recursive=True)
     if lang == "python":
         df = pd.DataFrame(
             columns=["Repo_name", "file_dir", "file_name", "nloc", "loc", "CCN", "func_token"])
-        if len(files) != 0:
-            for i in files:
-                code_name = i.split("/")
-                name = code_name[len(code_name) - 1]
-                if name != "__init__.py":
-                    name = name.replace(".py", "")
-                    f = open(i, "r", encoding='ISO-8859-1', errors='ignore')
-                    mlb = lizard.analyze_file(i)
-                    p = f.read()
-                    dir_name = i.replace(os.getcwd(), '')  # split('/')[-1]
-                    nloc = mlb.nloc
-                    loc = len(p.split('\n'))
-                    CCN = mlb.CCN
-                    func_token = mlb.token_count
-                    parsed_file = ""
-                    df.update(df, overwrite=True)
-                    df.loc[len(df)] = [full_name, i, name, nloc, loc, CCN, func_token]
+        analyzed = analyzed or {}
+        paths = [entry.path for entry in source_files(url, lang) if entry.path not in analyzed]
+        if pool is not None:
+            outcomes = pool.map(paths)
+        else:
+            outcomes = (isolation.Outcome(i, result=analyze_python_file(i)) for i in paths)
+        outcomes = itertools.chain((isolation.Outcome(i, result=result) for i, result in analyzed.items()), outcomes)
+        for outcome in outcomes:
+            i = outcome.item
+            if outcome.skipped is not None:
+                print(f"Skipped {i}: {outcome.skipped}")
+                if skipped is not None:
+                    skipped.append((i, outcome.skipped))
+                continue
+            name = i.split("/")[-1].replace(".py", "")
+            [nloc, loc, CCN, func_token, functions] = outcome.result
+            df.loc[len(df)] = [full_name, i, name, nloc, loc, CCN, func_token]
+            if repo_sketch is not None:
+                repo_sketch.add_file(nloc, loc, CCN, func_token, (func[3] for func in functions))
+            if exporter is not None:
+                functions = pd.DataFrame(data=functions, columns=["name", "start_line", "nloc", "CCN", *EXTRA_COLUMNS])
+                exporter.write_functions(functions, full_name, os.path.relpath(i, url))
     return df
 
 
 def send(dataframe):
-    dataframe.to_sql(name="initial", con=engine, if_exists='append', index=False)
+    dataframe.to_sql(name="initial", con=get_engine(), if_exists='append', index=False)
+
+
+def sketch_from_frame(dataframe):
+    """Builds the file-level part of a sketch from an already computed per-file DataFrame"""
+    ret = sketch.RepoSketch()
+    for nloc, loc, ccn, func_token in dataframe[["nloc", "loc", "CCN", "func_token"]].itertuples(index=False):
+        ret.add_file(nloc, loc, ccn, func_token)
+    return ret
 
 
-def get_average(dataframe, path, q):
+def send_skipped(skipped, path, con=None):
+    """Records the files of a repository that were skipped, and why
+
+    :param con: The connection to write with, e.g. to write as part of a transaction. Defaults to the engine
+    """
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    df = pd.DataFrame(data=[[timestamp, path, file, reason] for file, reason in skipped],
+                      columns=["Time", "URL", "File", "Reason"])
+    df.to_sql(name='Skipped_files', con=con or get_engine(), if_exists='append', index=False)
+
+
+def get_average(dataframe, path, q, repo_sketch=None, con=None):
+    """Writes the summary of a single repository to the `Repos` table, and its CCN distributions
+    to the `Repo_sketches` table. The summary is computed from `repo_sketch`, which was updated as
+    the files were analyzed; if it is missing, it is rebuilt from the per-file `dataframe`.
+
+    :param q: The queue of repositories whose size is reported, if any
+    :param con: The connection to write with, e.g. to write as part of a transaction. Defaults to the engine
+    """
     user_name = path.rsplit('/', 2)[1]
     repo_name = path.rsplit('/', 1)[-1]
+    if repo_sketch is None:
+        repo_sketch = sketch_from_frame(dataframe)
     df2 = pd.DataFrame(
         columns=["Time", "URL", "User_name", "Repo_name", "Total_File_Num", "Avg_nloc",
                  "Total_LOC",
@@ -137,19 +427,63 @@ def get_average(dataframe, path, q):
                  "Max_CCN",
                  "Avg_func_token"]
     )
-    avg_nloc = round(dataframe['nloc'].mean(), 2)
-    total_loc = dataframe['loc'].sum()
-    avg_ccn = round(dataframe['CCN'].mean(), 2)
-    max_ccn = dataframe['CCN'].max()
-    avg_token = round(dataframe['func_token'].mean(), 2)
-    row_num = dataframe.shape[0]
+    files = repo_sketch.files
+    avg_nloc = round(files['nloc'].mean, 2)
+    total_loc = files['loc'].total
+    avg_ccn = round(files['CCN'].mean, 2)
+    max_ccn = files['CCN'].max
+    avg_token = round(files['func_token'].mean, 2)
+    row_num = repo_sketch.file_count
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     df2.loc[len(df2)] = [timestamp, path, user_name, repo_name, row_num, avg_nloc, total_loc, avg_ccn,
                          max_ccn,
                          avg_token]
+    queue_size = f"..... Updated Queue Size : {str(q.qsize())}" if q is not None else ""
     if total_loc != 0:
-        df2.to_sql(name='Repos', con=engine, if_exists='append', index=False)
-        print(f"{user_name}/{repo_name} has been added to DB...... Updated Queue Size : {str(q.qsize())} ")
+        df2.to_sql(name='Repos', con=con or get_engine(), if_exists='append', index=False)
+        send_sketch(repo_sketch, path, timestamp, con)
+        print(f"{user_name}/{repo_name} has been added to DB.{queue_size} ")
     else:
-        print(f"Cannot fetch any files from {user_name}/{repo_name}..... Updated Queue Size : {str(q.qsize())}")
+        print(f"Cannot fetch any files from {user_name}/{repo_name}{queue_size}")
+
+
+def send_sketch(repo_sketch, path, timestamp, con=None):
+    """Persists the CCN distributions of a repository next to its `Repos` row, so that they can be
+    merged across repositories later without re-reading any per-file rows"""
+    file_ccn = repo_sketch.files['CCN']
+    func_ccn = repo_sketch.functions
+    df = pd.DataFrame(
+        data=[[timestamp, path, file_ccn.count, func_ccn.count,
+               file_ccn.quantile(0.5), file_ccn.quantile(0.9), file_ccn.quantile(0.99),
+               func_ccn.quantile(0.5), func_ccn.quantile(0.9), func_ccn.quantile(0.99),
+               repo_sketch.to_json()]],
+        columns=["Time", "URL", "Total_File_Num", "Total_Func_Num",
+                 "P50_CCN", "P90_CCN", "P99_CCN",
+                 "P50_func_CCN", "P90_func_CCN", "P99_func_CCN",
+                 "Sketch"]
+    )
+    df.to_sql(name='Repo_sketches', con=con or get_engine(), if_exists='append', index=False)
+
+
+def remove_results(path, con):
+    """Deletes whatever an earlier analysis of a repository wrote to the `Repos`, `Repo_sketches` and
+    `Skipped_files` tables, so that writing its results again doesn't duplicate them
+
+    :param con: The connection of the transaction that writes the new results
+    """
+    import results
+    for table in (results.repos, results.repo_sketches, results.skipped_files):
+        con.execute(table.delete().where(table.c.URL == path))
+
+
+def fleet_sketch(urls=None):
+    """Merges the stored sketches of every repository (or only of the repositories in `urls`).
+    Fleet-wide percentiles can then be read off the result, e.g.
+    `fleet_sketch().functions.quantile(0.99)`."""
+    sketches = pd.read_sql('SELECT URL, Sketch FROM Repo_sketches ORDER BY Time', con=get_engine())
+    if urls is not None:
+        sketches = sketches[sketches.URL.isin(list(urls))]
+    # A repository that was analyzed several times only counts once, with its latest sketch
+    sketches = sketches.drop_duplicates(subset="URL", keep="last")
+    return sketch.merge_all(sketch.RepoSketch.from_json(text) for text in sketches.Sketch)
@@ -0,0 +1,68 @@
+"""Measures how long it takes to import each entry point, and checks it against its budget.
+
+Usage: python bench_imports.py [runs]
+
+Every run imports the entry point in a fresh interpreter with `-X importtime`, and the median of the
+cumulative import times is compared to the budget. The heaviest imports are listed for entry points
+that go over their budget. Exits with status 1 if any entry point is over budget or fails to import.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+# Entry point name -> (module, budget in milliseconds)
+BUDGETS = {
+    'cli': ('cli', 20),
+    'gui': ('gui', 150),
+    'analyze': ('analyze', 100),
+    'worker': ('worker', 100),
+    'scraper': ('scraper', 250),
+    'service': ('service', 150),
+}
+# The number of heaviest imports listed for an entry point over budget
+TOP_IMPORTS = 10
+
+
+def measure(module: str) -> dict[str, int]:
+    """
+    :return: The cumulative import time in microseconds of every module imported by `module`
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        [_, cumulative, name] = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    over_budget = False
+    for entry_point, (module, budget) in BUDGETS.items():
+        try:
+            samples = [measure(module) for _ in range(runs)]
+        except RuntimeError as err:
+            # An entry point that can't be imported is as broken as one that is too slow
+            print(f"{entry_point:>8}: FAILED, {err}")
+            over_budget = True
+            continue
+        median = statistics.median(sample[module] for sample in samples) / 1000
+        ok = median <= budget
+        over_budget |= not ok
+        print(f"{entry_point:>8}: {median:7.1f} ms (budget {budget} ms) {'ok' if ok else 'OVER BUDGET'}")
+        if not ok:
+            heaviest = sorted(samples[-1].items(), key=lambda x: x[1], reverse=True)
+            for name, cumulative in heaviest[1:TOP_IMPORTS + 1]:
+                print(f"{'':>10}{cumulative / 1000:7.1f} ms  {name}")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
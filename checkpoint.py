@@ -0,0 +1,152 @@
+"""Keeps track of how far every crawl got, so that a crawl that was interrupted resumes where it stopped.
+
+A crawl searches one date slice after the other, page by page. After every page, the crawl's place is
+saved to a JSON file, which is replaced atomically, so it is never left half-written by a crash. When a
+crawl finishes, its place is removed and the time it started is recorded as its last successful
+crawl. Later crawls with the same search can then be limited to repositories pushed since then.
+
+Only one crawl of a search runs at a time: while it runs, it holds a lock file next to the checkpoint
+(see `Checkpoint.claim`), so that two crawls never overwrite each other's place. Crawls of different
+searches share the checkpoint file, so every update of it holds another lock file (see
+`Checkpoint._locked`), so that one crawl's update doesn't replace the file with a copy that lacks another's.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Without `fcntl` (i.e. on Windows), only crawls in the same process are kept from running at once
+    fcntl = None
+
+# Where crawls are tracked, relative to the working directory. `CRAWL_CHECKPOINT` overrides it
+CHECKPOINT_PATH = 'crawl_checkpoint.json'
+
+
+def utc_now() -> str:
+    """
+    :return: The current time, in the format GitHub's search qualifiers take
+    """
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+@dataclass()
+class CrawlState:
+    """Where a crawl is"""
+    # The search, e.g. `python/100/10/5` for a language, minimum stars and forks, and number of years
+    query: str
+    # The date ranges that are searched one after the other, e.g. `2021-01-01..2021-12-31`
+    slices: list[str]
+    started_at: str = field(default_factory=utc_now)
+    # Only repositories pushed at or after this time are searched for, if it is set
+    since: Optional[str] = None
+    # The index of the date range that is being searched, and the next page of its results
+    slice: int = 0
+    page: int = 1
+    # When the last repository of the last page that was crawled was updated
+    last_seen: Optional[str] = None
+    # When the state was last saved
+    saved_at: Optional[str] = None
+
+
+class CrawlInProgress(Exception):
+    """Another crawl of the same search is running"""
+
+
+class Checkpoint:
+    """The state of every crawl that hasn't finished, and when every search last finished, in a JSON file"""
+    def __init__(self, path: str = CHECKPOINT_PATH):
+        self.path = path
+        # Crawls run in the threads of the scraper app
+        self.lock = threading.Lock()
+        # The searches that are being crawled by this process
+        self.running: set[str] = set()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Keeps the checkpoint file from being updated by any other thread or process while the body of the
+        `with` statement runs, which reads it, changes it and replaces it"""
+        with self.lock, open(f"{self.path}.lock", 'a') as fp:
+            if fcntl is not None:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+            # Closing the file releases the lock
+            yield
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'crawls': {}, 'last_success': {}}
+
+    def _save(self, data: dict):
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path),
+                                         dir=os.path.dirname(self.path) or '.')
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent='\t')
+        os.replace(temp_path, self.path)
+
+    def resume(self, query: str) -> Optional[CrawlState]:
+        """
+        :return: Where the crawl of `query` stopped, or `None` if there is no unfinished crawl of it
+        """
+        with self.lock:
+            state = self._load()['crawls'].get(query)
+        return None if state is None else CrawlState(**state)
+
+    @contextmanager
+    def claim(self, query: str) -> Iterator[None]:
+        """Keeps any other crawl of `query` from running while the body of the `with` statement runs, in
+        this process or in any other that uses the same checkpoint file. The lock file is left behind,
+        since removing it while another process is about to lock it would let two crawls in.
+
+        :raise CrawlInProgress: if another crawl of `query` is running
+        """
+        with self.lock:
+            if query in self.running:
+                raise CrawlInProgress(query)
+            self.running.add(query)
+        try:
+            query_hash = hashlib.sha256(query.encode()).hexdigest()[:16]
+            with open(f"{self.path}.{query_hash}.lock", 'a') as fp:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        raise CrawlInProgress(query) from None
+                # Closing the file releases the lock
+                yield
+        finally:
+            with self.lock:
+                self.running.discard(query)
+
+    def save(self, state: CrawlState):
+        with self._locked():
+            data = self._load()
+            state.saved_at = utc_now()
+            data['crawls'][state.query] = asdict(state)
+            self._save(data)
+
+    def finish(self, state: CrawlState):
+        """Forgets a crawl that finished, and records when it started as the last successful crawl of its query"""
+        with self._locked():
+            data = self._load()
+            data['crawls'].pop(state.query, None)
+            data['last_success'][state.query] = state.started_at
+            self._save(data)
+
+    def last_success(self, query: str) -> Optional[str]:
+        """
+        :return: When the last crawl of `query` that finished started, if any did
+        """
+        with self.lock:
+            return self._load()['last_success'].get(query)
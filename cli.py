@@ -1,6 +1,10 @@
-import lizard
 import sys
 
+from lazy import lazy_import
+
+# Only loaded once it is actually used, see `bench_imports.py`
+lizard = lazy_import('lizard')
+
 
 def format_analysis(info):
     program_header = f"{info.filename} ({info.nloc} lines of code)"
@@ -0,0 +1,98 @@
+"""Checks that `fast_python` gives the same results as lizard on a corpus of Python files.
+
+Usage: python conformance.py [directory ...]
+
+Every Python file under the directories (the standard library by default) is analyzed by both
+engines. The share of files and functions on which the engines agree is reported for each metric,
+together with the time each engine took, and the files with the most disagreements are listed.
+Exits with status 1 if the engines agree on fewer than `MIN_AGREEMENT` of the functions' CCN.
+"""
+import os
+import sys
+import sysconfig
+import time
+from collections import Counter
+
+import discovery
+import fast_python
+
+# The share of functions whose CCN must match
+MIN_AGREEMENT = 0.99
+# The number of files with the most disagreements that are listed
+TOP_FILES = 10
+
+
+def compare(path: str, stats: Counter, timings: Counter) -> int:
+    """Analyzes a single file with both engines, and counts the agreements in `stats`
+
+    :return: The number of metrics the engines disagree on
+    """
+    import lizard
+    with open(path, mode='r', encoding='utf-8', errors='replace') as fp:
+        source = fp.read()
+    start = time.perf_counter()
+    try:
+        fast = fast_python.analyze_source(source, path)
+    except (SyntaxError, ValueError):
+        stats['invalid files'] += 1
+        return 0
+    timings['fast_python'] += time.perf_counter() - start
+    start = time.perf_counter()
+    expected = lizard.analyze_file.analyze_source_code(path, source)
+    timings['lizard'] += time.perf_counter() - start
+
+    disagreements = 0
+    stats['files'] += 1
+    for metric in ('nloc', 'token_count', 'CCN'):
+        same = getattr(fast, metric) == getattr(expected, metric)
+        stats[f"file {metric}"] += same
+        disagreements += not same
+
+    functions = {(func.name, func.start_line): func for func in fast.function_list}
+    stats['functions'] += len(expected.function_list)
+    stats['extra functions'] += len(functions) - len(expected.function_list)
+    for func in expected.function_list:
+        match = functions.get((func.name, func.start_line))
+        if match is None:
+            stats['missing functions'] += 1
+            disagreements += 1
+            continue
+        for metric in ('nloc', 'token_count', 'cyclomatic_complexity'):
+            same = getattr(match, metric) == getattr(func, metric)
+            stats[f"function {metric}"] += same
+            disagreements += not same
+    return disagreements
+
+
+def main():
+    roots = sys.argv[1:] or [sysconfig.get_paths()['stdlib']]
+    stats = Counter()
+    timings = Counter()
+    worst = []
+    for root in roots:
+        for entry in discovery.discover_files(root, ['python']):
+            disagreements = compare(entry.path, stats, timings)
+            if disagreements:
+                worst.append((disagreements, entry.path))
+
+    files = stats['files'] or 1
+    functions = stats['functions'] or 1
+    print(f"{stats['files']} files ({stats['invalid files']} invalid ones skipped), {stats['functions']} functions")
+    for metric in ('nloc', 'token_count', 'CCN'):
+        print(f"{'file ' + metric:>28}: {stats['file ' + metric] / files:8.2%}")
+    print(f"{'functions found':>28}: {1 - stats['missing functions'] / functions:8.2%}"
+          f" ({stats['extra functions']} more than lizard)")
+    for metric in ('nloc', 'token_count', 'cyclomatic_complexity'):
+        print(f"{'function ' + metric:>28}: {stats['function ' + metric] / functions:8.2%}")
+    for engine, seconds in timings.items():
+        print(f"{engine:>28}: {seconds:8.2f} s")
+    if worst:
+        print('Most disagreements:')
+        for disagreements, path in sorted(worst, reverse=True)[:TOP_FILES]:
+            print(f"{disagreements:8d}  {os.path.relpath(path)}")
+    agreement = stats['function cyclomatic_complexity'] / functions
+    sys.exit(0 if agreement >= MIN_AGREEMENT else 1)
+
+
+if __name__ == '__main__':
+    main()
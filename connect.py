@@ -5,6 +5,7 @@ from flask import request
 import json
 import queue
 import analyze
+import settings
 
 app = Flask(__name__)
 
@@ -13,18 +14,24 @@ q = queue.Queue()
 
 @app.route("/repos", methods=['GET', 'POST'])
 def connect_python():
-    analyze.load(q, "python")  #
     content = request.json
     contents = json.loads(content)
+    if settings.keys().get('JOB_QUEUE'):
+        # Analyzed by `worker.py` processes, which can run on other hosts
+        import worker
+        worker.enqueue(contents, "python")
+        return ""
+    analyze.load(q, "python")  #
     analyze.queuing(contents, q, "python")
 
     return ""
 
 
 if __name__ == "__main__":
-    t = threading.Thread(target=analyze.goes_through, args=(q,))
-    t.daemon = True
-    t.start()
+    if not settings.keys().get('JOB_QUEUE'):
+        t = threading.Thread(target=analyze.goes_through, args=(q, analyze.open_crawl_exporter()))
+        t.daemon = True
+        t.start()
 
     app.run(host="127.0.0.1",
             port=5000,
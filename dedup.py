@@ -0,0 +1,219 @@
+"""Skips cloning and analyzing repositories whose code is identical to a repository that was already analyzed.
+
+Forks and copies of popular repositories often have exactly the same files. Before a repository is
+cloned, its identity is looked up as cheaply as possible:
+
+1. The commit its HEAD points to, with a `git ls-remote`. Forks that haven't diverged share it.
+2. For GitHub repositories, a digest of the files that would be analyzed, from a single request to the
+   git trees API. A blob's SHA is a hash of its contents, so the digest only matches if every one of
+   those files is byte-identical, even if the history differs.
+
+If either matches a repository that was analyzed, its stored results are copied instead. The identity
+of every repository that is analyzed is recorded in the `Repo_trees` table.
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table
+
+import discovery
+import function_store
+import history
+import mirrors
+import settings
+from lazy import lazy_import
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
+
+# The GitHub API that trees are listed with. `GITHUB_API_URL` overrides it, e.g. with a stub
+API_URL = 'https://api.github.com'
+# How long to wait for the GitHub API, in seconds
+API_TIMEOUT = 30
+_GITHUB_URL = re.compile(r'^https?://github\.com/([^/]+)/([^/]+?)(?:\.git)?/?$')
+
+metadata = MetaData()
+
+# The identity of every analyzed repository. `Source_URL` is set for repositories whose results were
+# copied from another repository instead of being analyzed.
+repo_trees = Table(
+    'Repo_trees', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('URL', String(255), nullable=False),
+    Column('Language', String(32)),
+    Column('Commit_sha', String(40)),
+    Column('Tree_digest', String(64)),
+    Column('Source_URL', String(255)),
+    Column('Recorded_at', DateTime),
+    Index('Repo_trees_URL', 'URL'),
+    Index('Repo_trees_commit', 'Commit_sha'),
+    Index('Repo_trees_tree', 'Tree_digest'),
+)
+
+
+def create_schema(engine: sqlalchemy.engine.Engine):
+    """Creates the `Repo_trees` table and its indexes, unless they already exist"""
+    try:
+        metadata.create_all(engine, checkfirst=True)
+    except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.ProgrammingError):
+        # Another worker process created them in the meantime
+        metadata.create_all(engine, checkfirst=True)
+
+
+@dataclass()
+class TreeIdentity:
+    """What the results of analyzing a repository depend on. Either can be `None` if it is unknown."""
+    commit: Optional[str] = None
+    tree: Optional[str] = None
+
+
+@dataclass()
+class Duplicate:
+    """A repository that was already analyzed, and has the same code as a repository that wasn't"""
+    source_url: str
+    identity: TreeIdentity
+
+
+def tree_digest(entries: Iterable[tuple[str, str]], languages: Optional[Iterable[str]]) -> str:
+    """
+    :param entries: (path, blob SHA) of every file in a tree
+    :param languages: The languages that are analyzed, as lizard names them. `None` for every supported language
+    :return: A digest of the files that analyzing the tree depends on: the source files of `languages`,
+        and the `.gitignore` files that decide which of them are skipped
+    """
+    languages = None if languages is None else set(languages)
+    digest = hashlib.sha256()
+    for path, sha in sorted(entries):
+        name = path.rsplit('/', 1)[-1]
+        if name != '.gitignore':
+            language = discovery.language_of(name)
+            if language is None or (languages is not None and language not in languages):
+                continue
+        digest.update(f"{path}\0{sha}\n".encode('utf-8', errors='surrogateescape'))
+    return digest.hexdigest()
+
+
+def local_identity(git_dir: Union[str, Path], commit: Optional[str],
+                   languages: Optional[Iterable[str]]) -> TreeIdentity:
+    """
+    :return: The identity of a commit of a repository that is available locally, e.g. a mirror
+    """
+    if commit is None:
+        return TreeIdentity()
+    entries = [(path, sha) for path, sha, _ in history.list_tree(git_dir, commit)]
+    return TreeIdentity(commit=commit, tree=tree_digest(entries, languages))
+
+
+def github_tree(url: str, commit: str, languages: Optional[Iterable[str]]) -> Optional[str]:
+    """
+    :return: The tree digest (see `tree_digest`) of a commit of a GitHub repository, from the git trees API.
+        `None` if `url` isn't a GitHub repository, or if the tree can't be listed in a single request
+    """
+    match = _GITHUB_URL.match(url)
+    if match is None:
+        return None
+    [owner, repo] = match.groups()
+    keys = settings.keys()
+    auth = (keys['GITHUB_USER'], keys['GITHUB_TOKEN']) if keys.get('GITHUB_TOKEN') else None
+    api_url = keys.get('GITHUB_API_URL') or API_URL
+    try:
+        response = requests.get(f"{api_url}/repos/{owner}/{repo}/git/trees/{commit}", params={'recursive': '1'},
+                                auth=auth, timeout=API_TIMEOUT)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    if data.get('truncated'):
+        # Very large trees are only listed in part
+        return None
+    return tree_digest(((entry['path'], entry['sha']) for entry in data['tree'] if entry['type'] == 'blob'),
+                       languages)
+
+
+def _analyzed(conn: sqlalchemy.engine.Connection, column: Column, value: str, language: str) -> Optional[str]:
+    """
+    :return: The URL of a repository that was analyzed (rather than copied) with `value` in `column`
+    """
+    query = (sqlalchemy.select(repo_trees.c.URL)
+             .where(column == value, repo_trees.c.Language == language, repo_trees.c.Source_URL.is_(None))
+             .order_by(repo_trees.c.id.desc()).limit(1))
+    return conn.execute(query).scalar()
+
+
+def find_duplicate(engine: sqlalchemy.engine.Engine, url: str, language: str) -> Optional[Duplicate]:
+    """Looks for an analyzed repository with the same code as the repository at `url`, without cloning it.
+    The GitHub API is only asked if the commit doesn't match.
+
+    :return: The matching repository, which can be `url` itself if it didn't change since it was last
+        analyzed, or `None`
+    """
+    try:
+        commit = mirrors.resolve_head(url)
+    except ValueError:
+        # Whatever is wrong with the repository, cloning it will tell
+        return None
+    with engine.connect() as conn:
+        source = _analyzed(conn, repo_trees.c.Commit_sha, commit, language)
+    if source is not None:
+        return Duplicate(source, TreeIdentity(commit=commit))
+    tree = github_tree(url, commit, [language])
+    if tree is None:
+        return None
+    with engine.connect() as conn:
+        source = _analyzed(conn, repo_trees.c.Tree_digest, tree, language)
+    if source is not None:
+        return Duplicate(source, TreeIdentity(commit=commit, tree=tree))
+    return None
+
+
+def record(conn: sqlalchemy.engine.Connection, url: str, language: str, identity: TreeIdentity,
+           source_url: str = None):
+    """Records the identity of a repository whose results were just written, replacing any earlier record
+
+    :param source_url: The repository its results were copied from, if they were
+    """
+    conn.execute(repo_trees.delete().where(repo_trees.c.URL == url, repo_trees.c.Language == language))
+    conn.execute(repo_trees.insert().values(URL=url, Language=language, Commit_sha=identity.commit,
+                                            Tree_digest=identity.tree, Source_URL=source_url,
+                                            Recorded_at=datetime.now().replace(microsecond=0)))
+
+
+def reuse(conn: sqlalchemy.engine.Connection, duplicate: Duplicate, url: str, language: str):
+    """Copies the stored results of `duplicate` to the repository at `url`, in place of analyzing it.
+    The results of an earlier analysis of `url` must have been removed, see `analyze.remove_results`."""
+    if duplicate.source_url == url:
+        # Nothing changed since it was analyzed
+        return
+    user_name = url.rsplit('/', 2)[1]
+    repo_name = url.rsplit('/', 1)[-1]
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    existing = sqlalchemy.inspect(conn)
+    for table, columns in (('Repos', {'User_name': user_name, 'Repo_name': repo_name}), ('Repo_sketches', {}),
+                           ('Skipped_files', {})):
+        if not existing.has_table(table):
+            continue
+        df = pd.read_sql(sqlalchemy.text(f"SELECT * FROM {table} WHERE URL = :url"), con=conn,
+                         params={'url': duplicate.source_url})
+        if df.empty:
+            continue
+        # Only the latest results, in case the source was analyzed several times
+        df = df[df.Time == df.Time.max()].assign(URL=url, Time=timestamp, **columns)
+        df.to_sql(name=table, con=conn, if_exists='append', index=False)
+
+    functions = function_store.functions
+    copied = [column for column in functions.c if column.name not in ('id', 'URL')]
+    conn.execute(functions.delete().where(functions.c.URL == url))
+    conn.execute(functions.insert().from_select(
+        ['URL'] + [column.name for column in copied],
+        sqlalchemy.select(sqlalchemy.literal(url), *copied).where(functions.c.URL == duplicate.source_url),
+    ))
+    record(conn, url, language, duplicate.identity, duplicate.source_url)
@@ -0,0 +1,278 @@
+import fnmatch
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+# Directories that are never descended into, wherever they are: version control metadata,
+# virtualenvs, package caches and installed dependencies
+PRUNED_DIRS = frozenset({
+    '.git', '.hg', '.svn', '.idea', '.vscode',
+    '__pycache__', '.mypy_cache', '.pytest_cache', '.ruff_cache', '.tox', '.nox', '.eggs',
+    'venv', '.venv', 'virtualenv', 'site-packages', 'node_modules', 'bower_components', '_vendor',
+})
+# Directories that are only skipped at the root of the repository: build output and vendored
+# dependencies. Deeper down, these names are often real packages (e.g. `src/build` of pypa/build)
+ROOT_PRUNED_DIRS = frozenset({'build', 'dist', 'vendor', 'vendored', 'third_party', 'thirdparty'})
+# Generated files that are never worth analyzing, even though their extension is supported
+SKIPPED_FILES = ('*.min.js', '*_pb2.py', '*_pb2_grpc.py', '*.pb.go', '*.generated.*')
+# Files larger than this many bytes are skipped
+MAX_FILE_SIZE = 1024 * 1024
+# The number of leading bytes that are checked for NUL bytes to detect binary files
+SNIFF_SIZE = 8192
+
+
+@dataclass()
+class SourceEntry:
+    """A single source file that was found by `discover_files`"""
+    path: str
+    rel_path: str
+    language: str
+    size: int
+
+
+@lru_cache(maxsize=None)
+def _readers_by_extension() -> dict[str, type]:
+    """Maps every file extension supported by lizard to the language reader that handles it"""
+    from lizard_languages import languages
+    ret = {}
+    for reader in languages():
+        for ext in reader.ext:
+            # The first reader to claim an extension wins, just like lizard's own dispatch
+            ret.setdefault(ext, reader)
+    return ret
+
+
+def reader_for(file_name: str) -> Optional[type]:
+    """
+    :return: The lizard language reader for `file_name`, or `None` if the language is not supported
+    """
+    [_, dot, ext] = file_name.rpartition('.')
+    if not dot:
+        return None
+    return _readers_by_extension().get(ext)
+
+
+def language_of(file_name: str) -> Optional[str]:
+    """
+    :return: The name of the language of `file_name`, as lizard calls it (e.g. `python`), or `None`
+        if the language is not supported
+    """
+    reader = reader_for(file_name)
+    return None if reader is None else reader.language_names[0]
+
+
+def extensions_of(languages: Iterable[str]) -> set[str]:
+    """
+    :return: Every file extension (without the dot) of the languages, as lizard names them
+    """
+    languages = set(languages)
+    return {ext for ext, reader in _readers_by_extension().items() if languages.intersection(reader.language_names)}
+
+
+def _translate(pattern: str) -> str:
+    """Translates a single gitignore glob into a regular expression over `/`-separated paths"""
+    ret = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            ret += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            ret += '/.*'
+            i += 3
+        elif pattern.startswith('**', i):
+            ret += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            ret += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            ret += '[^/]'
+            i += 1
+        elif pattern[i] == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                ret += re.escape('[')
+                i += 1
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                ret += f"[{body}]"
+                i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            ret += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            ret += re.escape(pattern[i])
+            i += 1
+    return ret
+
+
+class GitIgnore:
+    """The rules of a single `.gitignore` file. Paths are matched relative to the directory
+    that contains the file."""
+    def __init__(self, base: str, lines: Iterable[str]):
+        self.base = base
+        # (regex, negated, directories only)
+        self.rules: list[tuple[re.Pattern, bool, bool]] = []
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line.endswith('\\ '):
+                line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            if '/' in line:
+                # Patterns with a slash are anchored to the directory of the .gitignore file
+                regex = _translate(line.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + _translate(line)
+            self.rules.append((re.compile(regex + '$', re.DOTALL), negated, dir_only))
+
+    @staticmethod
+    def load(directory: str, base: str) -> Optional["GitIgnore"]:
+        """
+        :param directory: The directory that might contain a `.gitignore` file
+        :param base: The path of `directory` relative to the root of the walk
+        :return: The parsed rules, or `None` if there is no `.gitignore` file
+        """
+        try:
+            with open(os.path.join(directory, '.gitignore'), mode='r', encoding='utf-8', errors='ignore') as fp:
+                return GitIgnore(base, fp.readlines())
+        except OSError:
+            return None
+
+    def match(self, rel_path: str, is_dir: bool) -> Optional[bool]:
+        """
+        :param rel_path: The path relative to the root of the walk
+        :return: `True` if the path is ignored, `False` if it is explicitly un-ignored, and `None`
+            if no rule applies
+        """
+        if self.base:
+            if not rel_path.startswith(self.base + '/'):
+                return None
+            rel_path = rel_path[len(self.base) + 1:]
+        ret = None
+        for regex, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                ret = not negated
+        return ret
+
+
+def _is_ignored(ignores: list[GitIgnore], rel_path: str, is_dir: bool) -> bool:
+    ret = False
+    for ignore in ignores:
+        matched = ignore.match(rel_path, is_dir)
+        if matched is not None:
+            ret = matched
+    return ret
+
+
+def _is_binary(path: str) -> bool:
+    try:
+        with open(path, mode='rb') as fp:
+            return b'\0' in fp.read(SNIFF_SIZE)
+    except OSError:
+        return True
+
+
+def _is_pruned(name: str, rel_dir: str, pruned_dirs: Iterable[str], root_pruned_dirs: Iterable[str]) -> bool:
+    """
+    :param name: The name of a directory
+    :param rel_dir: The path of the directory that contains it, relative to the root
+    """
+    return name in pruned_dirs or (not rel_dir and name in root_pruned_dirs)
+
+
+def is_excluded(rel_path: str, pruned_dirs: Iterable[str] = PRUNED_DIRS,
+                root_pruned_dirs: Iterable[str] = ROOT_PRUNED_DIRS) -> bool:
+    """
+    :return: If a file would be skipped by `discover_files` because of the directory it is in or
+        because it is a generated file. This is for paths that are listed rather than walked, like
+        the files in a git tree; `.gitignore` rules, size and binary checks don't apply to those.
+    """
+    [*dirs, name] = rel_path.split('/')
+    return (any(_is_pruned(directory, '/'.join(dirs[:i]), pruned_dirs, root_pruned_dirs)
+                for i, directory in enumerate(dirs))
+            or any(fnmatch.fnmatch(name, pattern) for pattern in SKIPPED_FILES))
+
+
+def discover_files(root: Union[str, Path], languages: Iterable[str] = None, max_size: int = MAX_FILE_SIZE,
+                   use_gitignore: bool = True, pruned_dirs: Iterable[str] = PRUNED_DIRS,
+                   root_pruned_dirs: Iterable[str] = ROOT_PRUNED_DIRS) -> Iterator[SourceEntry]:
+    """Finds every source file under `root` in a single pass over the file system.
+
+    Version control metadata, virtualenvs and dependency directories (see `PRUNED_DIRS`), and build
+    and vendor directories at the root (see `ROOT_PRUNED_DIRS`) are pruned before they are entered,
+    as is anything matched by a `.gitignore` file. Generated files, files larger than `max_size` and
+    binary files are skipped.
+
+    :param root: The directory to search
+    :param languages: The names of the languages to include (e.g. `python`), as lizard calls them.
+        `None` includes every language lizard supports
+    :param max_size: The size in bytes above which files are skipped
+    :param use_gitignore: If the `.gitignore` files in the tree should be respected
+    :param pruned_dirs: The names of the directories that are skipped wherever they are
+    :param root_pruned_dirs: The names of the directories that are only skipped at the root
+    :return: The files that were found, in a stable order, together with their language
+    """
+    pruned_dirs = frozenset(pruned_dirs)
+    root_pruned_dirs = frozenset(root_pruned_dirs)
+    readers = set(_readers_by_extension().values())
+    if languages is not None:
+        languages = set(languages)
+        readers = {reader for reader in readers if languages.intersection(reader.language_names)}
+
+    root = str(root)
+    # (absolute path, path relative to the root, the .gitignore rules that apply)
+    stack: list[tuple[str, str, list[GitIgnore]]] = [(root, '', [])]
+    while stack:
+        directory, rel_dir, ignores = stack.pop()
+        if use_gitignore:
+            ignore = GitIgnore.load(directory, rel_dir)
+            if ignore is not None:
+                ignores = ignores + [ignore]
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if (_is_pruned(entry.name, rel_dir, pruned_dirs, root_pruned_dirs)
+                        or _is_ignored(ignores, rel_path, True)):
+                    continue
+                # Virtualenvs don't always have a conventional name, but they always have this file
+                if os.path.exists(os.path.join(entry.path, 'pyvenv.cfg')):
+                    continue
+                subdirs.append((entry.path, rel_path, ignores))
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            reader = reader_for(entry.name)
+            if reader not in readers:
+                continue
+            if any(fnmatch.fnmatch(entry.name, pattern) for pattern in SKIPPED_FILES):
+                continue
+            if _is_ignored(ignores, rel_path, False):
+                continue
+            size = entry.stat(follow_symlinks=False).st_size
+            if size > max_size or _is_binary(entry.path):
+                continue
+            yield SourceEntry(path=entry.path, rel_path=rel_path, language=reader.language_names[0], size=size)
+        # Reversed, so that directories are popped off the stack in alphabetical order
+        stack.extend(reversed(subdirs))
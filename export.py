@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Optional, Union
+
+from lazy import lazy_import
+
+# Only loaded once it is actually used, see `bench_imports.py`
+pd = lazy_import('pandas')
+
+# The columns of the per-file summary, in the order they are stored
+SUMMARY_COLUMNS = ['repo', 'file_dir', 'file_name', 'nloc', 'loc', 'CCN', 'func_token']
+# The columns of the per-function details, in the order they are stored
+FUNCTION_COLUMNS = ['repo', 'file', 'name', 'start_line', 'nloc', 'CCN', 'enclosing_class', 'max_depth', 'branches',
+                    'calls', 'returns', 'raises', 'assertions']
+
+# Every format an exporter exists for, mapped to the file extension it writes
+FORMATS = {
+    'sqlite': '.sqlite',
+    'parquet': '.parquet',
+    'csv': '',
+}
+
+
+class Exporter:
+    """Writes the results of analysis to the file system. Results are written as they are
+    handed over, so an exporter can be fed one file (or one repository) at a time without
+    holding everything in memory.
+
+    Exporters are context managers; leaving the `with` block flushes and closes the output.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def write_summary(self, df: pd.DataFrame, repo: str):
+        """Writes the per-file summary of a repository
+        :param df: A DataFrame with (a subset of) the columns in `SUMMARY_COLUMNS`
+        :param repo: The name of the repository the files belong to
+        """
+        raise NotImplementedError
+
+    def write_functions(self, df: pd.DataFrame, repo: str, file: str):
+        """Writes the per-function details of a single file
+        :param df: A DataFrame with (a subset of) the columns in `FUNCTION_COLUMNS`
+        :param repo: The name of the repository the file belongs to
+        :param file: The path of the file, relative to the root of the repository
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """Makes sure that everything written so far has reached the file system"""
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _conform(df: pd.DataFrame, columns: list[str], **constants) -> pd.DataFrame:
+    """Reorders `df` to `columns`, filling in `constants` and leaving other missing columns empty"""
+    df = df.assign(**constants)
+    return df.reindex(columns=columns)
+
+
+class SqliteExporter(Exporter):
+    """Writes everything into a single SQLite database with a `summary` and a `functions` table.
+
+    Rows are bulk inserted with journaling turned off; the indexes are only built once all rows
+    are in, which is much faster than maintaining them during the load. Exporting into an existing
+    database replaces the rows of the repositories that are written again, and keeps the others.
+    """
+    # Rows are committed in batches of roughly this size
+    BATCH_ROWS = 50_000
+
+    def __init__(self, path: Union[str, Path]):
+        super().__init__(path)
+        # The crawler creates its exporter on the main thread but writes to it from the worker thread
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS summary ('
+            'repo TEXT, file_dir TEXT, file_name TEXT, nloc INTEGER, loc INTEGER, CCN INTEGER, func_token INTEGER)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS functions ('
+            'repo TEXT, file TEXT, name TEXT, start_line INTEGER, nloc INTEGER, CCN INTEGER, enclosing_class TEXT, '
+            'max_depth INTEGER, branches INTEGER, calls INTEGER, returns INTEGER, raises INTEGER, assertions INTEGER)'
+        )
+        self.pending_rows = 0
+        # The repositories written so far, whose rows from earlier exports were replaced
+        self.repos: set[str] = set()
+
+    def _replace(self, repo: str):
+        """Deletes the rows that an earlier export left for `repo`, the first time it is written to"""
+        if repo in self.repos:
+            return
+        self.repos.add(repo)
+        self.conn.execute('DELETE FROM summary WHERE repo = ?', (repo,))
+        self.conn.execute('DELETE FROM functions WHERE repo = ?', (repo,))
+
+    def _insert(self, table: str, df: pd.DataFrame):
+        placeholders = ', '.join('?' for _ in df.columns)
+        # `None` rather than NaN, so that missing values end up as SQL NULLs
+        rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        self.conn.executemany(f'INSERT INTO {table} VALUES ({placeholders})', rows)
+        self.pending_rows += len(df)
+        if self.pending_rows >= self.BATCH_ROWS:
+            self.conn.commit()
+            self.pending_rows = 0
+
+    def write_summary(self, df: pd.DataFrame, repo: str):
+        self._replace(repo)
+        self._insert('summary', _conform(df, SUMMARY_COLUMNS, repo=repo))
+
+    def write_functions(self, df: pd.DataFrame, repo: str, file: str):
+        self._replace(repo)
+        self._insert('functions', _conform(df, FUNCTION_COLUMNS, repo=repo, file=file))
+
+    def flush(self):
+        self.conn.commit()
+        self.pending_rows = 0
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.conn.execute('CREATE INDEX IF NOT EXISTS summary_repo ON summary (repo, file_dir, file_name)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS functions_file ON functions (repo, file)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS functions_ccn ON functions (CCN)')
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+
+
+class ParquetExporter(Exporter):
+    """Writes the per-function details into a single compressed Parquet file, streamed one row
+    group at a time. Since Parquet files hold a single table, the per-file summary is stored in
+    the file's metadata under the `cca.summary` key.
+
+    Rows are streamed into a `.partial` file next to `path`, which replaces `path` once the
+    exporter is closed. Older versions of `pyarrow` can't add metadata to a file that is already
+    being written, in which case the row groups are copied over into the final file instead.
+
+    Requires `pyarrow`.
+    """
+    # Functions are buffered until there are this many, then written out as one row group
+    ROW_GROUP_ROWS = 100_000
+
+    def __init__(self, path: Union[str, Path], compression: str = 'zstd'):
+        super().__init__(path)
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = pa.schema([
+            ('repo', pa.string()), ('file', pa.string()), ('name', pa.string()), ('start_line', pa.int64()),
+            ('nloc', pa.int64()), ('CCN', pa.int64()), ('enclosing_class', pa.string()),
+            ('max_depth', pa.float64()), ('branches', pa.float64()), ('calls', pa.float64()),
+            ('returns', pa.float64()), ('raises', pa.float64()), ('assertions', pa.float64()),
+        ])
+        self.compression = compression
+        self.summaries: list[pd.DataFrame] = []
+        self.buffer: list[pd.DataFrame] = []
+        self.buffered_rows = 0
+        self.writer = None
+        self.partial_path = self.path.with_name(self.path.name + '.partial')
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        import pyarrow.parquet as pq
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(str(self.partial_path), self.schema, compression=self.compression)
+        table = self.pa.Table.from_pandas(pd.concat(self.buffer, ignore_index=True), schema=self.schema,
+                                          preserve_index=False)
+        self.writer.write_table(table)
+        self.buffer.clear()
+        self.buffered_rows = 0
+
+    def write_summary(self, df: pd.DataFrame, repo: str):
+        self.summaries.append(_conform(df, SUMMARY_COLUMNS, repo=repo))
+
+    def write_functions(self, df: pd.DataFrame, repo: str, file: str):
+        self.buffer.append(_conform(df, FUNCTION_COLUMNS, repo=repo, file=file))
+        self.buffered_rows += len(df)
+        if self.buffered_rows >= self.ROW_GROUP_ROWS:
+            self._flush()
+
+    def flush(self):
+        self._flush()
+
+    def close(self):
+        if self.summaries is None:
+            return
+        if self.writer is None:
+            # Make sure that a (possibly empty) file is written even if there were no functions
+            self.buffer.append(pd.DataFrame(columns=FUNCTION_COLUMNS))
+        self._flush()
+        if self.summaries:
+            summary = pd.concat(self.summaries, ignore_index=True)
+        else:
+            summary = pd.DataFrame(columns=SUMMARY_COLUMNS)
+        metadata = {'cca.summary': summary.to_json(orient='split', index=False)}
+        self.summaries = None
+        if hasattr(self.writer, 'add_key_value_metadata'):
+            self.writer.add_key_value_metadata(metadata)
+            self.writer.close()
+            os.replace(self.partial_path, self.path)
+            return
+
+        import pyarrow.parquet as pq
+        self.writer.close()
+        partial = pq.ParquetFile(str(self.partial_path))
+        with pq.ParquetWriter(str(self.path), self.schema.with_metadata(metadata),
+                              compression=self.compression) as writer:
+            for i in range(partial.num_row_groups):
+                writer.write_table(partial.read_row_group(i))
+        partial.close()
+        os.remove(self.partial_path)
+
+
+def read_parquet_summary(path: Union[str, Path]) -> pd.DataFrame:
+    """Reads back the per-file summary stored in the metadata of a file written by `ParquetExporter`"""
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(str(path)).metadata
+    summary = json.loads(metadata[b'cca.summary'])
+    return pd.DataFrame(data=summary['data'], columns=summary['columns'])
+
+
+class CsvTreeExporter(Exporter):
+    """Writes a `summary.csv` with the files of every repository, and one CSV file per source file
+    under `details/<owner>/<repo>/`, in the same structure as the original file tree. If `compress`
+    is set, every CSV file is gzipped.
+    """
+    def __init__(self, path: Union[str, Path], compress: bool = False):
+        super().__init__(path)
+        self.compress = compress
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.details_dir = self.path / 'details'
+        self.details_dir.mkdir(exist_ok=True)
+        self.wrote_summary = False
+
+    def _csv_path(self, path: Path) -> Path:
+        return path.with_name(path.name + '.gz') if self.compress else path
+
+    def write_summary(self, df: pd.DataFrame, repo: str):
+        path = self._csv_path(self.path / 'summary.csv')
+        _conform(df, SUMMARY_COLUMNS, repo=repo).to_csv(path, mode='a' if self.wrote_summary else 'w',
+                                                        header=not self.wrote_summary, index=False)
+        self.wrote_summary = True
+
+    def write_functions(self, df: pd.DataFrame, repo: str, file: str):
+        file_path = file.strip('\\/').replace('\\', '/')
+        # Nested under the repository, since different repositories have files with the same path
+        csv_path = self._csv_path(self.details_dir / repo.strip('/') / f"{file_path}.csv")
+        csv_path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_csv(csv_path)
+
+
+class CombinedExporter(Exporter):
+    """Forwards everything that is written to several exporters"""
+    def __init__(self, exporters: list[Exporter]):
+        super().__init__('')
+        self.exporters = exporters
+
+    def write_summary(self, df: pd.DataFrame, repo: str):
+        for exporter in self.exporters:
+            exporter.write_summary(df, repo)
+
+    def write_functions(self, df: pd.DataFrame, repo: str, file: str):
+        for exporter in self.exporters:
+            exporter.write_functions(df, repo, file)
+
+    def flush(self):
+        for exporter in self.exporters:
+            exporter.flush()
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+
+def combine(*exporters: Optional[Exporter]) -> Optional[Exporter]:
+    """
+    :return: An exporter that writes to every exporter in `exporters` that is not `None`, or `None`
+        if there are none
+    """
+    exporters = [exporter for exporter in exporters if exporter is not None]
+    if not exporters:
+        return None
+    if len(exporters) == 1:
+        return exporters[0]
+    return CombinedExporter(exporters)
+
+
+def open_exporter(path: Union[str, Path], fmt: str = 'sqlite', compress: Optional[bool] = None) -> Exporter:
+    """
+    :param path: Where to write the results. For the `csv` format this is a directory, otherwise it is a file
+    :param fmt: One of the keys of `FORMATS`
+    :param compress: If the output should be compressed. `None` uses each format's default
+    :return: An exporter that writes to `path` in the format `fmt`
+    :raise ValueError: if `fmt` is not a known format
+    """
+    if fmt == 'sqlite':
+        return SqliteExporter(path)
+    if fmt == 'parquet':
+        return ParquetExporter(path, compression='zstd' if compress is None or compress else 'none')
+    if fmt == 'csv':
+        return CsvTreeExporter(path, compress=bool(compress))
+    raise ValueError(f"Unknown export format '{fmt}', expected one of {', '.join(FORMATS)}")
+
+
+def export_analysis(exporter: Exporter, repo: str, repo_analysis: pd.DataFrame,
+                    file_analysis: dict[str, pd.DataFrame]):
+    """Writes the summary and all per-function details of a single analyzed repository"""
+    exporter.write_summary(repo_analysis, repo)
+    for file, df in file_analysis.items():
+        exporter.write_functions(df, repo, file)
+
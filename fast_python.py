@@ -0,0 +1,261 @@
+"""A lizard-compatible analysis of Python source code that doesn't run lizard.
+
+For Python files, `analysis_api.ClonedRepo` used to run lizard's tokenizer and state machine, and then
+`features`' `ast.parse` on the same file. Most of lizard's time goes into pushing every single token
+through a chain of generators and a state machine. This engine computes the same metrics from one
+regular expression scan over the source code, in vectorized form:
+
+- Tokens are found with the same pattern lizard uses, so that token counts and nloc match.
+- CCN is 1 plus the `if`, `elif`, `for`, `while`, `and`, `or`, `except` and `finally` tokens in a
+  function's own code.
+- The function a token belongs to can only change at the first token of a line or around a `def`, so
+  lizard's indentation tracking is replayed on just those tokens, quirks included. For example, a
+  function whose body is on the same line as its `def` stays open until the next function starts, and
+  is left out unless a more indented line follows it.
+
+Together with `features`, which parses the source code itself, a Python file is read once instead of
+twice. `conformance.py` checks how closely the results match lizard's on a corpus.
+"""
+from __future__ import annotations
+
+import ast
+import re
+from typing import Optional
+
+import features
+from lazy import lazy_import
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+np = lazy_import('numpy')
+
+# The same token pattern lizard uses for Python, so that the token counts match
+_UNTIL_END = r"(?:\\\n|[^\n])*"
+_COMBINED_SYMBOLS = ["<<=", ">>=", "||", "&&", "===", "!==", "==", "!=", "<=", ">=", "->", "=>", "++", "--", '+=',
+                     '-=', "+", "-", '*', '/', '*=', '/=', '^=', '&=', '|=', "..."]
+_TOKEN_PATTERN = re.compile(
+    r"(?:\/\*.*?\*\/"
+    r"|\#" + _UNTIL_END +
+    r"|\'\'\'.*?\'\'\'|\"\"\".*?\"\"\""
+    r"|(?:\d+\')+\d+"
+    r"|\w+"
+    r"|\"(?:\\.|[^\"\\])*\""
+    r"|\'(?:\\.|[^\'\\])*?\'"
+    r"|\/\/" + _UNTIL_END +
+    r"|\#"
+    r"|:=|::|\*\*"
+    r"|\<\s*\?(?:\s*extends\s+\w+)?\s*\>"
+    r"|" + r"|".join(re.escape(s) for s in _COMBINED_SYMBOLS) +
+    r"|\\\n"
+    r"|\n"
+    r"|[^\S\n]+"
+    r"|.)", re.M | re.S)
+# The first characters of the tokens lizard skips: whitespace and comments
+_SKIPPED_STARTS = [ord('#')] + [c for c in range(0x3001) if chr(c).isspace()]
+# The tokens lizard counts as conditions. Matches that don't start a token are inside strings or comments
+_CONDITION_PATTERN = re.compile(r"\b(?:if|elif|for|while|and|or|except|finally)\b")
+_DEF_PATTERN = re.compile(r"\bdef\b")
+# The states of lizard's Python state machine
+_GLOBAL, _NAME, _PARAMETERS, _COLON, _FIRST_LINE = range(5)
+
+
+class FunctionInfo:
+    """The metrics of a single function, with the same attributes as lizard's `FunctionInfo`"""
+    __slots__ = ('name', 'start_line', 'nloc', 'token_count', 'cyclomatic_complexity', 'signature_done')
+
+    def __init__(self, name: str, start_line: int):
+        self.name = name
+        self.start_line = start_line
+        # Like lizard, the name of the function is its first token, on its first line
+        self.nloc = 1
+        self.token_count = 1
+        self.cyclomatic_complexity = 1
+        # If the parameters were read, after which lizard tracks indentation again
+        self.signature_done = False
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"FunctionInfo({fields})"
+
+
+class FileInformation:
+    """The metrics of a single file, with the same attributes as lizard's `FileInformation`"""
+    def __init__(self, filename: Optional[str], nloc: int, token_count: int, function_list: list[FunctionInfo]):
+        self.filename = filename
+        self.nloc = nloc
+        self.token_count = token_count
+        self.function_list = function_list
+
+    @property
+    def CCN(self) -> int:
+        return sum(func.cyclomatic_complexity for func in self.function_list)
+
+
+def _token_indices(positions: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """
+    :return: The indices of the counted tokens that start at any of `positions`
+    """
+    return np.searchsorted(starts, positions[np.isin(positions, starts)])
+
+
+def _matches(pattern: re.Pattern, source: str) -> np.ndarray:
+    """
+    :return: The positions of every match of `pattern` in `source`
+    """
+    return np.fromiter((m.start() for m in pattern.finditer(source)), dtype=np.int64)
+
+
+def analyze_source(source: str, file_name: str = None, store: features.FunctionStore = None,
+                   tree: ast.Module = None) -> FileInformation:
+    """Analyzes a string of Python source code, with the results lizard would give.
+
+    :param file_name: The name of the file, which is just passed on to the results
+    :param store: If given, the extra statistics of `features` are appended to this store as well
+    :param tree: The source code's syntax tree for `features`, if it was already parsed
+    :return: The file's metrics, which can be used in place of `lizard.analyze_file`'s
+    :raise SyntaxError: if a `store` is given and the source code isn't valid Python. Without a
+        `store` the source code isn't parsed at all, so anything can be analyzed, just like with lizard
+    """
+    if store is not None:
+        features.analyze_source(source, store, file_name, tree)
+
+    # Tokenize like lizard, and find the lines every counted token starts and ends on
+    tokens = _TOKEN_PATTERN.findall(source)
+    lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+    ends = np.cumsum(lengths)
+    code_points = np.frombuffer(source.encode('utf-32-le'), dtype='<u4')
+    counted = np.flatnonzero(~np.isin(code_points[ends - lengths], _SKIPPED_STARTS))
+    ends = ends[counted]
+    starts = ends - lengths[counted]
+    newlines = np.flatnonzero(code_points == ord('\n'))
+    start_lines = np.searchsorted(newlines, starts, side='right') + 1
+    end_lines = np.searchsorted(newlines, ends - 1, side='right') + 1
+    # Each token counts its own line if it is the first token on it, plus every line it continues onto
+    first_on_line = np.ones(len(starts), dtype=bool)
+    first_on_line[1:] = start_lines[1:] > end_lines[:-1]
+    line_counts = first_on_line + (end_lines - start_lines)
+    file_nloc = int(line_counts.sum())
+
+    # The indentation of every line, at the token that starts it
+    line_heads = np.flatnonzero(first_on_line)
+    line_starts = np.concatenate(([0], newlines + 1))
+    indents = starts[line_heads] - line_starts[start_lines[line_heads] - 1]
+    if '\t' in source:
+        # lizard counts a tab as 8 spaces
+        indents = np.array([indent + 7 * source.count('\t', start - indent, start)
+                            for start, indent in zip(starts[line_heads].tolist(), indents.tolist())], dtype=np.int64)
+    head_indents = dict(zip(line_heads.tolist(), indents.tolist()))
+
+    # The tokens lizard's state machine reacts to: the first token of every line, every `def`, the
+    # tokens up to its parameters, the end of its parameters and the two tokens after that
+    events = set(head_indents)
+    # The index of every `def` -> the index of the `)` that ends its parameters
+    signatures = {}
+    defs = _token_indices(_matches(_DEF_PATTERN, source), starts)
+    if len(defs):
+        opens = _token_indices(np.flatnonzero(code_points == ord('(')), starts)
+        closes = _token_indices(np.flatnonzero(code_points == ord(')')), starts)
+        for i in defs.tolist():
+            j = int(np.searchsorted(opens, i))
+            if j == len(opens):
+                continue
+            k = int(np.searchsorted(closes, opens[j]))
+            close = int(closes[k]) if k < len(closes) else len(starts)
+            signatures[i] = close
+            events.update(range(i, int(opens[j]) + 1))
+            events.update((close, close + 1, close + 2))
+
+    # Replay lizard's state machine on those tokens. Functions are indices into `functions`, and
+    # `global_id` stands for the code outside of any function
+    functions: list[FunctionInfo] = []
+    global_id = -1
+    # The functions in the order lizard lists them, which is the order in which they end
+    function_list: list[int] = []
+    indent_stack = [0]
+    # The function at every level of nesting, or `None` for levels that aren't a function
+    nesting_stack: list[Optional[int]] = []
+    pending: Optional[int] = None
+    current = global_id
+    state = _GLOBAL
+    close = -1
+    # (function, the number of lines of its docstring)
+    docstrings: list[tuple[int, int]] = []
+    # (index of a token, the function that token and the ones after it belong to)
+    segments: list[tuple[int, int]] = []
+
+    def pop_nesting():
+        nonlocal pending, current
+        pending = None
+        if nesting_stack and nesting_stack.pop() is not None:
+            # Like lizard, this ends the current function, which isn't necessarily the one popped
+            if current != global_id:
+                function_list.append(current)
+            current = next((f for f in reversed(nesting_stack) if f is not None), global_id)
+
+    for i in sorted(events):
+        if i >= len(starts):
+            break
+        token = tokens[counted[i]]
+        indent = head_indents.get(i)
+        if indent is not None and (current == global_id or functions[current].signature_done):
+            while indent_stack[-1] > indent and not token.startswith(')'):
+                indent_stack.pop()
+                pop_nesting()
+            if indent_stack[-1] < indent:
+                indent_stack.append(indent)
+                nesting_stack.append(pending)
+                pending = None
+        segments.append((i, current))
+
+        if state == _FIRST_LINE:
+            if token.startswith(('"""', "'''")):
+                docstrings.append((current, token.count('\n') + 1))
+            state = _GLOBAL
+        if state == _GLOBAL:
+            if i in signatures:
+                state = _NAME
+                close = signatures[i]
+        elif state == _NAME:
+            if token == '(':
+                state = _PARAMETERS
+            else:
+                prefix = ''.join(functions[f].name + '.' for f in nesting_stack if f is not None)
+                current = pending = len(functions)
+                functions.append(FunctionInfo(prefix + token, int(start_lines[i])))
+        elif state == _PARAMETERS:
+            if i == close:
+                functions[current].signature_done = True
+                state = _COLON
+        elif state == _COLON:
+            state = _FIRST_LINE if token == ':' else _GLOBAL
+        segments.append((i + 1, current))
+    # The end of the file closes every level of nesting
+    while len(indent_stack) > 1:
+        indent_stack.pop()
+        pop_nesting()
+
+    # Attribute every token to its function, with `len(functions)` standing for the global code
+    owners = np.full(len(starts), len(functions), dtype=np.int64)
+    if segments:
+        [bounds, segment_owners] = np.array(segments, dtype=np.int64).T
+        segment_owners[segment_owners == global_id] = len(functions)
+        owners[bounds[0]:] = np.repeat(segment_owners, np.diff(np.append(bounds, len(starts))))
+    token_counts = np.bincount(owners, minlength=len(functions) + 1)
+    nlocs = np.bincount(owners, weights=line_counts, minlength=len(functions) + 1)
+    conditions = _token_indices(_matches(_CONDITION_PATTERN, source), starts)
+    ccns = np.bincount(owners[conditions], minlength=len(functions) + 1)
+    for fid, func in enumerate(functions):
+        func.token_count += int(token_counts[fid])
+        func.nloc += int(nlocs[fid])
+        func.cyclomatic_complexity += int(ccns[fid])
+    for fid, lines in docstrings:
+        functions[fid].nloc -= lines
+        file_nloc -= lines
+
+    return FileInformation(file_name, file_nloc, len(starts), [functions[fid] for fid in function_list])
+
+
+def analyze_file(file_path: str, store: features.FunctionStore = None) -> FileInformation:
+    """Analyzes a Python source file, with the results lizard would give. See `analyze_source`."""
+    with open(file_path, mode='r') as fp:
+        source = fp.read()
+    return analyze_source(source, file_path, store)
@@ -1,22 +1,112 @@
 import ast
+from array import array
 from dataclasses import dataclass, field
 from typing import Optional, Union
 
 
-@dataclass(frozen=False)
 class Function:
-    """Statistics and identifying information for a single function"""
-    name: str
-    start_line: int
-    lines: int
-    enclosing_class: Optional[str]
-    max_depth: int = 0
-    branches: int = 0
-    calls: int = 0
-    returns: int = 0
-    raises: int = 0
-    assertions: int = 0
-    nested_funcs: list["Function"] = field(default_factory=list)
+    """Statistics and identifying information for a single function.
+
+    This is a slotted record rather than a dataclass, since a crawl creates a great many of
+    these and a per-instance `__dict__` more than doubles their size.
+    """
+    __slots__ = ('name', 'start_line', 'lines', 'enclosing_class', 'max_depth', 'branches', 'calls', 'returns',
+                 'raises', 'assertions', 'nested_funcs')
+
+    def __init__(self, name: str, start_line: int, lines: int, enclosing_class: Optional[str], max_depth: int = 0,
+                 branches: int = 0, calls: int = 0, returns: int = 0, raises: int = 0, assertions: int = 0,
+                 nested_funcs: list["Function"] = None):
+        self.name = name
+        self.start_line = start_line
+        self.lines = lines
+        self.enclosing_class = enclosing_class
+        self.max_depth = max_depth
+        self.branches = branches
+        self.calls = calls
+        self.returns = returns
+        self.raises = raises
+        self.assertions = assertions
+        self.nested_funcs = [] if nested_funcs is None else nested_funcs
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"Function({fields})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Function):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+
+# The integer-valued columns of a `FunctionStore`
+_INT_COLUMNS = ('start_line', 'lines', 'max_depth', 'branches', 'calls', 'returns', 'raises', 'assertions')
+
+
+class FunctionStore:
+    """A compact, column-oriented collection of function statistics.
+
+    Each integer field is kept in its own `array.array`, so a stored function costs a few dozen
+    bytes instead of a full Python object. Nested functions are flattened as they are appended
+    and given fully-qualified names, e.g. `do_stuff.inner` for the function `inner` nested inside
+    `do_stuff`. `to_frame` hands the columns to pandas without building a dict per row.
+    """
+    def __init__(self):
+        self.file: list[Optional[str]] = []
+        self.name: list[str] = []
+        self.enclosing_class: list[Optional[str]] = []
+        for column in _INT_COLUMNS:
+            setattr(self, column, array('l'))
+        self.current_file: Optional[str] = None
+
+    def __len__(self):
+        return len(self.name)
+
+    def __getitem__(self, i: int) -> Function:
+        return Function(
+            name=self.name[i],
+            enclosing_class=self.enclosing_class[i],
+            **{column: getattr(self, column)[i] for column in _INT_COLUMNS},
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def append(self, func: Function, prefix: str = ''):
+        """Stores `func` and, recursively, every function nested inside it.
+        :param prefix: The qualified name of the function that `func` is nested inside, if any
+        """
+        name = f"{prefix}.{func.name}" if prefix else func.name
+        self.file.append(self.current_file)
+        self.name.append(name)
+        self.enclosing_class.append(func.enclosing_class)
+        for column in _INT_COLUMNS:
+            getattr(self, column).append(getattr(func, column))
+        for nested_func in func.nested_funcs:
+            self.append(nested_func, name)
+
+    def extend(self, funcs: list[Function]):
+        for func in funcs:
+            self.append(func)
+
+    def index(self) -> dict[tuple[str, int], int]:
+        """
+        :return: A mapping of (name, start line) to the position of each function in the store.
+            Several functions in different classes can have the same name, so the start line is
+            used as a secondary key.
+        """
+        return {key: i for i, key in enumerate(zip(self.name, self.start_line))}
+
+    def to_frame(self):
+        """
+        :return: A Pandas DataFrame with one row per stored function
+        """
+        import numpy as np
+        import pandas as pd
+        data = {'file': self.file, 'name': self.name, 'enclosing_class': self.enclosing_class}
+        for column in _INT_COLUMNS:
+            # Copied through the buffer protocol in one go, rather than element by element
+            data[column] = np.array(getattr(self, column), dtype=np.int64)
+        return pd.DataFrame(data)
 
 
 @dataclass()
@@ -257,16 +347,35 @@ def class_def(node: ast.ClassDef, branch_depth: int = 0) -> list[Function]:
     return funcs
 
 
-def analyze_file(file_path: str) -> SourceFile:
+def analyze_file(file_path: str, store: FunctionStore = None) -> SourceFile:
+    """Analyzes every function in a Python source file.
+
+    :param store: If given, the file's functions are appended to this store (and tagged with
+        `file_path`) instead of being kept on the returned `SourceFile`
+    """
     with open(file_path, mode='r') as fp:
         source = fp.read()
-        root: ast.Module = ast.parse(source, mode='exec')
+    return analyze_source(source, store, file_path)
+
+
+def analyze_source(source: str, store: FunctionStore = None, file_path: str = None,
+                   root: ast.Module = None) -> SourceFile:
+    """Analyzes every function in a string of Python source code. See `analyze_file`.
+
+    :param root: The source code's syntax tree, if it was already parsed
+    """
+    if root is None:
+        root = ast.parse(source, mode='exec')
 
     functions = []
     for item in root.body:
         analyze_item(item, functions)
 
     lines = len(source.split('\n'))
+    if store is not None:
+        store.current_file = file_path
+        store.extend(functions)
+        return SourceFile(lines=lines)
     return SourceFile(functions=functions, lines=lines)
 
 
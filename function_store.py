@@ -0,0 +1,254 @@
+from datetime import date, datetime
+from typing import Optional
+
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import Column, Date, DateTime, Index, Integer, MetaData, String, Table
+
+import export
+
+metadata = MetaData()
+
+# One row per analyzed function. The indexes are laid out for "most complex functions" queries: each
+# one ends in `CCN`, so a query that compares the leading column for *equality* and orders by CCN walks
+# the index backwards from the highest CCN and stops after `LIMIT` rows. A range on the leading column
+# (e.g. `Repo_created BETWEEN ...`) can't be served that way, since the rows of the range aren't ordered
+# by CCN; that's why repositories are bucketed by `Created_year`, see `top_functions`.
+functions = Table(
+    'Functions', metadata,
+    Column('id', Integer().with_variant(sqlalchemy.BigInteger(), 'mysql'), primary_key=True, autoincrement=True),
+    Column('URL', String(255), nullable=False),
+    Column('Repo_created', Date),
+    # The year of `Repo_created`, which the most complex functions of a range of years are looked up by
+    Column('Created_year', Integer),
+    Column('Language', String(32)),
+    Column('File', String(512)),
+    Column('Name', String(255)),
+    Column('Start_line', Integer),
+    Column('nloc', Integer),
+    Column('CCN', Integer),
+    Column('Enclosing_class', String(255)),
+    Column('Max_depth', Integer),
+    Column('Branches', Integer),
+    Column('Calls', Integer),
+    Column('Returns', Integer),
+    Column('Raises', Integer),
+    Column('Assertions', Integer),
+    Column('Analyzed_at', DateTime),
+    Index('Functions_CCN', 'CCN'),
+    Index('Functions_year_CCN', 'Created_year', 'CCN'),
+    Index('Functions_language_CCN', 'Language', 'CCN'),
+    Index('Functions_URL', 'URL'),
+)
+
+# The functions of repositories whose analysis isn't committed yet, tagged with the `Token` of the job's
+# lease (see `jobs.Lease`). `FunctionStoreWriter.commit` moves them into `Functions` in the same
+# transaction that completes the job, so a worker that lost its lease never replaces any functions.
+staging = Table(
+    'Functions_staging', metadata,
+    Column('Token', String(32), nullable=False),
+    *(Column(column.name, column.type) for column in functions.c if column.name != 'id'),
+    Index('Functions_staging_token', 'Token'),
+    Index('Functions_staging_URL', 'URL'),
+)
+
+# Maps the columns of a per-function DataFrame (see `export.FUNCTION_COLUMNS`) to the columns of the table
+_COLUMN_NAMES = {
+    'file': 'File',
+    'name': 'Name',
+    'start_line': 'Start_line',
+    'nloc': 'nloc',
+    'CCN': 'CCN',
+    'enclosing_class': 'Enclosing_class',
+    'max_depth': 'Max_depth',
+    'branches': 'Branches',
+    'calls': 'Calls',
+    'returns': 'Returns',
+    'raises': 'Raises',
+    'assertions': 'Assertions',
+}
+
+
+def create_schema(engine: sqlalchemy.engine.Engine):
+    """Creates the `Functions` table and its indexes, unless they already exist"""
+    try:
+        metadata.create_all(engine, checkfirst=True)
+    except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.ProgrammingError):
+        # Another worker process created them in the meantime
+        metadata.create_all(engine, checkfirst=True)
+
+
+class FunctionStoreWriter(export.Exporter):
+    """Bulk loads per-function results into the `Functions` table. Works with any database that
+    SQLAlchemy supports; in particular with MySQL and with an embedded SQLite file.
+
+    Call `begin_repo` before writing the functions of a repository. Functions are buffered and
+    inserted in large batches. The first batch of a repository replaces any rows stored for it
+    by an earlier analysis, so analyzing a repository again never duplicates its functions.
+
+    Workers of the job queue pass the token of their lease to `begin_repo` instead: the batches then
+    go to `Functions_staging`, and only replace the repository's functions once `commit` is called
+    in the transaction that completes the job.
+    """
+    # Functions are buffered until there are this many, then inserted in one statement
+    BATCH_ROWS = 10_000
+
+    def __init__(self, engine: sqlalchemy.engine.Engine):
+        super().__init__(str(engine.url))
+        self.engine = engine
+        create_schema(engine)
+        self.url: Optional[str] = None
+        self.repo_created: Optional[date] = None
+        self.language: Optional[str] = None
+        self.analyzed_at: Optional[datetime] = None
+        self.replaced = False
+        self.token: Optional[str] = None
+        self.buffer: list[dict] = []
+
+    def begin_repo(self, url: str, repo_created: Optional[date] = None, language: str = 'python',
+                   token: str = None):
+        """Starts writing the functions of a new repository
+        :param url: The URL of the repository, as stored in the `Repos` table
+        :param repo_created: When the repository was created, if known
+        :param language: The language of the functions that follow
+        :param token: The token of the lease of the repository's job. If it is given, the functions are
+            staged until `commit` is called
+        """
+        self.flush()
+        self.url = url
+        self.repo_created = repo_created
+        self.language = language
+        self.analyzed_at = datetime.now().replace(microsecond=0)
+        self.replaced = False
+        self.token = token
+        if token is not None:
+            # Whatever earlier claims of the job staged can never be committed any more
+            with self.engine.begin() as conn:
+                conn.execute(staging.delete().where(staging.c.URL == url, staging.c.Token != token))
+
+    def write_summary(self, df: pd.DataFrame, repo: str):
+        # Per-file summaries are kept by the `initial` and `Repos` tables
+        pass
+
+    def write_functions(self, df: pd.DataFrame, repo: str, file: str):
+        df = df[[column for column in df.columns if column in _COLUMN_NAMES]].rename(columns=_COLUMN_NAMES)
+        created_year = None if self.repo_created is None else self.repo_created.year
+        df = df.assign(URL=self.url, Repo_created=self.repo_created, Created_year=created_year, Language=self.language,
+                       Analyzed_at=self.analyzed_at, File=file)
+        # `None` rather than NaN, so that missing values end up as SQL NULLs
+        self.buffer.extend(df.astype(object).where(df.notna(), None).to_dict('records'))
+        if len(self.buffer) >= self.BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.url is None or (self.replaced and not self.buffer):
+            return
+        with self.engine.begin() as conn:
+            if self.token is not None:
+                if self.buffer:
+                    conn.execute(staging.insert(), [dict(row, Token=self.token) for row in self.buffer])
+            else:
+                if not self.replaced:
+                    conn.execute(functions.delete().where(functions.c.URL == self.url))
+                    self.replaced = True
+                if self.buffer:
+                    conn.execute(functions.insert(), self.buffer)
+        self.buffer = []
+
+    def commit(self, conn: sqlalchemy.engine.Connection):
+        """Replaces the stored functions of the current repository with the staged ones, as part of the
+        transaction on `conn` that completes its job (see `jobs.JobStore.complete`). If that transaction
+        is rolled back, call `discard`."""
+        if self.url is None or self.token is None:
+            return
+        if self.buffer:
+            conn.execute(staging.insert(), [dict(row, Token=self.token) for row in self.buffer])
+        names = [column.name for column in functions.c if column.name != 'id']
+        conn.execute(functions.delete().where(functions.c.URL == self.url))
+        conn.execute(functions.insert().from_select(
+            names, sqlalchemy.select(*(staging.c[name] for name in names)).where(staging.c.Token == self.token)))
+        conn.execute(staging.delete().where(staging.c.Token == self.token))
+        self.buffer = []
+        self.url = None
+
+    def discard(self):
+        """Drops the buffered functions of the current repository, e.g. because its analysis failed.
+        They are analyzed again later, and replace whatever was already written for the repository."""
+        self.buffer = []
+        self.url = None
+        if self.token is not None:
+            with self.engine.begin() as conn:
+                conn.execute(staging.delete().where(staging.c.Token == self.token))
+            self.token = None
+
+    def close(self):
+        self.flush()
+
+
+def first_commit_date(repo_path) -> Optional[date]:
+    """
+    :return: The date of the oldest root commit of a cloned repository, which is the best estimate of
+        when the repository was created that is available without asking GitHub
+    """
+    from git.repo.base import Repo
+    dates = Repo(repo_path).git.log('--max-parents=0', '--format=%aI', 'HEAD').split()
+    if not dates:
+        return None
+    return min(datetime.fromisoformat(x).date() for x in dates)
+
+
+def top_functions(engine: sqlalchemy.engine.Engine, limit: int = 100, created_from: date = None,
+                  created_to: date = None, language: str = None, min_ccn: int = None) -> pd.DataFrame:
+    """The most complex functions, optionally limited to repositories created within a date range
+    and to a single language. For example, the 100 most complex functions in repositories created in
+    2021 are `top_functions(engine, 100, date(2021, 1, 1), date(2021, 12, 31))`.
+
+    If both ends of the date range are given, every year of the range is queried on its own, with
+    `Created_year = <year>`: each of those is a backwards walk of `Functions_year_CCN` that stops
+    after `limit` rows, and the results of the years are merged. Otherwise (and for a language
+    without dates, which `Functions_language_CCN` serves the same way) a single query is run, which
+    the database answers by walking `Functions_CCN` backwards and skipping the rows that don't match,
+    so it gets slower the more complex functions there are outside of the filter.
+
+    :param created_from: The earliest creation date (inclusive) of the repositories to include
+    :param created_to: The latest creation date (inclusive) of the repositories to include
+    :param min_ccn: The lowest CCN to include
+    :return: The matching functions, most complex first
+    """
+    query = functions.select()
+    if created_from is not None:
+        query = query.where(functions.c.Repo_created >= created_from)
+    if created_to is not None:
+        query = query.where(functions.c.Repo_created <= created_to)
+    if language is not None:
+        query = query.where(functions.c.Language == language)
+    if min_ccn is not None:
+        query = query.where(functions.c.CCN >= min_ccn)
+    query = query.order_by(functions.c.CCN.desc()).limit(limit)
+    if created_from is None or created_to is None or created_from > created_to:
+        return pd.read_sql(query, con=engine)
+    frames = [pd.read_sql(query.where(functions.c.Created_year == year), con=engine)
+              for year in range(created_from.year, created_to.year + 1)]
+    return (pd.concat(frames, ignore_index=True)
+            .sort_values('CCN', ascending=False, kind='stable')
+            .head(limit)
+            .reset_index(drop=True))
+
+
+def complex_functions_by_language(engine: sqlalchemy.engine.Engine, min_ccn: int = 30) -> pd.DataFrame:
+    """
+    :return: For every language, the number of functions with a CCN above `min_ccn`, and their
+        average and highest CCN
+    """
+    query = (
+        sqlalchemy.select(
+            functions.c.Language,
+            sqlalchemy.func.count().label('Functions'),
+            sqlalchemy.func.avg(functions.c.CCN).label('Avg_CCN'),
+            sqlalchemy.func.max(functions.c.CCN).label('Max_CCN'),
+        )
+        .where(functions.c.CCN > min_ccn)
+        .group_by(functions.c.Language)
+        .order_by(sqlalchemy.desc('Functions'))
+    )
+    return pd.read_sql(query, con=engine)
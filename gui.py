@@ -6,10 +6,14 @@ from pathlib import Path
 from typing import Optional, Union
 
 import dearpygui.dearpygui as dpg
-import numpy as np
-import pandas as pd
 
 import analysis_api
+import export
+from lazy import lazy_import
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 Id = Union[int, str]
 
@@ -65,6 +69,7 @@ def start() -> Id:
     loading_icon_id: Id
     save_button_id: Id
     save_tooltip_id: Id
+    save_format_id: Id
     repo: Optional[analysis_api.ClonedRepo] = None
     data_tab_bar: Id
     summary_tab: Id
@@ -80,12 +85,13 @@ def start() -> Id:
         5. Make the "save" button visible
         """
         dpg.show_item(loading_icon_id)
-        is_valid = subprocess.run(['git', 'ls-remote', app_data],
+        is_valid = subprocess.run(['git', 'ls-remote', '--', app_data],
                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
         dpg.hide_item(loading_icon_id)
         if is_valid:
             fill_table(app_data)
             dpg.show_item(save_button_id)
+            dpg.show_item(save_format_id)
             dpg.show_item(save_tooltip_id)
 
     def sort_details_callback(tbl, sort_specs):
@@ -214,29 +220,16 @@ def start() -> Id:
         dpg.show_item('save_dir_id')
 
     def on_save_dir_selected(sender, app_data):
-        """Saves all of the repository data in the file system in the same
-        structure as the original file tree"""
+        """Saves all of the repository data in the selected directory, either as a single file or,
+        for the `csv` format, in the same structure as the original file tree"""
         dpg.hide_item(sender)
+        fmt = dpg.get_value(save_format_id)
         path = Path(app_data['file_path_name'])
-        if not path.exists():
-            path.mkdir()
-        summary_path = path / 'summary.csv'
-        repo.repo_analysis.to_csv(summary_path)
-        details_dir = path / "details"
-        print(details_dir)
-        if not details_dir.exists():
-            details_dir.mkdir()
-        for file, df in repo.file_analysis.items():
-            file_path = file.strip('\\/')
-            parent_path = file_path.split('\\')[:-1]
-            dir = details_dir
-            for segment in parent_path:
-                dir = dir / segment
-                if not dir.exists():
-                    dir.mkdir()
-            csv_path = details_dir / f"{file_path}.csv"
-            print(csv_path)
-            df.to_csv(csv_path)
+        if fmt != 'csv':
+            path.mkdir(parents=True, exist_ok=True)
+            path = path / f"{repo.user_name}_{repo.repo_name}{export.FORMATS[fmt]}"
+        repo.export(path, fmt)
+        print(f"Saved results to {path}")
 
     dpg.add_file_dialog(directory_selector=True, show=False, tag='save_dir_id',
                         callback=on_save_dir_selected, width=400, height=400)
@@ -246,10 +239,12 @@ def start() -> Id:
             input_text_box_id = dpg.add_input_text(hint="Enter your repository URL, then press Enter",
                                                    callback=on_input_text_enter, on_enter=True)
             save_button_id = dpg.add_button(label='Save', show=False, callback=on_save_button_press)
+            save_format_id = dpg.add_combo(list(export.FORMATS), default_value='sqlite', width=80, show=False)
             loading_icon_id = dpg.add_loading_indicator(style=1, color=(0, 0, 0, 255), show=False)
 
             save_tooltip_id = dpg.add_tooltip(save_button_id, show=False)
-            dpg.add_text('Save the raw data as a collection of CSV files', parent=save_tooltip_id)
+            dpg.add_text('Save the raw data as a single SQLite or Parquet file, or as a collection of CSV files',
+                         parent=save_tooltip_id)
         with dpg.tab_bar():
             summary_tab = dpg.add_tab(label='Summary')
             details_tab = dpg.add_tab(label='Details')
@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import subprocess
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import analysis_api
+import discovery
+import fast_python
+import features
+from lazy import lazy_import
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+lizard = lazy_import('lizard')
+pd = lazy_import('pandas')
+
+# The columns of the repository-level time series
+COMMIT_COLUMNS = ['commit', 'time', 'files', 'functions', 'nloc', 'CCN', 'func_token', 'Avg_CCN', 'Max_CCN',
+                  'Max_func_CCN']
+# Files larger than this many bytes are skipped, like `discovery.discover_files` does
+MAX_FILE_SIZE = discovery.MAX_FILE_SIZE
+
+
+@dataclass()
+class BlobAnalysis:
+    """The analysis of a single file's contents. Since it only depends on the contents, it is shared by
+    every commit and every path at which the same blob appears."""
+    nloc: int
+    CCN: int
+    func_token: int
+    functions: pd.DataFrame
+
+
+@dataclass()
+class History:
+    """Complexity metrics over a series of commits.
+
+    `commits` holds one row of repository-level metrics per commit, oldest first. The per-function
+    metrics are kept once per distinct blob, together with which blob each file had at each commit;
+    `functions` and `function_series` assemble per-function time series from those on demand.
+    """
+    commits: pd.DataFrame
+    # commit -> [(path, blob key)]
+    trees: dict[str, list[tuple[str, tuple[str, str]]]] = field(repr=False)
+    # (blob sha, language) -> analysis of that blob
+    blobs: dict[tuple[str, str], BlobAnalysis] = field(repr=False)
+
+    @property
+    def functions(self) -> pd.DataFrame:
+        """
+        :return: The metrics of every function at every analyzed commit, with the commit and the path
+            of the file in the `commit` and `file` columns. This can be large; see `function_series`
+        """
+        frames = [
+            self.blobs[blob].functions.assign(commit=commit, file=path)
+            for commit, files in self.trees.items()
+            for path, blob in files
+        ]
+        columns = ['commit', 'file'] + analysis_api.FUNCTION_COLUMNS
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)[columns]
+
+    def function_series(self, file: str, name: str) -> pd.DataFrame:
+        """
+        :param file: The path of the file, relative to the root of the repository
+        :param name: The (fully-qualified) name of the function
+        :return: The metrics of a single function at every analyzed commit at which it exists
+        """
+        frames = []
+        for commit, files in self.trees.items():
+            for path, blob in files:
+                if path == file:
+                    df = self.blobs[blob].functions
+                    frames.append(df[df.name == name].assign(commit=commit))
+        columns = ['commit'] + analysis_api.FUNCTION_COLUMNS
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)[columns]
+
+
+class BlobReader:
+    """Reads blobs out of a git repository through a single long-running `git cat-file --batch`"""
+    def __init__(self, git_dir: Union[str, Path]):
+        self.process = subprocess.Popen(['git', '--git-dir', str(git_dir), 'cat-file', '--batch'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, sha: str) -> bytes:
+        self.process.stdin.write(f"{sha}\n".encode())
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(sha)
+        size = int(header[2])
+        data = self.process.stdout.read(size)
+        # Every object is followed by a newline
+        self.process.stdout.read(1)
+        return data
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _git(git_dir: Union[str, Path], *args: str) -> str:
+    return subprocess.run(['git', '--git-dir', str(git_dir), *args], check=True, stdout=subprocess.PIPE,
+                          text=True).stdout
+
+
+def list_commits(git_dir: Union[str, Path], rev_range: str = None, every: int = 1,
+                 max_commits: int = None) -> list[tuple[str, int]]:
+    """
+    :param rev_range: The commits to include, e.g. `v1.0..v2.0`. Defaults to the entire history of HEAD
+    :param every: Only include every `every`th commit. The newest commit is always included
+    :param max_commits: Only include (at most) this many of the newest commits, after `every` is applied
+    :return: (commit, commit time) of the commits along the first-parent history, oldest first
+    """
+    lines = _git(git_dir, 'log', '--first-parent', '--reverse', '--format=%H %ct', rev_range or 'HEAD').split('\n')
+    commits = [(sha, int(time)) for sha, time in (line.split() for line in lines if line)]
+    # Counted back from the newest commit, so that it is always included
+    commits = commits[::-1][::every][::-1]
+    if max_commits is not None:
+        commits = commits[-max_commits:]
+    return commits
+
+
+def list_tree(git_dir: Union[str, Path], commit: str) -> list[tuple[str, str, int]]:
+    """
+    :return: (path, blob sha, size in bytes) of every file in the tree of `commit`, without checking it out
+    """
+    ret = []
+    output = _git(git_dir, 'ls-tree', '-r', '-z', '--long', '--full-tree', commit)
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        [info, path] = entry.split('\t', 1)
+        [_, kind, sha, size] = info.split()
+        if kind == 'blob':
+            ret.append((path, sha, int(size)))
+    return ret
+
+
+def analyze_blob(path: str, data: bytes, language: str, engine: str = 'lizard') -> BlobAnalysis:
+    """Analyzes the contents of a single file, like `analysis_api.ClonedRepo` does for a checked out file
+
+    :param engine: How Python files are analyzed, one of `analysis_api.ENGINES`
+    """
+    source = data.decode('utf-8', errors='replace')
+    is_python = language == 'python'
+    if is_python and engine == 'fast':
+        lizard_analysis = fast_python.analyze_source(source, path)
+    else:
+        lizard_analysis = lizard.analyze_file.analyze_source_code(path, source)
+    extra_analysis = features.FunctionStore()
+    if is_python:
+        try:
+            features.analyze_source(source, extra_analysis, path)
+        except SyntaxError:
+            # Old commits are more likely to contain code that no longer parses (e.g. Python 2)
+            extra_analysis = features.FunctionStore()
+    return BlobAnalysis(
+        nloc=lizard_analysis.nloc,
+        CCN=lizard_analysis.CCN,
+        func_token=lizard_analysis.token_count,
+        functions=analysis_api.function_frame(lizard_analysis, extra_analysis, is_python),
+    )
+
+
+def analyze_history(git_dir: Union[str, Path], rev_range: str = None, every: int = 1, max_commits: int = None,
+                    languages: Optional[Iterable[str]] = ('python',),
+                    blobs: dict[tuple[str, str], BlobAnalysis] = None, engine: str = 'lizard') -> History:
+    """Analyzes the complexity of a repository at a series of commits.
+
+    Trees are read straight out of the object database, nothing is checked out. Each distinct blob is
+    analyzed only once, no matter at how many commits or paths it appears; since most files don't
+    change between two commits, this makes every commit after the first one cheap.
+
+    :param git_dir: The `.git` directory of the repository, or a bare repository
+    :param rev_range: See `list_commits`
+    :param every: See `list_commits`
+    :param max_commits: See `list_commits`
+    :param languages: The languages to analyze, as lizard names them. `None` analyzes every supported language
+    :param blobs: Analyses of blobs from an earlier call, which are reused and added to
+    :param engine: How Python files are analyzed, one of `analysis_api.ENGINES`
+    :return: The metrics at every selected commit
+    """
+    languages = None if languages is None else set(languages)
+    blobs = {} if blobs is None else blobs
+    trees = {}
+    rows = []
+    with BlobReader(git_dir) as reader:
+        for commit, time in list_commits(git_dir, rev_range, every, max_commits):
+            files = []
+            for path, sha, size in list_tree(git_dir, commit):
+                language = discovery.language_of(path.rsplit('/', 1)[-1])
+                if language is None or (languages is not None and language not in languages):
+                    continue
+                # Remove __init__ files as they tend to throw off statistics
+                if path.rsplit('/', 1)[-1] == '__init__.py' or discovery.is_excluded(path) or size > MAX_FILE_SIZE:
+                    continue
+                key = (sha, language)
+                if key not in blobs:
+                    blobs[key] = analyze_blob(path, reader.read(sha), language, engine)
+                files.append((path, key))
+            trees[commit] = files
+
+            analyses = [blobs[key] for _, key in files]
+            file_ccns = [blob.CCN for blob in analyses]
+            rows.append([
+                commit,
+                pd.Timestamp(time, unit='s'),
+                len(analyses),
+                sum(len(blob.functions) for blob in analyses),
+                sum(blob.nloc for blob in analyses),
+                sum(file_ccns),
+                sum(blob.func_token for blob in analyses),
+                round(sum(file_ccns) / len(file_ccns), 2) if file_ccns else None,
+                max(file_ccns, default=None),
+                max((blob.functions['CCN'].max() for blob in analyses if len(blob.functions)), default=None),
+            ])
+    return History(commits=pd.DataFrame(data=rows, columns=COMMIT_COLUMNS), trees=trees, blobs=blobs)
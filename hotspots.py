@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import codecs
+import subprocess
+from bisect import bisect_right
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+import discovery
+import history
+from lazy import lazy_import
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Larger than any line number
+_END = 1 << 62
+FILE_COLUMNS = ['file', 'nloc', 'CCN', 'commits', 'added', 'deleted', 'score']
+FUNCTION_COLUMNS = ['file', 'name', 'start_line', 'nloc', 'CCN', 'commits', 'changed_lines', 'score']
+
+
+@dataclass()
+class Hotspots:
+    """Files and functions ranked by how often they change multiplied by their complexity.
+
+    `score` is `commits * CCN`: complex code that changes often is where refactoring pays off most.
+    Both frames are sorted by descending score.
+    """
+    commit: str
+    files: pd.DataFrame
+    functions: pd.DataFrame
+
+
+class LineMap:
+    """Maps the line numbers of one version of a file to the line numbers of the newest version.
+
+    The map is piecewise linear: line `x` in the segment starting at `starts[i]` maps to `x + offsets[i]`,
+    or to nothing if the offset is `None`, because the line was deleted by a newer commit.
+    """
+    __slots__ = ('starts', 'offsets')
+
+    def __init__(self):
+        self.starts = [1]
+        self.offsets: list[Optional[int]] = [0]
+
+    def map_range(self, lo: int, hi: int) -> Iterator[tuple[int, int]]:
+        """
+        :return: The ranges `[lo, hi)` of the newest version that the lines `[lo, hi)` map to
+        """
+        i = bisect_right(self.starts, lo) - 1
+        while i < len(self.starts) and self.starts[i] < hi:
+            end = self.starts[i + 1] if i + 1 < len(self.starts) else _END
+            offset = self.offsets[i]
+            if offset is not None:
+                yield max(lo, self.starts[i]) + offset, min(hi, end) + offset
+            i += 1
+
+    def step_back(self, hunks: list[tuple[int, int, int, int]]):
+        """Turns this into a map of the version before a commit, given the commit's hunks of this file
+
+        :param hunks: (old start, old count, new start, new count) of every hunk, as in `@@ -a,b +c,d @@`
+        """
+        # The map from the old version to the new version, in the same form
+        starts = []
+        offsets = []
+        pos = 1
+        delta = 0
+        for a, b, _, d in hunks:
+            if b > 0:
+                if a > pos:
+                    starts.append(pos)
+                    offsets.append(delta)
+                # The deleted lines don't exist in the new version
+                starts.append(a)
+                offsets.append(None)
+                pos = a + b
+            elif a + 1 > pos:
+                # Lines are inserted after line `a` of the old version
+                starts.append(pos)
+                offsets.append(delta)
+                pos = a + 1
+            delta += d - b
+        starts.append(pos)
+        offsets.append(delta)
+
+        # Compose it with this map
+        new_starts = []
+        new_offsets = []
+        for i, (start, offset) in enumerate(zip(starts, offsets)):
+            if offset is None:
+                new_starts.append(start)
+                new_offsets.append(None)
+                continue
+            end = starts[i + 1] if i + 1 < len(starts) else _END
+            j = bisect_right(self.starts, start + offset) - 1
+            while j < len(self.starts) and self.starts[j] < end + offset:
+                new_starts.append(max(start, self.starts[j] - offset))
+                new_offsets.append(None if self.offsets[j] is None else self.offsets[j] + offset)
+                j += 1
+
+        # Merge adjacent segments with the same offset
+        self.starts = []
+        self.offsets = []
+        for start, offset in zip(new_starts, new_offsets):
+            if self.offsets and self.offsets[-1] == offset:
+                continue
+            self.starts.append(start)
+            self.offsets.append(offset)
+
+
+@dataclass()
+class _FileChange:
+    """The change of a single file in a single commit"""
+    old_path: Optional[str] = None
+    new_path: Optional[str] = None
+    rename_from: Optional[str] = None
+    rename_to: Optional[str] = None
+    is_new: bool = False
+    hunks: list[tuple[int, int, int, int]] = None
+
+
+def _parse_range(text: bytes) -> tuple[int, int]:
+    [start, _, count] = text.partition(b',')
+    return int(start), int(count) if count else 1
+
+
+def _parse_path(line: bytes, prefix: str) -> Optional[str]:
+    """Parses the path out of a `--- a/path` or `+++ b/path` line"""
+    path = line[4:].rstrip(b'\n')
+    if path.startswith(b'"'):
+        # Paths with unusual characters are quoted C-style
+        path = codecs.escape_decode(path[1:-1])[0]
+    path = path.decode('utf-8', errors='replace')
+    if path == '/dev/null':
+        return None
+    return path[len(prefix):]
+
+
+def language_pathspecs(languages: Optional[Iterable[str]]) -> list[str]:
+    """
+    :return: Pathspecs matching the files of `languages`, or none if `languages` is `None`
+    """
+    if languages is None:
+        return []
+    return sorted(f"*.{ext}" for ext in discovery.extensions_of(languages))
+
+
+def stream_changes(git_dir: Union[str, Path], rev: str = 'HEAD', since: str = None,
+                   paths: Iterable[str] = ()) -> Iterator[tuple[str, int, list[_FileChange]]]:
+    """Streams the changes of every commit along the first-parent history of `rev`, newest first.
+
+    Only the hunk headers are kept; the changed lines themselves are skipped as they are read, so
+    this runs in constant memory however long the history is.
+
+    :param since: Only include commits after this date, in any format `git log --since` accepts
+    :param paths: Pathspecs to limit the changes to, e.g. `*.py`
+    :return: (commit, commit time, changed files) of every commit
+    """
+    args = ['git', '--git-dir', str(git_dir), '-c', 'core.quotePath=false', 'log', '--first-parent', '-m', '-M',
+            '-p', '-U0', '--no-color', '--no-ext-diff', '--format=%x00%H %ct']
+    if since is not None:
+        args.append(f"--since={since}")
+    args += [rev, '--', *paths]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=1 << 16)
+    commit = None
+    time = 0
+    changes: list[_FileChange] = []
+    change: Optional[_FileChange] = None
+    # The number of old and new lines left in the current hunk
+    old_left = new_left = 0
+    try:
+        for line in process.stdout:
+            if old_left or new_left:
+                if line[:1] == b'-':
+                    old_left -= 1
+                elif line[:1] == b'+':
+                    new_left -= 1
+                continue
+            if line[:1] == b'\0':
+                if commit is not None:
+                    yield commit, time, changes
+                [commit, time] = line[1:].split()
+                commit = commit.decode()
+                time = int(time)
+                changes = []
+                change = None
+            elif line.startswith(b'diff --git '):
+                change = _FileChange(hunks=[])
+                changes.append(change)
+            elif change is None:
+                continue
+            elif line.startswith(b'@@ '):
+                [_, old, new] = line.split(b' ', 3)[:3]
+                [a, b] = _parse_range(old[1:])
+                [c, d] = _parse_range(new[1:])
+                change.hunks.append((a, b, c, d))
+                old_left, new_left = b, d
+            elif line.startswith(b'--- '):
+                change.old_path = _parse_path(line, 'a/')
+            elif line.startswith(b'+++ '):
+                change.new_path = _parse_path(line, 'b/')
+            elif line.startswith(b'new file mode'):
+                change.is_new = True
+            elif line.startswith(b'rename from '):
+                change.rename_from = line[len('rename from '):].rstrip(b'\n').decode('utf-8', errors='replace')
+            elif line.startswith(b'rename to '):
+                change.rename_to = line[len('rename to '):].rstrip(b'\n').decode('utf-8', errors='replace')
+        if commit is not None:
+            yield commit, time, changes
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+class _FileState:
+    """The churn of a single file of the newest version, and of the functions in it"""
+    __slots__ = ('line_map', 'commits', 'added', 'deleted', 'starts', 'ends', 'func_commits', 'func_lines')
+
+    def __init__(self, functions: pd.DataFrame):
+        self.line_map = LineMap()
+        self.commits = 0
+        self.added = 0
+        self.deleted = 0
+        # The functions' lines are approximated as `[start_line, start_line + nloc)`
+        self.starts = functions['start_line'].to_numpy(dtype=np.int64)
+        self.ends = self.starts + functions['nloc'].to_numpy(dtype=np.int64)
+        self.func_commits = np.zeros(len(functions), dtype=np.int64)
+        self.func_lines = np.zeros(len(functions), dtype=np.int64)
+
+    def record(self, hunks: list[tuple[int, int, int, int]]):
+        """Records a commit that changed this file"""
+        self.commits += 1
+        ranges = []
+        for _, b, c, d in hunks:
+            self.added += d
+            self.deleted += b
+            # A pure deletion touches the lines around where the deleted lines used to be
+            ranges.extend(self.line_map.map_range(max(c, 1), c + max(d, 1)))
+        if ranges and len(self.starts):
+            [lo, hi] = np.array(ranges, dtype=np.int64).T
+            overlap = (np.minimum(hi[:, None], self.ends[None, :]) - np.maximum(lo[:, None], self.starts[None, :]))
+            overlap = np.clip(overlap, 0, None)
+            self.func_commits += overlap.any(axis=0)
+            self.func_lines += overlap.sum(axis=0)
+        self.line_map.step_back(hunks)
+
+
+def analyze_hotspots(git_dir: Union[str, Path], rev: str = 'HEAD', since: str = None,
+                     languages: Optional[Iterable[str]] = ('python',), engine: str = 'lizard') -> Hotspots:
+    """Ranks the files and functions of a repository by churn multiplied by complexity.
+
+    The complexity of the newest version is analyzed straight from the object database (see
+    `history.analyze_history`), then the history is read back in a single streamed `git log -p -U0` pass.
+    The hunk headers give the per-file line counts `git log --numstat` would, and the changed line ranges
+    are carried back through the history, so that changes in old commits are attributed to the functions
+    at their current position. Renames are followed. Memory is bounded by the size of the newest
+    version, not by the length of the history.
+
+    :param git_dir: The `.git` directory of the repository, or a bare repository
+    :param rev: The commit whose files and functions are ranked
+    :param since: Only count changes after this date, in any format `git log --since` accepts
+    :param languages: The languages to analyze, as lizard names them. `None` analyzes every supported language
+    :param engine: How Python files are analyzed, one of `analysis_api.ENGINES`
+    :return: The ranked files and functions
+    """
+    current = history.analyze_history(git_dir, rev, max_commits=1, languages=languages, engine=engine)
+    if current.commits.empty:
+        return Hotspots(commit=None, files=pd.DataFrame(columns=FILE_COLUMNS),
+                        functions=pd.DataFrame(columns=FUNCTION_COLUMNS))
+    commit = current.commits['commit'].iloc[-1]
+    files = dict(current.trees[commit])
+
+    states = {path: _FileState(current.blobs[key].functions) for path, key in files.items()}
+    # The path of each file at the commit being read -> its path in the newest version
+    tracked = {path: path for path in files}
+    for _, _, changes in stream_changes(git_dir, commit, since, language_pathspecs(languages)):
+        for change in changes:
+            path = change.rename_to or change.new_path
+            head_path = tracked.get(path)
+            if head_path is None:
+                continue
+            if change.hunks:
+                states[head_path].record(change.hunks)
+            if change.is_new:
+                # Older commits don't have this file
+                del tracked[path]
+            elif change.rename_from is not None:
+                del tracked[path]
+                tracked[change.rename_from] = head_path
+        if not tracked:
+            break
+
+    file_rows = []
+    function_frames = []
+    for path, state in states.items():
+        blob = current.blobs[files[path]]
+        file_rows.append([path, blob.nloc, blob.CCN, state.commits, state.added, state.deleted])
+        functions = blob.functions[['name', 'start_line', 'nloc', 'CCN']].assign(
+            file=path, commits=state.func_commits, changed_lines=state.func_lines)
+        function_frames.append(functions)
+
+    file_df = pd.DataFrame(data=file_rows, columns=FILE_COLUMNS[:-1])
+    file_df['score'] = file_df['commits'] * file_df['CCN']
+    if function_frames:
+        function_df = pd.concat(function_frames, ignore_index=True)
+    else:
+        function_df = pd.DataFrame(columns=FUNCTION_COLUMNS[:-1])
+    function_df['score'] = function_df['commits'] * function_df['CCN']
+    return Hotspots(
+        commit=commit,
+        files=file_df.sort_values('score', ascending=False, kind='stable', ignore_index=True)[FILE_COLUMNS],
+        functions=function_df.sort_values('score', ascending=False, kind='stable',
+                                          ignore_index=True)[FUNCTION_COLUMNS],
+    )
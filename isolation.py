@@ -0,0 +1,214 @@
+import math
+import multiprocessing
+import os
+import signal
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import wait
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where only the wall-clock budget is enforced
+    resource = None
+
+# The default budgets for a single file
+CPU_SECONDS = 60
+MEMORY_MB = 2048
+
+
+@dataclass()
+class Outcome:
+    """The outcome of running a task on a single item. Exactly one of `result` and `skipped` is set."""
+    item: Any
+    result: Any = None
+    skipped: Optional[str] = None
+
+
+def _worker_main(conn, func: Callable, cpu_seconds: Optional[int], memory_bytes: Optional[int]):
+    """The loop that runs inside every worker process"""
+    if resource is not None and memory_bytes is not None:
+        [_, hard] = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, hard))
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        if resource is not None and cpu_seconds is not None:
+            # The CPU limit counts the whole life of the process, so it is moved forward for every task.
+            # Going over it sends SIGXCPU, which kills the worker.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = math.ceil(usage.ru_utime + usage.ru_stime)
+            [_, hard] = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = used + cpu_seconds
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        try:
+            conn.send(('ok', func(item)))
+        except MemoryError:
+            # The worker may be in a bad state after running out of memory, so it is replaced
+            conn.send(('skipped', 'memory budget exceeded'))
+            return
+        except Exception as err:
+            conn.send(('skipped', f"failed: {type(err).__name__}: {err}"))
+
+
+class _Worker:
+    def __init__(self, pool: "BudgetPool"):
+        [self.conn, child_conn] = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, pool.func, pool.cpu_seconds, pool.memory_bytes),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.item = None
+        self.started = None
+
+    @property
+    def busy(self) -> bool:
+        return self.started is not None
+
+    def submit(self, item):
+        self.item = item
+        self.started = time.monotonic()
+        self.conn.send(item)
+
+    def finish(self):
+        item = self.item
+        self.item = None
+        self.started = None
+        return item
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def _death_reason(exitcode: Optional[int]) -> str:
+    if exitcode is not None and exitcode < 0:
+        if hasattr(signal, 'SIGXCPU') and -exitcode == signal.SIGXCPU:
+            return 'CPU time budget exceeded'
+        if -exitcode == signal.SIGKILL:
+            # The kernel's OOM killer is the usual culprit
+            return 'worker was killed (out of memory?)'
+        return f"worker crashed with signal {-exitcode}"
+    return f"worker crashed with exit code {exitcode}"
+
+
+class BudgetPool:
+    """Runs a function over many items (typically the files of a repository) in a pool of worker
+    processes, where every item gets its own CPU-time, memory and wall-clock budget.
+
+    An item that goes over its budget, or that makes its worker crash, is reported as skipped
+    together with a reason, and the worker is replaced. One pathological file can therefore never
+    hold up a whole repository for longer than its budget.
+
+    `func` must be picklable, i.e. defined at the top level of a module.
+    """
+    def __init__(self, func: Callable, workers: int = None, cpu_seconds: Optional[int] = CPU_SECONDS,
+                 memory_mb: Optional[int] = MEMORY_MB, wall_seconds: Optional[float] = None):
+        """
+        :param func: The function that is called on each item
+        :param workers: The number of worker processes. Defaults to the number of CPUs
+        :param cpu_seconds: The CPU time budget of each item, or `None` for no limit
+        :param memory_mb: The address space limit of each worker process in MiB, or `None` for no limit
+        :param wall_seconds: The wall-clock budget of each item. Defaults to twice the CPU budget, which
+            also catches items that block without using any CPU
+        """
+        self.func = func
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = None if memory_mb is None else memory_mb * 1024 * 1024
+        if wall_seconds is None and cpu_seconds is not None:
+            wall_seconds = 2 * cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.workers = [_Worker(self) for _ in range(workers or os.cpu_count() or 1)]
+
+    def _replace(self, i: int):
+        self.workers[i].kill()
+        self.workers[i] = _Worker(self)
+
+    def map(self, items: Iterable) -> Iterator[Outcome]:
+        """Runs `func` on every item. Outcomes are yielded as soon as they are available, which
+        is not necessarily in the order of `items`.
+
+        If the caller stops early (it breaks out of the loop, raises, or closes the generator), the
+        workers that are still busy are replaced, so that a later call never receives their results."""
+        pending = iter(items)
+        exhausted = False
+        try:
+            while True:
+                # Hand out work to every idle worker
+                for worker in self.workers:
+                    if exhausted or worker.busy:
+                        continue
+                    try:
+                        worker.submit(next(pending))
+                    except StopIteration:
+                        exhausted = True
+                busy = [i for i, worker in enumerate(self.workers) if worker.busy]
+                if not busy:
+                    return
+
+                timeout = None
+                if self.wall_seconds is not None:
+                    now = time.monotonic()
+                    deadline = min(self.workers[i].started for i in busy) + self.wall_seconds
+                    timeout = max(deadline - now, 0)
+                waitables = {}
+                for i in busy:
+                    waitables[self.workers[i].conn] = i
+                    waitables[self.workers[i].process.sentinel] = i
+                ready = {waitables[x] for x in wait(list(waitables), timeout)}
+
+                for i in busy:
+                    worker = self.workers[i]
+                    # Workers are replaced before their outcome is yielded, so that the pool is in order
+                    # whenever the caller has control
+                    if i in ready:
+                        try:
+                            [status, value] = worker.conn.recv()
+                        except (EOFError, OSError):
+                            worker.process.join()
+                            outcome = Outcome(worker.finish(), skipped=_death_reason(worker.process.exitcode))
+                            self._replace(i)
+                            yield outcome
+                            continue
+                        item = worker.finish()
+                        if status == 'ok':
+                            yield Outcome(item, result=value)
+                        else:
+                            if value == 'memory budget exceeded':
+                                self._replace(i)
+                            yield Outcome(item, skipped=value)
+                    elif self.wall_seconds is not None and time.monotonic() - worker.started >= self.wall_seconds:
+                        outcome = Outcome(worker.finish(), skipped='wall-clock budget exceeded')
+                        self._replace(i)
+                        yield outcome
+        finally:
+            for i, worker in enumerate(self.workers):
+                if worker.busy:
+                    self._replace(i)
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=1)
+            worker.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
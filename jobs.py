@@ -0,0 +1,251 @@
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, Text
+
+import results
+
+metadata = MetaData()
+
+# How long a claimed job stays leased to a worker without a heartbeat
+LEASE_SECONDS = 300
+# How often a worker renews the lease of the job it is working on
+HEARTBEAT_SECONDS = 60
+# How many times a job is tried before it is given up on
+MAX_ATTEMPTS = 3
+# How many queued jobs are looked at per attempt to claim one
+CLAIM_CANDIDATES = 8
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# One row per repository to analyze. A worker owns a job while `State` is `leased` and `Lease_expires`
+# is in the future; `Token` changes on every claim, so a worker whose lease expired and was claimed
+# by another worker can no longer renew or complete it.
+jobs = Table(
+    'Crawl_jobs', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('URL', String(255), nullable=False, unique=True),
+    Column('Language', String(32), nullable=False),
+    Column('State', String(16), nullable=False),
+    Column('Worker', String(128)),
+    Column('Token', String(32)),
+    Column('Lease_expires', DateTime),
+    Column('Attempts', Integer, nullable=False, default=0),
+    Column('Enqueued_at', DateTime),
+    Column('Finished_at', DateTime),
+    Column('Error', Text),
+    Index('Crawl_jobs_state', 'State', 'Lease_expires'),
+)
+
+
+def create_schema(engine: sqlalchemy.engine.Engine):
+    """Creates the `Crawl_jobs` table and its index, and the tables that workers write their results
+    to (see `results`), unless they already exist. This happens before any worker claims a job, so
+    that workers never race to create a table on their first write."""
+    try:
+        metadata.create_all(engine, checkfirst=True)
+    except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.ProgrammingError):
+        # Another worker process created them in the meantime
+        metadata.create_all(engine, checkfirst=True)
+    results.create_schema(engine)
+
+
+def _now() -> datetime:
+    # Every worker uses UTC, so that workers on hosts in different time zones agree on lease expiry
+    return datetime.utcnow().replace(microsecond=0)
+
+
+@dataclass()
+class Lease:
+    """A job claimed by a worker. `token` identifies this particular claim of the job."""
+    id: int
+    url: str
+    language: str
+    worker: str
+    token: str
+    attempt: int
+
+
+class LeaseLost(Exception):
+    """The lease of a job expired and the job was claimed by another worker"""
+
+
+class JobStore:
+    """A queue of repositories to analyze, shared by any number of worker processes on any number
+    of hosts through a database. Works with any database that SQLAlchemy supports; in particular
+    with MySQL and with an embedded SQLite file.
+
+    Workers `claim` a job, which leases it to them for `lease_seconds`, and keep renewing the lease
+    with `heartbeat` while they work on it. If a worker crashes or hangs, its lease runs out and the
+    job is claimed by another worker. Claims are a conditional `UPDATE` of a single row, so two
+    workers can never claim the same job, without locking anything for longer than one statement.
+    """
+    def __init__(self, engine: sqlalchemy.engine.Engine, lease_seconds: int = LEASE_SECONDS,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.engine = engine
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        create_schema(engine)
+
+    def enqueue(self, urls: Iterable[str], language: str) -> int:
+        """Adds repositories to the queue. Repositories that are already in it, whatever their
+        state, are left alone, so enqueueing the same repositories again is harmless.
+
+        :return: The number of repositories that were added
+        """
+        urls = list(dict.fromkeys(urls))
+        added = 0
+        with self.engine.connect() as conn:
+            existing = set()
+            for i in range(0, len(urls), 500):
+                query = sqlalchemy.select(jobs.c.URL).where(jobs.c.URL.in_(urls[i:i + 500]))
+                existing.update(conn.execute(query).scalars())
+            for url in urls:
+                if url in existing:
+                    continue
+                try:
+                    with conn.begin():
+                        conn.execute(jobs.insert().values(URL=url, Language=language, State=QUEUED, Attempts=0,
+                                                          Enqueued_at=_now()))
+                    added += 1
+                except sqlalchemy.exc.IntegrityError:
+                    # Enqueued by someone else in the meantime
+                    pass
+        return added
+
+    def _claimable(self, now: datetime):
+        return sqlalchemy.or_(
+            jobs.c.State == QUEUED,
+            sqlalchemy.and_(jobs.c.State == LEASED, jobs.c.Lease_expires < now),
+        )
+
+    def claim(self, worker: str) -> Optional[Lease]:
+        """Leases the oldest job that is queued, or whose lease expired, to `worker`
+
+        :return: The claimed job, or `None` if there is nothing to do
+        """
+        while True:
+            now = _now()
+            with self.engine.connect() as conn:
+                candidates = conn.execute(
+                    sqlalchemy.select(jobs.c.id).where(self._claimable(now)).order_by(jobs.c.id)
+                    .limit(CLAIM_CANDIDATES)
+                ).scalars().all()
+                if not candidates:
+                    return None
+                for job_id in candidates:
+                    token = uuid.uuid4().hex
+                    with conn.begin():
+                        claimed = conn.execute(
+                            jobs.update()
+                            .where(jobs.c.id == job_id, self._claimable(now))
+                            .values(State=LEASED, Worker=worker, Token=token, Attempts=jobs.c.Attempts + 1,
+                                    Lease_expires=now + timedelta(seconds=self.lease_seconds))
+                        ).rowcount
+                    if not claimed:
+                        # Another worker was faster
+                        continue
+                    row = conn.execute(sqlalchemy.select(jobs).where(jobs.c.id == job_id)).one()
+                    if row.Attempts > self.max_attempts:
+                        # The job keeps taking its workers down with it
+                        with conn.begin():
+                            conn.execute(jobs.update().where(jobs.c.id == job_id, jobs.c.Token == token)
+                                         .values(State=FAILED, Finished_at=now, Token=None,
+                                                 Error=row.Error or 'lease expired too many times'))
+                        continue
+                    return Lease(id=job_id, url=row.URL, language=row.Language, worker=worker, token=token,
+                                 attempt=row.Attempts)
+
+    def _owned(self, lease: Lease):
+        return sqlalchemy.and_(jobs.c.id == lease.id, jobs.c.State == LEASED, jobs.c.Token == lease.token)
+
+    def heartbeat(self, lease: Lease):
+        """Extends the lease of a job
+
+        :raise LeaseLost: if the job was claimed by another worker in the meantime
+        """
+        with self.engine.begin() as conn:
+            renewed = conn.execute(
+                jobs.update().where(self._owned(lease))
+                .values(Lease_expires=_now() + timedelta(seconds=self.lease_seconds))
+            ).rowcount
+        if not renewed:
+            raise LeaseLost(lease.url)
+
+    def complete(self, lease: Lease, conn: sqlalchemy.engine.Connection):
+        """Marks a job as done, as part of the transaction on `conn` that writes its results. If the
+        lease was lost, this raises, so that the transaction is rolled back and only the worker that
+        currently holds the lease ever commits results for the job.
+
+        :raise LeaseLost: if the job was claimed by another worker in the meantime
+        """
+        done = conn.execute(
+            jobs.update().where(self._owned(lease))
+            .values(State=DONE, Finished_at=_now(), Lease_expires=None, Token=None, Error=None)
+        ).rowcount
+        if not done:
+            raise LeaseLost(lease.url)
+
+    def fail(self, lease: Lease, error: str):
+        """Gives a job back after it failed. It is queued again, unless it has failed `max_attempts` times"""
+        state = FAILED if lease.attempt >= self.max_attempts else QUEUED
+        with self.engine.begin() as conn:
+            conn.execute(
+                jobs.update().where(self._owned(lease))
+                .values(State=state, Lease_expires=None, Token=None, Error=error[-2000:],
+                        Finished_at=_now() if state == FAILED else None)
+            )
+
+    def release(self, lease: Lease):
+        """Gives a job back without counting it as an attempt, e.g. when a worker is shut down"""
+        with self.engine.begin() as conn:
+            conn.execute(
+                jobs.update().where(self._owned(lease))
+                .values(State=QUEUED, Lease_expires=None, Token=None, Attempts=jobs.c.Attempts - 1)
+            )
+
+    def counts(self) -> dict[str, int]:
+        """
+        :return: The number of jobs in every state
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(sqlalchemy.select(jobs.c.State, sqlalchemy.func.count()).group_by(jobs.c.State))
+            return {state: count for state, count in rows}
+
+
+class Heartbeat:
+    """Renews the lease of a job in a background thread while it is being worked on. If the lease
+    is lost anyway, `lost` is set, so that the worker can stop early."""
+    def __init__(self, store: JobStore, lease: Lease, interval: float = HEARTBEAT_SECONDS):
+        self.store = store
+        self.lease = lease
+        self.interval = interval
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.store.heartbeat(self.lease)
+            except LeaseLost:
+                self.lost.set()
+                return
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                # The database might only be unreachable for a moment; the lease has some slack
+                print(f"Could not renew the lease of {self.lease.url}: {e}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stopped.set()
+        self.thread.join()
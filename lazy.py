@@ -0,0 +1,25 @@
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Imports a module lazily: the returned module is only actually loaded the first time one of
+    its attributes is used. This keeps heavy dependencies like pandas out of the start-up time of
+    entry points that might never need them.
+
+    For example, `pd = lazy_import('pandas')` can be used exactly like `import pandas as pd`.
+    Modules that use lazily imported names in type annotations should start with
+    `from __future__ import annotations`, so that the annotations don't trigger the import.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
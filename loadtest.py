@@ -0,0 +1,388 @@
+"""Measures the crawl pipeline (scraper -> `connect.py` -> `analyze.goes_through` -> database) under load,
+without any network access.
+
+Usage: python loadtest.py [options], see python loadtest.py --help
+
+Everything runs in this process, against stand-ins for what is outside of it:
+
+- a stub of the GitHub search API, with a configurable latency and rate limit,
+- synthetic git repositories in a scratch directory, which git fetches instead of github.com, by way of
+  `url.<base>.insteadOf` in the environment,
+- an SQLite database instead of MySQL.
+
+The real scraper and `connect.py` apps are served on local ports, and crawls are started at a fixed
+rate. Once every repository that was found has been stored, or the timeout expires, the throughput,
+the growth of the analysis queue and the latency of every stage (see `timing`) are reported.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import settings
+import timing
+
+# The stages that are reported, in pipeline order: (name, description)
+STAGES = [
+    ('crawl', 'crawl (one scraper request)'),
+    ('search', 'search API request'),
+    ('post', 'POST /repos'),
+    ('queue_wait', 'waiting in the queue'),
+    ('dedup', 'duplicate check'),
+    ('analyze', 'checkout and analysis'),
+    ('store', 'writing results'),
+    ('end_to_end', 'found -> stored'),
+]
+
+
+def generate_source(rng: random.Random, functions: int) -> str:
+    """
+    :return: A Python module with `functions` functions of random length and complexity
+    """
+    lines = []
+    for i in range(functions):
+        lines.append(f"def function_{i}(x, y):")
+        lines.append("    total = 0")
+        for j in range(rng.randint(0, 12)):
+            kind = rng.choice(('if', 'for', 'while', 'plain'))
+            if kind == 'if':
+                lines.append(f"    if x > {j} and y < {j * 2}:")
+                lines.append(f"        total += {j}")
+            elif kind == 'for':
+                lines.append(f"    for i in range({j}):")
+                lines.append("        total += i * x")
+            elif kind == 'while':
+                lines.append(f"    while total < {j * 10}:")
+                lines.append("        total += y or 1")
+            else:
+                lines.append(f"    total = total * {j} + x - y")
+        lines.append("    return total")
+        lines.append("")
+    return '\n'.join(lines)
+
+
+def create_repos(root: Path, count: int, files: int, seed: int = 0) -> list[str]:
+    """Creates `count` git repositories with `files` Python files each under `root/<user>/<repo>`
+
+    :return: The GitHub URLs that stand for the repositories
+    """
+    rng = random.Random(seed)
+    urls = []
+    env = dict(os.environ, GIT_AUTHOR_NAME='loadtest', GIT_AUTHOR_EMAIL='loadtest@localhost',
+               GIT_COMMITTER_NAME='loadtest', GIT_COMMITTER_EMAIL='loadtest@localhost')
+    for i in range(count):
+        user_name = f"user{i % 10}"
+        repo_name = f"repo{i}"
+        path = root / user_name / repo_name
+        for j in range(files):
+            file = path / f"package{j % 3}" / f"module{j}.py"
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(generate_source(rng, rng.randint(1, 20)))
+        subprocess.run(['git', 'init', '--quiet', str(path)], check=True, env=env)
+        subprocess.run(['git', 'add', '--all'], cwd=path, check=True, env=env)
+        subprocess.run(['git', 'commit', '--quiet', '--message', 'Initial commit'], cwd=path, check=True, env=env)
+        urls.append(f"https://github.com/{user_name}/{repo_name}")
+    return urls
+
+
+class StubGitHub(ThreadingHTTPServer):
+    """Answers repository searches like the GitHub search API does, from a fixed list of repositories.
+
+    Every distinct query gets the next `per_query` repositories of the list, which wraps around, so
+    that later queries find some repositories again. Every request takes `latency` seconds. At most
+    `rate_limit` requests are answered per `rate_window` seconds; the rest are refused the way GitHub
+    refuses them, with a 403 and the time the limit is reset.
+    """
+    daemon_threads = True
+
+    def __init__(self, urls: list[str], per_query: int, latency: float, rate_limit: int, rate_window: float):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+        self.urls = urls
+        self.per_query = per_query
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.queries: dict[str, int] = {}
+        self.window_start = time.time()
+        self.window_requests = 0
+        self.requests = 0
+        self.refused = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def admit(self):
+        """
+        :return: `None` if a request can be answered, otherwise when the rate limit is reset
+        """
+        with self.lock:
+            self.requests += 1
+            now = time.time()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_requests = 0
+            if self.rate_limit and self.window_requests >= self.rate_limit:
+                self.refused += 1
+                return self.window_start + self.rate_window
+            self.window_requests += 1
+            return None
+
+    def search(self, query: str, page: int, per_page: int) -> dict:
+        with self.lock:
+            slot = self.queries.setdefault(query, len(self.queries))
+        found = [self.urls[(slot * self.per_query + i) % len(self.urls)] for i in range(self.per_query)]
+        return {
+            'total_count': len(found),
+            'incomplete_results': False,
+            'items': [{'html_url': url, 'updated_at': '2024-01-01T00:00:00Z'}
+                      for url in found[(page - 1) * per_page:page * per_page]],
+        }
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    server: StubGitHub
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        reset = self.server.admit()
+        if reset is not None:
+            self._reply(403, {'message': 'API rate limit exceeded'},
+                        {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(reset))})
+            return
+        url = urlsplit(self.path)
+        if url.path != '/search/repositories':
+            # e.g. the git trees API, see `dedup.github_tree`
+            self._reply(404, {'message': 'Not Found'})
+            return
+        params = parse_qs(url.query)
+        query = params.get('q', [''])[0]
+        page = int(params.get('page', ['1'])[0])
+        per_page = int(params.get('per_page', ['30'])[0])
+        self._reply(200, self.server.search(query, page, per_page))
+
+    def _reply(self, status: int, data: dict, headers: dict = None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+class Recorder:
+    """Collects what `timing` reports"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: dict[str, list[float]] = {}
+        self.events: dict[str, dict[str, float]] = {}
+        self.rate_limited = 0
+
+    def __call__(self, name: str, start: float, duration, fields: dict):
+        with self.lock:
+            if duration is not None:
+                self.stages.setdefault(name, []).append(duration)
+            elif name == 'rate_limited':
+                self.rate_limited += 1
+            else:
+                # The first time every repository reached every point
+                self.events.setdefault(name, {}).setdefault(fields['url'], start)
+
+    def urls(self, event: str) -> set[str]:
+        with self.lock:
+            return set(self.events.get(event, {}))
+
+    def between(self, first: str, then: str) -> list[float]:
+        """
+        :return: How long it took every repository to get from event `first` to event `then`
+        """
+        with self.lock:
+            a = self.events.get(first, {})
+            b = self.events.get(then, {})
+            return [b[url] - a[url] for url in b if url in a]
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def serve(app):
+    """Serves a Flask app on a free local port in a background thread"""
+    import logging
+    from werkzeug.serving import make_server
+    # Not every request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_config(directory: Path, stub: StubGitHub, analyzer_port: int, workers: int):
+    """Writes the `config.yml` of the load test and makes `settings` read it"""
+    keys = {
+        'GITHUB_USER': 'loadtest',
+        'GITHUB_TOKEN': 'loadtest',
+        'DB_USER': None,
+        'DB_PASSWORD': None,
+        'DB_HOST': None,
+        'DB_NAME': None,
+        'DB_URL': f"sqlite:///{directory / 'cca.db'}",
+        'ANALYSIS_WORKERS': workers,
+        'CACHE_DIR': str(directory / 'cache'),
+        'GITHUB_API_URL': stub.url,
+        'ANALYZER_URL': f"http://127.0.0.1:{analyzer_port}/repos",
+        'CRAWL_PAUSE_SECONDS': 0,
+        'QUEUE_LOG': str(directory / 'log.json'),
+        'CRAWL_CHECKPOINT': str(directory / 'crawl_checkpoint.json'),
+    }
+    import yaml
+    path = directory / 'config.yml'
+    with open(path, 'w') as f:
+        yaml.dump({'Keys': keys}, f)
+    settings.CONFIG_PATH = str(path)
+    settings.keys.cache_clear()
+
+
+def redirect_github(repos: Path):
+    """Makes git fetch `https://github.com/<user>/<repo>` from `repos/<user>/<repo>`, for this process and
+    every process it starts"""
+    i = int(os.environ.get('GIT_CONFIG_COUNT', 0))
+    os.environ[f"GIT_CONFIG_KEY_{i}"] = f"url.{repos.as_uri()}/.insteadOf"
+    os.environ[f"GIT_CONFIG_VALUE_{i}"] = 'https://github.com/'
+    os.environ['GIT_CONFIG_COUNT'] = str(i + 1)
+
+
+def report(args, recorder: Recorder, stub: StubGitHub, depths: list[tuple[float, int]], started: float,
+           crawled: float, finished: float):
+    enqueued = recorder.urls('enqueued')
+    done = recorder.urls('done')
+    found = recorder.urls('discovered')
+    elapsed = finished - started
+    print()
+    print(f"Crawls:       {args.crawls} in {crawled - started:.1f} s, {stub.requests} GitHub API requests, "
+          f"{stub.refused} refused by the rate limit")
+    print(f"Repositories: {len(found)} found, {len(enqueued)} queued, {len(done)} stored in {elapsed:.1f} s")
+    print(f"Throughput:   {len(done) / elapsed:.2f} repositories/s, {len(done) * args.files / elapsed:.1f} files/s")
+    if depths:
+        # The queue is empty when the first crawl starts
+        during_crawl = [(started, 0)] + [(t, depth) for t, depth in depths if t <= crawled]
+        growth = (during_crawl[-1][1] - during_crawl[0][1]) / max(during_crawl[-1][0] - during_crawl[0][0], 1e-9)
+        print(f"Queue:        at most {max(depth for _, depth in depths)} repositories, {depths[-1][1]} at the end, "
+              f"grew by {growth:.2f} repositories/s while crawling")
+        step = max(len(depths) // 20, 1)
+        print("Queue depth:  " + ' '.join(f"{t - started:.0f}s:{depth}" for t, depth in depths[::step]))
+    latencies = dict(recorder.stages)
+    latencies['queue_wait'] = recorder.between('enqueued', 'dequeued')
+    latencies['end_to_end'] = recorder.between('discovered', 'done')
+    print()
+    print(f"{'Stage':<30}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, description in STAGES:
+        values = latencies.get(name)
+        if not values:
+            continue
+        print(f"{description:<30}{len(values):>7}" + ''.join(
+            f"{percentile(values, q) * 1000:>10.0f}" for q in (0.5, 0.9, 0.99, 1)))
+    lost = found - enqueued
+    if lost:
+        print(f"\n{len(lost)} repositories were found but never queued")
+    if enqueued - done:
+        print(f"{len(enqueued - done)} repositories were still being analyzed when the load test stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repos', type=int, default=40, help="synthetic repositories to create")
+    parser.add_argument('--files', type=int, default=20, help="Python files per repository")
+    parser.add_argument('--per-query', type=int, default=10, help="repositories found by every search query")
+    parser.add_argument('--crawls', type=int, default=4, help="crawls (scraper requests) to start")
+    parser.add_argument('--rate', type=float, default=1.0, help="crawls started per second")
+    parser.add_argument('--years', type=int, default=1, help="years (search queries) per crawl")
+    parser.add_argument('--latency-ms', type=float, default=50, help="latency of every search API request")
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help="search API requests allowed per --rate-window, 0 for no limit")
+    parser.add_argument('--rate-window', type=float, default=60, help="seconds per rate limit window")
+    parser.add_argument('--workers', type=int, default=2, help="analysis worker processes")
+    parser.add_argument('--interval', type=float, default=0.5, help="seconds between queue depth samples")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds to wait for the analyses")
+    parser.add_argument('--directory', help="where to put the repositories and the database, kept afterwards. "
+                                            "Defaults to a temporary directory")
+    args = parser.parse_args()
+
+    directory = Path(args.directory or tempfile.mkdtemp(prefix='cca-loadtest-')).resolve()
+    directory.mkdir(parents=True, exist_ok=True)
+    print(f"Creating {args.repos} repositories with {args.files} files each in {directory}")
+    urls = create_repos(directory / 'repos', args.repos, args.files)
+    redirect_github(directory / 'repos')
+
+    stub = StubGitHub(urls, args.per_query, args.latency_ms / 1000, args.rate_limit, args.rate_window)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    import analyze
+    import connect
+    import scraper
+    # In production the scraper and `connect.py` are separate processes; here they would import these
+    # from several threads at once
+    import dedup
+    import function_store
+    import pandas
+    analyzer = serve(connect.app)
+    crawler = serve(scraper.app)
+    write_config(directory, stub, analyzer.server_port, args.workers)
+
+    recorder = Recorder()
+    timing.hooks.append(recorder)
+    threading.Thread(target=analyze.goes_through, args=(connect.q, None), daemon=True).start()
+
+    depths = []
+    stopped = threading.Event()
+
+    def sample_queue():
+        while not stopped.wait(args.interval):
+            depths.append((time.perf_counter(), connect.q.qsize()))
+    threading.Thread(target=sample_queue, daemon=True).start()
+
+    import requests
+
+    def crawl(i):
+        # Every crawl searches for different repositories, since its queries differ in the number of stars
+        with timing.stage('crawl'):
+            requests.get(f"http://127.0.0.1:{crawler.server_port}/python/{i}/0/{args.years}/")
+    print(f"Starting {args.crawls} crawls, {args.rate} per second")
+    started = time.perf_counter()
+    crawls = []
+    for i in range(args.crawls):
+        time.sleep(max(started + i / args.rate - time.perf_counter(), 0))
+        crawls.append(threading.Thread(target=crawl, args=(i,), daemon=True))
+        crawls[-1].start()
+    for thread in crawls:
+        thread.join()
+    crawled = time.perf_counter()
+    while time.perf_counter() - started < args.timeout and recorder.urls('enqueued') - recorder.urls('done'):
+        time.sleep(0.1)
+    finished = time.perf_counter()
+    stopped.set()
+    depths.append((finished, connect.q.qsize()))
+
+    report(args, recorder, stub, depths, started, crawled, finished)
+    if not args.directory:
+        shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(0 if not recorder.urls('enqueued') - recorder.urls('done') else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""A cache of bare mirrors of remote repositories, and a scratch area for their working copies.
+
+Analyzing a repository that was analyzed before costs an incremental `git fetch` instead of a full clone.
+Working copies are written from a mirror's object database without any network access, each into a
+directory of its own, so any number of processes can check out the same repository at the same time.
+Mirrors and working copies share a disk quota; when it is exceeded, working copies left behind by
+processes that died are removed first, then the least recently used mirrors.
+
+The scratch area can be put somewhere else than the mirrors, e.g. on a tmpfs such as `/dev/shm`,
+since working copies are only read once and then removed.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import settings
+
+try:
+    import fcntl
+except ImportError:
+    # Without `fcntl` (i.e. on Windows), a cache must not be shared by several processes
+    fcntl = None
+
+# The default disk quota of a cache, for its mirrors and working copies together
+QUOTA_BYTES = 20 * 1024 ** 3
+# Working copies without a lock file that are older than this are left over from a crash
+ABANDONED_SECONDS = 3600
+
+
+def _key(url: str) -> str:
+    """
+    :return: A directory name that is unique to `url`, but still recognizable
+    """
+    slug = re.sub(r'[^A-Za-z0-9._-]+', '_', '_'.join(url.rstrip('/').rsplit('/', 2)[1:]))[:64]
+    return f"{slug}-{hashlib.sha256(url.encode()).hexdigest()[:12]}"
+
+
+def _git(*args: str, **kwargs) -> str:
+    return subprocess.run(['git', *args], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                          **kwargs).stdout
+
+
+def _size(path: Path) -> int:
+    """
+    :return: The number of bytes taken up by the files under `path`
+    """
+    ret = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                ret += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return ret
+
+
+def _remove(path: Path):
+    # Git makes its objects read-only, see `analysis_api.remove_readonly`
+    def remove_readonly(f, p, _):
+        os.chmod(p, 0o700)
+        f(p)
+    shutil.rmtree(path, onerror=remove_readonly)
+
+
+def resolve_head(url: str) -> str:
+    """
+    :return: The commit that HEAD of the remote repository at `url` currently points to
+    :raise ValueError: if `url` is not a git repository, or if it has no commits
+    """
+    # `--` keeps a URL like `--upload-pack=...` from being taken as an option
+    result = subprocess.run(['git', 'ls-remote', '--', url, 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            text=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        raise ValueError(f"{url} is not a git repository with any commits")
+    return result.stdout.split()[0]
+
+
+class _Lock:
+    """An advisory lock on a file, which is released when the process holding it dies"""
+    def __init__(self, path: Path):
+        self.fp = open(path, 'a+')
+
+    def acquire(self, shared: bool = False, blocking: bool = True) -> bool:
+        if fcntl is None:
+            return True
+        flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(self.fp, flags)
+        except BlockingIOError:
+            return False
+        return True
+
+    def close(self):
+        # Closing the file releases the lock
+        self.fp.close()
+
+
+@dataclass()
+class Checkout:
+    """A working copy of a repository in the scratch area. `release` removes it."""
+    path: Path
+    git_dir: Path
+    commit: Optional[str]
+    _lock: _Lock = None
+
+    def release(self):
+        if self._lock is None:
+            return
+        _remove(self.path.parent.parent)
+        os.remove(f"{self.path.parent.parent}.lock")
+        self._lock.close()
+        self._lock = None
+
+    def __enter__(self) -> Checkout:
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
+class MirrorCache:
+    """Bare mirrors in `root/mirrors` and working copies in `root/scratch` (or in `scratch_dir`).
+
+    Every mirror has a lock file next to it: it is locked exclusively while the mirror is cloned or
+    fetched, and shared while a working copy is read out of it, so that it isn't evicted in the
+    meantime. Its modification time records when the mirror was last used. Every working copy also
+    has a lock file, which is held for as long as the working copy is in use.
+    """
+    def __init__(self, root: Union[str, Path], scratch_dir: Union[str, Path] = None, quota_bytes: int = QUOTA_BYTES):
+        self.mirror_dir = Path(root) / 'mirrors'
+        self.scratch_dir = Path(scratch_dir) if scratch_dir else Path(root) / 'scratch'
+        self.quota_bytes = quota_bytes
+        self.mirror_dir.mkdir(parents=True, exist_ok=True)
+        self.scratch_dir.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[Path, Path]:
+        key = _key(url)
+        return self.mirror_dir / f"{key}.git", self.mirror_dir / f"{key}.lock"
+
+    def _update(self, url: str, path: Path, fetch: bool):
+        """Clones the mirror of `url`, or fetches what changed since it was last updated. Must hold
+        the mirror's lock exclusively."""
+        if path.exists():
+            if fetch:
+                _git('--git-dir', str(path), 'fetch', '--quiet', '--prune', '--tags', 'origin')
+                (path / 'cca-size').write_text(str(_size(path)))
+            return
+        # Cloned under a temporary name, so that a clone that was interrupted is never mistaken for a mirror
+        temp_path = path.with_name(f"{path.name}.tmp")
+        if temp_path.exists():
+            _remove(temp_path)
+        _git('clone', '--quiet', '--bare', '--', url, str(temp_path))
+        # Only branches and tags are kept up to date, not e.g. the pull requests GitHub advertises
+        _git('--git-dir', str(temp_path), 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*')
+        (temp_path / 'cca-size').write_text(str(_size(temp_path)))
+        os.rename(temp_path, path)
+
+    @contextmanager
+    def mirror(self, url: str, fetch: bool = True) -> Iterator[Path]:
+        """Provides an up-to-date bare mirror of the repository at `url`, which isn't evicted until the
+        context is exited
+
+        :param fetch: If an existing mirror should be updated. Without it, the mirror is only cloned if it is missing
+        """
+        path, lock_path = self._paths(url)
+        lock = _Lock(lock_path)
+        try:
+            lock.acquire()
+            self._update(url, path, fetch)
+            os.utime(lock_path)
+            # Other processes can read the mirror as well, just not update or evict it
+            lock.acquire(shared=True)
+            yield path
+        finally:
+            lock.close()
+        self.evict()
+
+    def checkout(self, url: str, rev: str = 'HEAD') -> Checkout:
+        """Writes a working copy of a repository to a directory of its own in the scratch area. Only its
+        files are written; its history stays in the mirror at `Checkout.git_dir`.
+
+        :param rev: The commit to check out
+        :return: The working copy at `scratch/<unique name>/<user>/<repo>`, which must be released once it isn't
+            needed anymore
+        :raise subprocess.CalledProcessError: if `url` is not a git repository
+        """
+        [user_name, repo_name] = url.rstrip('/').rsplit('/', 2)[1:]
+        lock_fd, lock_path = tempfile.mkstemp(prefix=f"{_key(url)}-", suffix='.lock', dir=self.scratch_dir)
+        os.close(lock_fd)
+        lock = _Lock(Path(lock_path))
+        lock.acquire()
+        work_dir = Path(lock_path[:-len('.lock')])
+        path = work_dir / user_name / repo_name
+        path.mkdir(parents=True)
+        try:
+            with self.mirror(url) as git_dir:
+                commit = self._resolve(git_dir, rev)
+                if commit is not None:
+                    # With an index of its own, so that checkouts of the same mirror never collide
+                    env = dict(os.environ, GIT_INDEX_FILE=str(work_dir / 'index'))
+                    _git('--git-dir', str(git_dir), '--work-tree', str(path), 'read-tree', '--reset', '-u', commit,
+                         env=env)
+        except BaseException:
+            Checkout(path, git_dir=None, commit=None, _lock=lock).release()
+            raise
+        return Checkout(path, git_dir, commit, lock)
+
+    @staticmethod
+    def _resolve(git_dir: Path, rev: str) -> Optional[str]:
+        """
+        :return: The commit `rev` points to, or `None` if it doesn't exist, e.g. in an empty repository
+        """
+        result = subprocess.run(['git', '--git-dir', str(git_dir), 'rev-parse', '--verify', '--quiet',
+                                 f"{rev}^{{commit}}"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    def usage(self) -> int:
+        """
+        :return: The number of bytes taken up by the mirrors and the working copies
+        """
+        ret = 0
+        for entry in self.mirror_dir.glob('*.git'):
+            try:
+                ret += int((entry / 'cca-size').read_text())
+            except (OSError, ValueError):
+                ret += _size(entry)
+        return ret + _size(self.scratch_dir)
+
+    def evict(self):
+        """Removes abandoned working copies and the least recently used mirrors until the cache fits its quota"""
+        usage = self.usage()
+        if usage <= self.quota_bytes:
+            return
+        now = time.time()
+        for entry in sorted(self.scratch_dir.iterdir()):
+            if not entry.is_dir():
+                continue
+            lock_path = Path(f"{entry}.lock")
+            if not lock_path.exists():
+                if now - entry.stat().st_mtime > ABANDONED_SECONDS:
+                    _remove(entry)
+                continue
+            lock = _Lock(lock_path)
+            try:
+                if lock.acquire(blocking=False):
+                    # The process that checked it out is gone
+                    _remove(entry)
+                    os.remove(lock_path)
+            finally:
+                lock.close()
+        usage = self.usage()
+
+        def last_used(path: Path) -> float:
+            try:
+                return path.with_suffix('.lock').stat().st_mtime
+            except OSError:
+                return 0
+        for path in sorted(self.mirror_dir.glob('*.git'), key=last_used):
+            if usage <= self.quota_bytes:
+                break
+            lock = _Lock(path.with_suffix('.lock'))
+            try:
+                if not lock.acquire(blocking=False):
+                    # In use
+                    continue
+                size = _size(path)
+                _remove(path)
+                usage -= size
+            finally:
+                lock.close()
+
+
+@lru_cache(maxsize=None)
+def default_cache() -> MirrorCache:
+    """The cache set up by the optional `CACHE_DIR`, `SCRATCH_DIR` and `CACHE_QUOTA_MB` keys of `config.yml`.
+    Without a `config.yml`, or without those keys, it is at `cache` in the working directory."""
+    try:
+        config = settings.keys()
+    except OSError:
+        config = {}
+    quota_mb = config.get('CACHE_QUOTA_MB')
+    return MirrorCache(
+        config.get('CACHE_DIR') or Path(os.getcwd()) / 'cache',
+        config.get('SCRATCH_DIR'),
+        quota_mb * 1024 ** 2 if quota_mb else QUOTA_BYTES,
+    )
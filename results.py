@@ -0,0 +1,81 @@
+"""The tables that the summary of every analyzed repository is written to, see `analyze.get_average`.
+
+pandas' `to_sql` would create these tables on the first write, but then several workers that write
+their first results at the same time race to create them. So they are defined here, and created by
+`create_schema` before any worker claims a job (see `jobs.create_schema`).
+"""
+import sqlalchemy
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Float, Index, Integer, MetaData, String, Table, Text
+
+metadata = MetaData()
+
+# One row per analysis of a repository
+repos = Table(
+    'Repos', metadata,
+    Column('Time', DateTime),
+    Column('URL', String(255)),
+    Column('User_name', String(255)),
+    Column('Repo_name', String(255)),
+    Column('Total_File_Num', Integer),
+    Column('Avg_nloc', Float),
+    Column('Total_LOC', BigInteger),
+    Column('Avg_CCN', Float),
+    Column('Max_CCN', Integer),
+    Column('Avg_func_token', Float),
+    Index('Repos_URL', 'URL'),
+)
+
+# The CCN distributions of a repository, next to its `Repos` row, see `sketch.RepoSketch`
+repo_sketches = Table(
+    'Repo_sketches', metadata,
+    Column('Time', DateTime),
+    Column('URL', String(255)),
+    Column('Total_File_Num', Integer),
+    Column('Total_Func_Num', Integer),
+    Column('P50_CCN', Float),
+    Column('P90_CCN', Float),
+    Column('P99_CCN', Float),
+    Column('P50_func_CCN', Float),
+    Column('P90_func_CCN', Float),
+    Column('P99_func_CCN', Float),
+    Column('Sketch', Text),
+    Index('Repo_sketches_URL', 'URL'),
+)
+
+# The files of a repository that went over their analysis budget, see `isolation.BudgetPool`
+skipped_files = Table(
+    'Skipped_files', metadata,
+    Column('Time', DateTime),
+    Column('URL', String(255)),
+    Column('File', Text),
+    Column('Reason', Text),
+    Index('Skipped_files_URL', 'URL'),
+)
+
+# The estimated statistics of a repository, from a sample of its files (see `sampling.Estimate.summary`),
+# if the crawler estimates repositories before analyzing them, see `analyze.estimate_repo`
+repo_estimates = Table(
+    'Repo_estimates', metadata,
+    Column('Time', DateTime),
+    Column('URL', String(255)),
+    Column('Total_File_Num', Integer),
+    Column('Sampled_File_Num', Integer),
+    *(Column(f"{name}{suffix}", Float) for name in ('Avg_nloc', 'Total_LOC', 'Avg_CCN', 'Avg_func_token')
+      for suffix in ('', '_low', '_high')),
+    Column('Max_CCN', Integer),
+    Column('Confidence', Float),
+    Column('Reason', String(16)),
+    # If the repository was analyzed in full after it was estimated, rather than skipped
+    Column('Analyzed', Boolean),
+    Index('Repo_estimates_URL', 'URL'),
+)
+
+
+def create_schema(engine: sqlalchemy.engine.Engine):
+    """Creates the `Repos`, `Repo_sketches`, `Skipped_files` and `Repo_estimates` tables and their
+    indexes, unless they already exist"""
+    try:
+        metadata.create_all(engine, checkfirst=True)
+    except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.ProgrammingError):
+        # Another worker process created them in the meantime
+        metadata.create_all(engine, checkfirst=True)
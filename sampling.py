@@ -0,0 +1,277 @@
+"""Estimates the statistics of a repository from a stratified random sample of its files.
+
+Files are grouped into strata by their top-level directory and by their size, since both tend to go
+along with how complex a file is. Files are drawn from every stratum in proportion to its number of
+files, and the per-file means are estimated with the usual stratified estimator, whose variance only
+depends on how much files vary within their stratum. Sampling stops as soon as the confidence
+interval of every metric in `PRECISION_METRICS` is narrow enough, or when the time budget runs out.
+"""
+from __future__ import annotations
+
+import math
+import random
+import time
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Callable, Iterable, Optional
+
+import discovery
+
+# The metrics that are estimated for every file, as in `sketch.RepoSketch.FILE_METRICS`
+METRICS = ('nloc', 'loc', 'CCN', 'func_token')
+# The metrics whose confidence intervals decide when enough files were sampled
+PRECISION_METRICS = ('nloc', 'CCN', 'func_token')
+# The default half-width of the confidence intervals, relative to the estimate
+PRECISION = 0.1
+# The default confidence level of the intervals
+CONFIDENCE = 0.95
+# The precision isn't trusted before this many files were sampled
+MIN_FILES = 30
+# The precision is checked every time this many more files were sampled
+CHECK_EVERY = 10
+# The upper bounds (in bytes) of the file size classes, smaller ones first
+SIZE_CLASSES = (1024, 4096, 16384)
+# Directories with fewer files than this share a stratum, so that there are only a few strata
+MIN_STRATUM_FILES = 50
+
+
+def _top_dir(entry: discovery.SourceEntry) -> str:
+    [head, sep, _] = entry.rel_path.partition('/')
+    return head if sep else ''
+
+
+class _Stratum:
+    """The files of a stratum, in the random order they are drawn in, and running statistics of
+    those that were analyzed"""
+    def __init__(self, entries: list[discovery.SourceEntry]):
+        self.entries = entries
+        # The number of files that were drawn, which are analyzed in batches, and of those that were analyzed
+        self.drawn = 0
+        self.sampled = 0
+        self.means = dict.fromkeys(METRICS, 0.0)
+        # The sums of squared differences from the mean, see Welford's algorithm
+        self.squares = dict.fromkeys(METRICS, 0.0)
+
+    def add(self, values: dict[str, float]):
+        self.sampled += 1
+        for metric in METRICS:
+            delta = values[metric] - self.means[metric]
+            self.means[metric] += delta / self.sampled
+            self.squares[metric] += delta * (values[metric] - self.means[metric])
+
+
+@dataclass()
+class Interval:
+    """An estimate and its confidence interval"""
+    estimate: float
+    low: float
+    high: float
+
+    @property
+    def relative_error(self) -> float:
+        """
+        :return: The half-width of the interval, relative to the estimate
+        """
+        half_width = (self.high - self.low) / 2
+        if half_width == 0:
+            return 0.0
+        return half_width / abs(self.estimate) if self.estimate else math.inf
+
+
+@dataclass()
+class Estimate:
+    """The estimated statistics of a repository. `means` are per file and `totals` are over every file,
+    both for the metrics in `METRICS`."""
+    files: int
+    sampled: int
+    confidence: float
+    means: dict[str, Interval] = field(default_factory=dict)
+    totals: dict[str, Interval] = field(default_factory=dict)
+    # The highest CCN of any sampled file, which is a lower bound of the highest CCN of the repository
+    max_ccn: Optional[int] = None
+    elapsed: float = 0.0
+    # Why sampling stopped: `precision`, `time`, or `exhausted` once every file was analyzed
+    reason: Optional[str] = None
+
+    @property
+    def exact(self) -> bool:
+        """If every file was analyzed, so that the estimates are the actual values"""
+        return self.sampled == self.files
+
+    def summary(self) -> dict:
+        """
+        :return: The estimates, named like the columns of the `Repos` table (see `analyze.get_average`),
+            each with the bounds of its interval in `<name>_low` and `<name>_high`
+        """
+        ret = {'Total_File_Num': self.files, 'Sampled_File_Num': self.sampled}
+        for name, interval in (('Avg_nloc', self.means.get('nloc')), ('Total_LOC', self.totals.get('loc')),
+                               ('Avg_CCN', self.means.get('CCN')), ('Avg_func_token', self.means.get('func_token'))):
+            if interval is None:
+                continue
+            ret[name] = round(interval.estimate, 2)
+            ret[f"{name}_low"] = round(interval.low, 2)
+            ret[f"{name}_high"] = round(interval.high, 2)
+        ret['Max_CCN'] = self.max_ccn
+        return ret
+
+
+class StratifiedSample:
+    """Draws files at random from the strata of a repository, keeping every stratum's share of the
+    sample as close to its share of the files as possible. Every stratum is drawn from once before
+    any is drawn from twice, so that none is left out of the estimate."""
+    def __init__(self, entries: Iterable[discovery.SourceEntry], seed=None):
+        entries = list(entries)
+        self.files = len(entries)
+        dir_sizes: dict[str, int] = {}
+        for entry in entries:
+            dir_sizes[_top_dir(entry)] = dir_sizes.get(_top_dir(entry), 0) + 1
+        groups: dict[tuple[str, int], list[discovery.SourceEntry]] = {}
+        for entry in entries:
+            directory = _top_dir(entry)
+            if dir_sizes[directory] < MIN_STRATUM_FILES:
+                directory = ''
+            groups.setdefault((directory, bisect_right(SIZE_CLASSES, entry.size)), []).append(entry)
+        rng = random.Random(seed)
+        self.strata = []
+        # Sorted first, so that the same seed always draws the same files
+        for key in sorted(groups):
+            rng.shuffle(groups[key])
+            self.strata.append(_Stratum(groups[key]))
+        self.max_ccn: Optional[int] = None
+
+    @property
+    def sampled(self) -> int:
+        return sum(stratum.sampled for stratum in self.strata)
+
+    def draw(self) -> Optional[tuple[_Stratum, discovery.SourceEntry]]:
+        """
+        :return: The next file to analyze and its stratum, or `None` if every file was drawn
+        """
+        drawn = sum(stratum.drawn for stratum in self.strata)
+        best = None
+        best_deficit = None
+        for stratum in self.strata:
+            if stratum.drawn == len(stratum.entries):
+                continue
+            if stratum.drawn == 0:
+                deficit = math.inf
+            else:
+                deficit = len(stratum.entries) / self.files * (drawn + 1) - stratum.drawn
+            if best is None or deficit > best_deficit:
+                best = stratum
+                best_deficit = deficit
+        if best is None:
+            return None
+        best.drawn += 1
+        return best, best.entries[best.drawn - 1]
+
+    def drop(self, stratum: _Stratum, entry: discovery.SourceEntry):
+        """Removes a file that was drawn from `stratum`, because it couldn't be analyzed"""
+        stratum.entries.remove(entry)
+        stratum.drawn -= 1
+        self.files -= 1
+
+    def add(self, stratum: _Stratum, values: dict[str, float]):
+        """Records the metrics of a file that was drawn from `stratum`"""
+        stratum.add(values)
+        if self.max_ccn is None or values['CCN'] > self.max_ccn:
+            self.max_ccn = values['CCN']
+
+    def estimate(self, confidence: float = CONFIDENCE) -> Estimate:
+        """
+        :return: The stratified estimates of the metrics, with normal confidence intervals. The variance of
+            strata with fewer than two sampled files is taken from the strata that have more; strata without
+            any sampled file (only if sampling was cut short) are assumed to be like the rest of the sample.
+        """
+        ret = Estimate(files=self.files, sampled=self.sampled, confidence=confidence, max_ccn=self.max_ccn)
+        if not ret.sampled:
+            return ret
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        sampled = [stratum for stratum in self.strata if stratum.sampled]
+        for metric in METRICS:
+            overall = sum(stratum.means[metric] * stratum.sampled for stratum in sampled) / ret.sampled
+            pooled_squares = sum(stratum.squares[metric] for stratum in sampled if stratum.sampled > 1)
+            pooled_df = sum(stratum.sampled - 1 for stratum in sampled if stratum.sampled > 1)
+            if pooled_df:
+                pooled = pooled_squares / pooled_df
+            elif ret.sampled > 1:
+                pooled = sum(stratum.squares[metric] + stratum.sampled * (stratum.means[metric] - overall) ** 2
+                             for stratum in sampled) / (ret.sampled - 1)
+            else:
+                pooled = math.inf
+            mean = 0.0
+            variance = 0.0
+            for stratum in self.strata:
+                weight = len(stratum.entries) / self.files
+                n = stratum.sampled
+                mean += weight * (stratum.means[metric] if n else overall)
+                if n == len(stratum.entries):
+                    # Every file of the stratum is known
+                    continue
+                s2 = stratum.squares[metric] / (n - 1) if n > 1 else pooled
+                variance += weight ** 2 * (1 - n / len(stratum.entries)) * s2 / max(n, 1)
+            half_width = z * math.sqrt(variance) if variance else 0.0
+            ret.means[metric] = Interval(mean, mean - half_width, mean + half_width)
+            ret.totals[metric] = Interval(mean * self.files, (mean - half_width) * self.files,
+                                          (mean + half_width) * self.files)
+        return ret
+
+
+def estimate(entries: Iterable[discovery.SourceEntry],
+             analyze: Optional[Callable[[discovery.SourceEntry], Optional[dict[str, float]]]],
+             precision: float = PRECISION, time_budget: float = None, confidence: float = CONFIDENCE,
+             seed=None, min_files: int = MIN_FILES,
+             analyze_batch: Callable[[list[discovery.SourceEntry]], list[Optional[dict[str, float]]]] = None,
+             batch_files: int = CHECK_EVERY) -> Estimate:
+    """Analyzes randomly drawn files until the estimates are precise enough
+
+    :param entries: Every file of the repository
+    :param analyze: Analyzes a single file, and returns the value of every metric in `METRICS`, or `None`
+        if the file can't be analyzed (e.g. because it went over its budget); such files are left out
+        of the estimates, as they would be left out of a full analysis
+    :param precision: Stop once the confidence interval of every metric in `PRECISION_METRICS` is at
+        most this wide on either side, relative to its estimate
+    :param time_budget: Stop after this many seconds, however precise the estimates are by then
+    :param seed: The seed of the random draws, to draw the same files every time
+    :param min_files: Don't stop for precision before this many files were analyzed
+    :param analyze_batch: Analyzes several files at once (e.g. in parallel), and returns what `analyze` would
+        for each of them, in the same order. If it is given, it is used instead of `analyze`, with up to
+        `batch_files` files at a time; the time budget and the precision are checked after every batch
+    """
+    if analyze_batch is None:
+        def analyze_batch(batch):
+            return [analyze(entry) for entry in batch]
+        batch_files = 1
+    start = time.perf_counter()
+    sample = StratifiedSample(entries, seed)
+    reason = 'exhausted'
+    # The number of analyzed files the precision was last checked at
+    checked = 0
+    while True:
+        batch = []
+        while len(batch) < batch_files:
+            drawn = sample.draw()
+            if drawn is None:
+                break
+            batch.append(drawn)
+        if not batch:
+            break
+        for [stratum, entry], values in zip(batch, analyze_batch([entry for _, entry in batch])):
+            if values is None:
+                sample.drop(stratum, entry)
+            else:
+                sample.add(stratum, values)
+        if time_budget is not None and time.perf_counter() - start >= time_budget:
+            reason = 'time'
+            break
+        if sample.sampled >= min_files and sample.sampled - checked >= CHECK_EVERY:
+            checked = sample.sampled
+            current = sample.estimate(confidence)
+            if all(current.means[metric].relative_error <= precision for metric in PRECISION_METRICS):
+                reason = 'precision'
+                break
+    ret = sample.estimate(confidence)
+    ret.elapsed = time.perf_counter() - start
+    ret.reason = reason if not ret.exact else 'exhausted'
+    return ret
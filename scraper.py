@@ -1,50 +1,140 @@
 import json
-import yaml
-import os
 import sys
 import time
-import urllib.request
-import pandas as pd
-import pymysql
-import requests
-from flask import Flask, jsonify
-from pandas.tseries.offsets import YearEnd
-
-with open('config.yml') as f:
-    keys = yaml.load(f, Loader=yaml.FullLoader)
-
-# Github token
-user = keys['Keys']['GITHUB_USER']
-token = keys['Keys']['GITHUB_TOKEN']
+
+from flask import Flask, jsonify, request
+
+import checkpoint
+import settings
+import timing
+from lazy import lazy_import
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
+
 app = Flask(__name__)
 
+# The GitHub API that repositories are searched with. `GITHUB_API_URL` overrides it, e.g. with a stub
+API_URL = 'https://api.github.com'
+# Where the repositories that were found are sent to be analyzed, see `connect.py`. `ANALYZER_URL` overrides it
+ANALYZER_URL = 'http://127.0.0.1:5000/repos'
+# How long to pause after each search, in seconds. `CRAWL_PAUSE_SECONDS` overrides it
+CRAWL_PAUSE_SECONDS = 10
+
+# The database connection is opened on first use by `get_cursor`
 conn = None
 cursor = None
 
-try:
-    conn = pymysql.connect(
-        user=keys['Keys']['DB_USER'],
-        password=keys['Keys']['DB_PASSWORD'],
-        host=keys['Keys']['DB_HOST'],
-        port=3306,
-        db=keys['Keys']['DB_NAME'],
-    )
-    cursor = conn.cursor()
-except pymysql.Error as e:
-    print(f"Error connecting to MariaDB: {e}")
-    sys.exit(1)
+
+def get_cursor():
+    """
+    :return: A cursor of the database connection. The connection is opened on first use
+    """
+    global conn, cursor
+    if cursor is None:
+        import pymysql
+        keys = settings.keys()
+        try:
+            conn = pymysql.connect(
+                user=keys['DB_USER'],
+                password=keys['DB_PASSWORD'],
+                host=keys['DB_HOST'],
+                port=3306,
+                db=keys['DB_NAME'],
+            )
+            cursor = conn.cursor()
+        except pymysql.Error as e:
+            print(f"Error connecting to MariaDB: {e}")
+            sys.exit(1)
+    return cursor
+
+
+# Opened on first use by `crawl_checkpoint`
+_checkpoint = None
+
+
+def crawl_checkpoint():
+    """
+    :return: Where crawls are tracked, see `checkpoint`. The file is set by the optional `CRAWL_CHECKPOINT` key
+    """
+    global _checkpoint
+    if _checkpoint is None:
+        _checkpoint = checkpoint.Checkpoint(settings.keys().get('CRAWL_CHECKPOINT') or checkpoint.CHECKPOINT_PATH)
+    return _checkpoint
 
 
 @app.route('/<string:language>/<int:stars>/<int:forks>/<int:years>/', methods=['GET'])
 def to_scraper(language, stars, forks, years):
-    for beg in pd.date_range(end=pd.datetime.now().date(), periods=years, freq='YS')[::-1]:
-        dt = beg.strftime("%Y-%m-%d") + '..' + (beg + YearEnd(1)).strftime("%Y-%m-%d")
-        url = f'https://api.github.com/search/repositories?q=stars:>={stars}+forks:>={forks}+language:{language}+created:{dt}+is:sponsorable+sort:reactions+sort:updated+&order=desc&per_page=100&'
+    """Crawls the repositories created in each of the last `years` years. A crawl of the same search that
+    was interrupted is resumed where it stopped. With `?incremental=1`, only repositories pushed since the
+    last crawl of the same search that finished are crawled. While a search is being crawled, another crawl
+    of it is refused with 409."""
+    query = f"{language}/{stars}/{forks}/{years}"
+    try:
+        with crawl_checkpoint().claim(query):
+            run_crawl(query, language, stars, forks, years)
+    except checkpoint.CrawlInProgress:
+        return jsonify({"error": f"{query} is already being crawled"}), 409
+    return jsonify({"language": language, "forks": forks, "stars": stars, "years": years})
+
+
+def run_crawl(query, language, stars, forks, years):
+    """Crawls a search from where its checkpoint says it stopped, see `to_scraper`"""
+    from pandas.tseries.offsets import YearEnd
+    state = crawl_checkpoint().resume(query)
+    if state is None:
+        slices = [beg.strftime("%Y-%m-%d") + '..' + (beg + YearEnd(1)).strftime("%Y-%m-%d")
+                  for beg in pd.date_range(end=pd.datetime.now().date(), periods=years, freq='YS')[::-1]]
+        since = crawl_checkpoint().last_success(query) if request.args.get('incremental') else None
+        state = checkpoint.CrawlState(query, slices, since=since)
+        crawl_checkpoint().save(state)
+    else:
+        print(f"Resuming the crawl of {query} at {state.slices[state.slice]}, page {state.page}")
+    while state.slice < len(state.slices):
+        dt = state.slices[state.slice]
+        pushed = f'+pushed:>={state.since}' if state.since else ''
+        url = f'{api_url()}/search/repositories?q=stars:>={stars}+forks:>={forks}+language:{language}+created:{dt}{pushed}+is:sponsorable+sort:reactions+sort:updated+&order=desc&per_page=100&'
         print(dt)
 
-        crawling(url)
+        crawling(url, state)
+        state.slice += 1
+        state.page = 1
+        crawl_checkpoint().save(state)
+    crawl_checkpoint().finish(state)
 
-    return jsonify({"language": language, "forks": forks, "stars": stars, "years": years})
+
+def api_url():
+    return settings.keys().get('GITHUB_API_URL') or API_URL
+
+
+def send_to_analyzer(listing):
+    """Sends repository URLs to `connect.py` to be analyzed"""
+    headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+    with timing.stage('post', repos=len(listing)):
+        requests.post(settings.keys().get('ANALYZER_URL') or ANALYZER_URL, json=json.dumps(listing),
+                      headers=headers)
+
+
+def github_get(url, auth=None):
+    """GETs `url` from the GitHub API. When the rate limit is exceeded, waits until it is reset and tries again.
+
+    :return: The response
+    """
+    while True:
+        with timing.stage('search', url=url):
+            response = requests.get(url, auth=auth)
+        if response.status_code not in (403, 429):
+            return response
+        if 'Retry-After' in response.headers:
+            wait = int(response.headers['Retry-After'])
+        elif response.headers.get('X-RateLimit-Remaining') == '0':
+            wait = max(int(response.headers['X-RateLimit-Reset']) - time.time(), 0) + 1
+        else:
+            return response
+        print(f"Rate limited by GitHub, waiting {wait:.0f} s")
+        timing.event('rate_limited', url=url, wait=wait)
+        time.sleep(wait)
 
 
 def scrape(url):
@@ -56,29 +146,52 @@ def scrape(url):
         j = s['html_url']
         listing.append(j)
 
-    urls = "http://127.0.0.1:5000/repos"
-    headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-    requests.post(urls, json=json.dumps(listing), headers=headers)
+    send_to_analyzer(listing)
 
 
-total_list = []
-cursor.execute(f"SELECT URL FROM Repos")
-db_url = [item[0] for item in cursor.fetchall()]
-total_list.extend(db_url)
+# Every URL that was already analyzed or queued. It is loaded from the database by the first crawl
+total_list = None
 
-def crawling(url):
-    requested = urllib.request.Request(url)
-    response = urllib.request.urlopen(requested)
-    rescode = response.getcode()
-    tot_repos = requests.get(url, auth=(user, token)).json()
+
+def load_total_list():
+    global total_list
+    if total_list is None:
+        if settings.keys().get('DB_URL'):
+            # An embedded database, see `analyze.get_engine`
+            import sqlalchemy
+            import analyze
+            engine = analyze.get_engine()
+            if not sqlalchemy.inspect(engine).has_table('Repos'):
+                total_list = []
+                return total_list
+            with engine.connect() as con:
+                total_list = list(con.execute(sqlalchemy.text("SELECT URL FROM Repos")).scalars())
+            return total_list
+        cursor = get_cursor()
+        cursor.execute(f"SELECT URL FROM Repos")
+        total_list = [item[0] for item in cursor.fetchall()]
+    return total_list
+
+
+def crawling(url, state=None):
+    """Crawls every page of a search, and sends the repositories that weren't seen before to be analyzed
+
+    :param state: Where the crawl is. The crawl starts at `state.page`, and `state` is saved to the
+        checkpoint (see `crawl_checkpoint`) once the repositories of each page were sent
+    """
+    user = settings.keys()['GITHUB_USER']
+    token = settings.keys()['GITHUB_TOKEN']
+    response = github_get(url, auth=(user, token))
+    rescode = response.status_code
+    tot_repos = response.json()
     total = tot_repos["total_count"]
     print('Total count of repos:', total)
-    global total_list
+    total_list = load_total_list()
     final_list = []
-    i = 1
+    i = 1 if state is None else state.page
     while i <= (total / 100) + 1:
         final_url = url + 'page={}'.format(i)
-        res = requests.get(final_url, auth=(user, token))
+        res = github_get(final_url, auth=(user, token))
         repos = res.json()
         if rescode == 200:
             repos.get('items', 'error')
@@ -92,16 +205,26 @@ def crawling(url):
                         else:
                             final_list.append(res_data)
                             total_list.append(res_data)
+                            timing.event('discovered', url=res_data)
 
                 except KeyError:
                     print("error")
 
             i = i + 1
             temp_list.clear()
-    urls = "http://127.0.0.1:5000/repos"
-    headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-    requests.post(urls, json=json.dumps(final_list), headers=headers)
-    time.sleep(10)
+            if state is not None:
+                # Sent before the page is checkpointed, so that no repository is lost if the crawl stops here
+                if final_list:
+                    send_to_analyzer(final_list)
+                    final_list.clear()
+                state.page = i
+                if repos['items']:
+                    state.last_seen = repos['items'][-1].get('updated_at')
+                crawl_checkpoint().save(state)
+    if final_list or state is None:
+        send_to_analyzer(final_list)
+    pause = settings.keys().get('CRAWL_PAUSE_SECONDS')
+    time.sleep(CRAWL_PAUSE_SECONDS if pause is None else pause)
     final_list.clear()
 
 
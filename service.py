@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+from flask import Flask, abort, jsonify, request
+
+import analysis_api
+from lazy import lazy_import
+from mirrors import resolve_head
+
+# These are only loaded once they are actually used, see `bench_imports.py`
+git = lazy_import('git')
+pd = lazy_import('pandas')
+
+# The most entries kept in memory and on disk
+MEMORY_ENTRIES = 32
+DISK_ENTRIES = 512
+# The default and largest page sizes
+PER_PAGE = 50
+MAX_PER_PAGE = 1000
+# The hosts that repositories may be analyzed from. Anything else, including local paths and `file://`
+# URLs, is refused, since the URL is handed to git
+ALLOWED_HOSTS = ('github.com',)
+# The only form of repository URL that is accepted, e.g. `https://github.com/owner/repo`
+URL_PATTERN = re.compile(r'https://(?P<host>[A-Za-z0-9.-]+)/[A-Za-z0-9_][A-Za-z0-9_.-]*/[A-Za-z0-9_][A-Za-z0-9_.-]*/?')
+# How long (in seconds) the resolved HEAD of a repository is reused, so that paging through an analysis
+# doesn't ask the remote for its HEAD on every request
+HEAD_TTL = 60
+
+
+@dataclass()
+class Analysis:
+    """The finished analysis of a repository at a single commit"""
+    url: str
+    commit: str
+    repo_analysis: pd.DataFrame
+    file_analysis: dict[str, pd.DataFrame]
+    _functions: pd.DataFrame = None
+
+    @property
+    def functions(self) -> pd.DataFrame:
+        """Every function of every file, with the path of the file in the `file` column"""
+        if self._functions is None:
+            frames = [df.assign(file=file) for file, df in self.file_analysis.items()]
+            columns = ['file'] + analysis_api.FUNCTION_COLUMNS
+            self._functions = pd.concat(frames, ignore_index=True)[columns] if frames else pd.DataFrame(columns=columns)
+        return self._functions
+
+
+class AnalysisCache:
+    """A two-level LRU cache of finished analyses, keyed by (URL, commit). Since a commit never
+    changes, entries never go stale; they are only evicted to bound memory and disk usage.
+
+    The most recently used entries are kept in memory, and every entry is also pickled to
+    `disk_dir`. The disk level uses file modification times to track recency, so it survives
+    restarts and can be shared by several service processes.
+    """
+    def __init__(self, disk_dir: Path, memory_entries: int = MEMORY_ENTRIES, disk_entries: int = DISK_ENTRIES):
+        self.disk_dir = Path(disk_dir)
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.memory: OrderedDict[tuple[str, str], Analysis] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _disk_path(self, key: tuple[str, str]) -> Path:
+        [url, commit] = key
+        url_hash = hashlib.sha256(url.encode()).hexdigest()[:16]
+        return self.disk_dir / f"{url_hash}_{commit}.pkl"
+
+    def _remember(self, key: tuple[str, str], analysis: Analysis):
+        with self.lock:
+            self.memory[key] = analysis
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, key: tuple[str, str]) -> Optional[Analysis]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        path = self._disk_path(key)
+        try:
+            with open(path, mode='rb') as fp:
+                analysis = pickle.load(fp)
+            # Marks the entry as recently used
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        self._remember(key, analysis)
+        return analysis
+
+    def put(self, key: tuple[str, str], analysis: Analysis):
+        self._remember(key, analysis)
+        path = self._disk_path(key)
+        # Written under a temporary name first, so a reader never sees a partial file
+        partial_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.partial")
+        with open(partial_path, mode='wb') as fp:
+            pickle.dump(analysis, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = sorted(self.disk_dir.glob('*.pkl'), key=lambda p: p.stat().st_mtime)
+        for path in entries[:max(len(entries) - self.disk_entries, 0)]:
+            try:
+                path.unlink()
+            except OSError:
+                # Already evicted by another process
+                pass
+
+
+class SingleFlight:
+    """Makes sure that concurrent calls for the same key share a single execution"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight: dict = {}
+
+    def do(self, key, fn: Callable):
+        """Calls `fn`, unless a call for `key` is already in progress; in that case, waits for that
+        call to finish and returns its result (or raises its exception) instead."""
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(fn())
+        except BaseException as err:
+            future.set_exception(err)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return future.result()
+
+
+class AnalysisService:
+    """Analyzes repositories on request, paying for at most one clone and analysis per (URL, commit)"""
+    def __init__(self, cache: AnalysisCache, head_ttl: float = HEAD_TTL):
+        self.cache = cache
+        self.flights = SingleFlight()
+        self.head_ttl = head_ttl
+        # URL -> (HEAD commit, when it was resolved)
+        self.heads: dict[str, tuple[str, float]] = {}
+        self.heads_lock = threading.Lock()
+
+    def _head(self, url: str) -> str:
+        now = time.monotonic()
+        with self.heads_lock:
+            cached = self.heads.get(url)
+        if cached is not None and now - cached[1] < self.head_ttl:
+            return cached[0]
+        commit = resolve_head(url)
+        with self.heads_lock:
+            self.heads[url] = (commit, now)
+            # Expired entries are dropped here, so that the map doesn't grow without bound
+            for stale in [u for u, (_, resolved_at) in self.heads.items() if now - resolved_at >= self.head_ttl]:
+                del self.heads[stale]
+        return commit
+
+    def get(self, url: str) -> Analysis:
+        """
+        :return: The analysis of the HEAD of the repository at `url`, as of at most `head_ttl` seconds ago
+        :raise ValueError: if `url` is not a git repository
+        :raise git.GitCommandError: if the repository could not be cloned
+        """
+        key = (url, self._head(url))
+        analysis = self.cache.get(key)
+        if analysis is not None:
+            return analysis
+        return self.flights.do(key, lambda: self._analyze(key))
+
+    def _analyze(self, key: tuple[str, str]) -> Analysis:
+        # Another request may have finished this analysis while we were waiting for the flight
+        analysis = self.cache.get(key)
+        if analysis is not None:
+            return analysis
+        repo = analysis_api.ClonedRepo.from_url(key[0])
+        repo.analyze_repo()
+        # HEAD may have moved on between resolving it and cloning, so the clone's own commit is used
+        analysis = Analysis(key[0], repo.commit or key[1], repo.repo_analysis, repo.file_analysis)
+        self.cache.put((analysis.url, analysis.commit), analysis)
+        if analysis.commit != key[1]:
+            self.cache.put(key, analysis)
+        return analysis
+
+
+def _page(df: pd.DataFrame):
+    """Sorts and paginates `df` according to the request's `sort`, `ascending`, `page` and `per_page`
+    arguments"""
+    sort = request.args.get('sort')
+    if sort is not None:
+        if sort not in df.columns:
+            abort(400, f"Unknown sort key '{sort}'")
+        ascending = request.args.get('ascending', 'true').lower() != 'false'
+        df = df.sort_values(by=sort, ascending=ascending, kind='stable')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    items = df.iloc[(page - 1) * per_page:page * per_page]
+    return {
+        'page': page,
+        'per_page': per_page,
+        'total': len(df),
+        # Round-tripped through pandas' JSON writer, which knows how to handle numpy types and NaN
+        'items': json.loads(items.to_json(orient='records')),
+    }
+
+
+def is_allowed_url(url: str, allowed_hosts=ALLOWED_HOSTS) -> bool:
+    """
+    :return: If `url` is of the form `https://<host>/<owner>/<repo>`, with one of `allowed_hosts`
+    """
+    match = URL_PATTERN.fullmatch(url)
+    return match is not None and match['host'].lower() in allowed_hosts
+
+
+def create_app(cache_dir: Path = None, allowed_hosts=ALLOWED_HOSTS) -> Flask:
+    """
+    :param cache_dir: Where finished analyses are stored. Defaults to `cache/analyses` in the working directory
+    :param allowed_hosts: The hosts that repositories may be analyzed from
+    """
+    app = Flask(__name__)
+    service = AnalysisService(AnalysisCache(cache_dir or Path(os.getcwd()) / 'cache' / 'analyses'))
+
+    def get_analysis() -> Analysis:
+        url = request.args.get('url')
+        if not url:
+            abort(400, "Missing 'url' argument")
+        if not is_allowed_url(url, allowed_hosts):
+            abort(400, f"Only https://<host>/<owner>/<repo> URLs from {', '.join(allowed_hosts)} can be analyzed")
+        try:
+            return service.get(url)
+        except ValueError as err:
+            abort(404, str(err))
+        except git.GitCommandError as err:
+            # The remote answered `git ls-remote`, so the clone failing is a problem on its side
+            abort(502, f"Cloning {url} failed: {err}")
+
+    @app.route('/analysis', methods=['GET'])
+    def analysis():
+        result = get_analysis()
+        return jsonify({
+            'url': result.url,
+            'commit': result.commit,
+            'files': len(result.repo_analysis),
+            'functions': len(result.functions),
+            'nloc': int(result.repo_analysis['nloc'].sum()),
+            'CCN': int(result.repo_analysis['CCN'].sum()),
+        })
+
+    @app.route('/files', methods=['GET'])
+    def files():
+        return jsonify(_page(get_analysis().repo_analysis))
+
+    @app.route('/functions', methods=['GET'])
+    def functions():
+        result = get_analysis()
+        df = result.functions
+        file = request.args.get('file')
+        if file is not None:
+            df = df[df.file == file]
+        return jsonify(_page(df))
+
+    return app
+
+
+if __name__ == '__main__':
+    create_app().run(host='127.0.0.1', port=5001, threaded=True)
@@ -0,0 +1,14 @@
+from functools import lru_cache
+
+# The configuration file, relative to the working directory
+CONFIG_PATH = 'config.yml'
+
+
+@lru_cache(maxsize=None)
+def keys() -> dict:
+    """
+    :return: The `Keys` section of `config.yml`. The file is only read the first time this is called
+    """
+    import yaml
+    with open(CONFIG_PATH) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)['Keys']
@@ -0,0 +1,157 @@
+import json
+import math
+from typing import Iterable
+
+# Values up to this are counted exactly, one bucket per integer
+EXACT_LIMIT = 64
+# Above `EXACT_LIMIT`, each bucket is this many times wider than the one before it
+GROWTH = 2 ** 0.125
+
+
+def bucket_of(value: float) -> int:
+    """
+    :return: The index of the histogram bucket that `value` falls into. Buckets `0..EXACT_LIMIT`
+        each hold a single integer, the ones above that grow geometrically.
+    """
+    if value <= EXACT_LIMIT:
+        return max(int(value), 0)
+    return EXACT_LIMIT + 1 + int(math.log(value / EXACT_LIMIT, GROWTH))
+
+
+def bucket_bounds(bucket: int) -> tuple[float, float]:
+    """
+    :return: The lower (inclusive) and upper (exclusive) bounds of the values in `bucket`
+    """
+    if bucket <= EXACT_LIMIT:
+        return bucket, bucket + 1
+    k = bucket - EXACT_LIMIT - 1
+    return EXACT_LIMIT * GROWTH ** k, EXACT_LIMIT * GROWTH ** (k + 1)
+
+
+class Histogram:
+    """A mergeable streaming summary of a non-negative metric, such as the CCN of every function.
+
+    Values are counted in fixed buckets, exact for small integers and about 9% wide above
+    `EXACT_LIMIT`, so quantiles can be read off at any time without keeping the values around.
+    Since the buckets are the same for every histogram, two histograms are merged by adding up
+    their counts; this is what lets fleet-wide percentiles be computed from per-repo sketches.
+    """
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value: float):
+        bucket = bucket_of(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def update(self, values: Iterable[float]):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        """Adds the contents of `other` to this histogram in-place, and returns this histogram"""
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else math.nan
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: The quantile, between 0 and 1
+        :return: An estimate of the `q`-quantile. Exact for integers up to `EXACT_LIMIT`, otherwise
+            within one bucket width of the true value. NaN if the histogram is empty.
+        """
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen > rank:
+                if bucket <= EXACT_LIMIT:
+                    return float(bucket)
+                [low, high] = bucket_bounds(bucket)
+                return min(math.sqrt(low * high), self.max)
+        return float(self.max)
+
+    def to_dict(self) -> dict:
+        return {
+            'counts': {str(bucket): count for bucket, count in sorted(self.counts.items())},
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "Histogram":
+        ret = Histogram()
+        ret.counts = {int(bucket): count for bucket, count in data['counts'].items()}
+        ret.count = data['count']
+        ret.total = data['total']
+        ret.max = data['max']
+        return ret
+
+
+class RepoSketch:
+    """Streaming statistics for a single repository (or, once merged, for many repositories).
+    It is updated once per analyzed file and never needs the per-file rows afterwards.
+    """
+    # The metrics that are tracked for every file
+    FILE_METRICS = ('nloc', 'loc', 'CCN', 'func_token')
+
+    def __init__(self):
+        self.files = {metric: Histogram() for metric in self.FILE_METRICS}
+        self.functions = Histogram()
+
+    def add_file(self, nloc: int, loc: int, ccn: int, func_token: int, function_ccns: Iterable[int] = ()):
+        """Records a single analyzed file
+        :param function_ccns: The CCN of every function in the file
+        """
+        for metric, value in zip(self.FILE_METRICS, (nloc, loc, ccn, func_token)):
+            self.files[metric].add(value)
+        self.functions.update(function_ccns)
+
+    def merge(self, other: "RepoSketch") -> "RepoSketch":
+        for metric in self.FILE_METRICS:
+            self.files[metric].merge(other.files[metric])
+        self.functions.merge(other.functions)
+        return self
+
+    @property
+    def file_count(self) -> int:
+        return self.files['CCN'].count
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'files': {metric: hist.to_dict() for metric, hist in self.files.items()},
+            'functions': self.functions.to_dict(),
+        })
+
+    @staticmethod
+    def from_json(text: str) -> "RepoSketch":
+        data = json.loads(text)
+        ret = RepoSketch()
+        ret.files = {metric: Histogram.from_dict(hist) for metric, hist in data['files'].items()}
+        ret.functions = Histogram.from_dict(data['functions'])
+        return ret
+
+
+def merge_all(sketches: Iterable[RepoSketch]) -> RepoSketch:
+    """Merges any number of sketches into a new one"""
+    ret = RepoSketch()
+    for sketch in sketches:
+        ret.merge(sketch)
+    return ret
@@ -0,0 +1,121 @@
+"""Checks that `fast_python` gives the same results as lizard, field by field, on small Python sources that
+each exercise a part of lizard's Python reader. `conformance.py` compares the engines on a whole corpus.
+
+Run with `python -m pytest test_conformance.py`.
+"""
+import textwrap
+
+import lizard
+import pytest
+
+import fast_python
+
+# The sources both engines analyze, by the part of lizard's reader they exercise
+SOURCES = {
+    'empty': '',
+    'module level code': '''
+        import os
+        x = 1 if os.sep == '/' else 2
+        for i in range(3):
+            print(i and x or None)
+    ''',
+    'function': '''
+        def f(a, b=1, *args, **kwargs):
+            """Docstring with if and or in it"""
+            if a and b:
+                return a
+            elif a or b:
+                return b
+            return None
+    ''',
+    'nested functions': '''
+        def outer(x):
+            def inner(y):
+                while y:
+                    y -= 1
+                return y
+            return inner(x) if x else 0
+
+        def after():
+            pass
+    ''',
+    'methods and decorators': '''
+        import functools
+
+
+        class A:
+            """A class"""
+            attribute = [i for i in range(10) if i % 2]
+
+            @staticmethod
+            def static(x):
+                return [y for y in x if y]
+
+            @functools.lru_cache(maxsize=None)
+            def cached(self, n):
+                try:
+                    return n // 2
+                except ZeroDivisionError:
+                    return 0
+                finally:
+                    pass
+
+            async def coroutine(self):
+                async for item in self.items():
+                    if item:
+                        await item
+    ''',
+    'multi-line signature': '''
+        def f(
+            a,  # a comment
+            b=(1,
+               2),
+        ):
+            return lambda x: x and a or b
+    ''',
+    'strings and comments': """
+        def f():
+            # if while for
+            s = 'if and or'
+            t = '''
+        def not_a_function():
+            if True:
+                pass
+        '''
+            u = f"{s!r} and {t}"
+            return s + t + u \\
+                + 'for'
+    """,
+    'loops with else': '''
+        def f(items):
+            for item in items:
+                if item is None:
+                    break
+            else:
+                return True
+            while items:
+                items.pop()
+            else:
+                return False
+    ''',
+}
+
+# The metrics of a file that must match
+FILE_FIELDS = ('nloc', 'token_count', 'CCN')
+# The metrics of a function that must match
+FUNCTION_FIELDS = ('name', 'start_line', 'nloc', 'token_count', 'cyclomatic_complexity')
+
+
+@pytest.mark.parametrize('name', SOURCES)
+def test_same_as_lizard(name):
+    source = textwrap.dedent(SOURCES[name])
+    path = f"{name.replace(' ', '_')}.py"
+    fast = fast_python.analyze_source(source, path)
+    expected = lizard.analyze_file.analyze_source_code(path, source)
+
+    for field in FILE_FIELDS:
+        assert getattr(fast, field) == getattr(expected, field), field
+    assert len(fast.function_list) == len(expected.function_list)
+    for func, expected_func in zip(fast.function_list, expected.function_list):
+        for field in FUNCTION_FIELDS:
+            assert getattr(func, field) == getattr(expected_func, field), f"{expected_func.name}: {field}"
@@ -0,0 +1,37 @@
+"""Hooks that report the stages of the crawl pipeline as they happen, e.g. to `loadtest.py`.
+
+The scraper, `connect.py` and `analyze.goes_through` call `event` when a repository moves from one stage
+to the next, and time their slow steps with `stage`. Nothing is recorded unless a hook was added to
+`hooks`, so outside of a load test this costs no more than a function call.
+"""
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# Called with the name of the event or stage, when it started (`time.perf_counter`), how long it took in
+# seconds (`None` for events) and the fields it was reported with
+hooks: list[Callable[[str, float, Optional[float], dict], None]] = []
+
+
+def event(name: str, **fields):
+    """Reports that something happened, e.g. that a repository was queued"""
+    if not hooks:
+        return
+    now = time.perf_counter()
+    for hook in hooks:
+        hook(name, now, None, fields)
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """Reports how long the body of the `with` statement took"""
+    if not hooks:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        for hook in hooks:
+            hook(name, start, duration, fields)
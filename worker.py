@@ -0,0 +1,139 @@
+"""Analyzes repositories from the job queue that is shared through the database, see `jobs.JobStore`.
+
+Usage: python worker.py [processes]
+       python worker.py enqueue [URL ...]
+
+Any number of workers can run on any number of hosts, as long as they use the same database (`DB_URL`,
+or the MySQL database of `config.yml`). Each worker claims a repository, analyzes it in a scratch
+directory of its own (see `mirrors`), and commits its results in the same transaction that marks the
+job as done. A worker that crashes or hangs stops renewing its lease, and once the lease has expired
+the repository is claimed by another worker. With `enqueue`, the URLs given (or read from standard
+input, one per line) are added to the queue.
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import analyze
+import settings
+
+# How long an idle worker waits before looking for new jobs again
+POLL_SECONDS = 5
+
+
+def open_job_store():
+    """Opens the job queue in the results database, with the lease length set by the optional
+    `LEASE_SECONDS` key"""
+    import jobs
+    return jobs.JobStore(analyze.get_engine(), settings.keys().get('LEASE_SECONDS') or jobs.LEASE_SECONDS)
+
+
+def process(store, lease, pool, function_writer):
+    """Analyzes the repository of a claimed job and commits its results, unless the lease was lost"""
+    import dedup
+    import jobs
+    interval = settings.keys().get('HEARTBEAT_SECONDS') or jobs.HEARTBEAT_SECONDS
+    try:
+        duplicate = dedup.find_duplicate(analyze.get_engine(), lease.url, lease.language)
+        if duplicate is not None:
+            with analyze.get_engine().begin() as conn:
+                analyze.reuse_duplicate(duplicate, lease.url, lease.language, conn)
+                store.complete(lease, conn)
+            print(f"{lease.url} has the same code as {duplicate.source_url}, its results were reused")
+            return
+        with jobs.Heartbeat(store, lease, interval) as heartbeat:
+            df, repo_sketch, skipped, identity, estimate = analyze.analyze_repo(
+                lease.url, lease.language, function_writer, pool, function_writer, lease.token)
+            if heartbeat.lost.is_set():
+                raise jobs.LeaseLost(lease.url)
+            # Results replace those of any earlier attempt, and are only committed by the lease holder
+            with analyze.get_engine().begin() as conn:
+                if estimate is not None:
+                    analyze.send_estimate(estimate, lease.url, df is not None, conn)
+                if df is None:
+                    # Skipped because of its estimate; the results of any earlier analysis are kept
+                    print(f"Skipped {lease.url}, its estimated Avg_CCN is {estimate.means['CCN'].estimate:.2f}")
+                else:
+                    analyze.remove_results(lease.url, conn)
+                    function_writer.commit(conn)
+                    if skipped:
+                        analyze.send_skipped(skipped, lease.url, conn)
+                    if not df.empty:
+                        analyze.get_average(df, lease.url, None, repo_sketch, conn)
+                    else:
+                        print(f"no {lease.language} files found in {lease.url}")
+                    dedup.record(conn, lease.url, lease.language, identity)
+                store.complete(lease, conn)
+    except jobs.LeaseLost:
+        function_writer.discard()
+        print(f"Lost the lease of {lease.url}, another worker is analyzing it")
+    except Exception:
+        function_writer.discard()
+        print(f"Failed to analyze {lease.url} (attempt {lease.attempt})")
+        store.fail(lease, traceback.format_exc())
+    except BaseException:
+        # Shut down while working on the job: give it back right away rather than when the lease expires
+        function_writer.discard()
+        store.release(lease)
+        raise
+
+
+def run(once=False):
+    """Claims and analyzes jobs until the process is stopped
+
+    :param once: Return as soon as the queue is empty, instead of waiting for new jobs
+    """
+    import dedup
+    import function_store
+    # Stopping with SIGTERM gives the current job back, just like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    store = open_job_store()
+    pool = analyze.open_budget_pool()
+    function_writer = function_store.FunctionStoreWriter(analyze.get_engine())
+    dedup.create_schema(analyze.get_engine())
+    try:
+        while True:
+            lease = store.claim(worker_id)
+            if lease is None:
+                if once:
+                    return
+                time.sleep(POLL_SECONDS)
+                continue
+            print(f"{worker_id} is analyzing {lease.url}")
+            process(store, lease, pool, function_writer)
+    finally:
+        pool.close()
+
+
+def enqueue(urls, language='python'):
+    added = open_job_store().enqueue(urls, language)
+    print(f"Added {added} of {len(urls)} repositories to the queue")
+
+
+def main():
+    if sys.argv[1:2] == ['enqueue']:
+        urls = sys.argv[2:] or [line.strip() for line in sys.stdin if line.strip()]
+        enqueue(urls)
+        return
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if processes == 1:
+        run()
+        return
+    children = [multiprocessing.Process(target=run) for _ in range(processes)]
+    for child in children:
+        child.start()
+    try:
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        for child in children:
+            child.join()
+
+
+if __name__ == '__main__':
+    main()